@@ -18,6 +18,9 @@ def _override_model_defaults():
     Server.freq_scale_min = conf.freq_scale_min
     Server.freq_scale_delta = conf.freq_scale_delta
     Server.freq_scale_digits = conf.freq_scale_digits
+    # set the State implementation used by the cloud model
+    Cloud.state_class = globals()[conf.state_backend]
+    StateHistory.snapshot_interval = conf.state_history_interval
     # TODO: also set Server.resource_types
 
 def _setup(conf_module='philharmonic.settings.base'):
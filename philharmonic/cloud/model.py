@@ -10,10 +10,16 @@ Created on Jul 11, 2013
 
 '''
 
+import bisect
 import copy
 import itertools
+import math
+from collections import MutableMapping
+from datetime import datetime
 
-from philharmonic.utils import deprecated, CommonEqualityMixin
+import numpy as np
+
+from philharmonic.utils import deprecated
 from . import visualiser
 
 def format_spec(spec):
@@ -34,16 +40,136 @@ def format_spec(spec):
 class ModelUsageError(Exception):
     pass
 
+class ResourceSpec(MutableMapping):
+    """The resources of a machine - a dict-like view resource -> value of a
+    NumPy vector aligned with resource_types, so that capacity arithmetic
+    can be done with vector operations. The first len(vector) resource types
+    are specified.
+
+    """
+    __slots__ = ('vector', 'resource_types')
+
+    def __init__(self, values=(), resource_types=None):
+        if resource_types is None:
+            resource_types = Machine.resource_types
+        if len(values) > len(resource_types):
+            raise ModelUsageError("more values than resource types")
+        self.vector = np.array(values)
+        self.resource_types = resource_types
+
+    def _position(self, r):
+        try:
+            i = self.resource_types.index(r)
+        except ValueError:
+            raise KeyError(r)
+        if i >= len(self.vector):
+            raise KeyError(r)
+        return i
+
+    def __getitem__(self, r):
+        return self.vector[self._position(r)].item()
+
+    def __setitem__(self, r, value):
+        try:
+            i = self._position(r)
+        except KeyError:
+            if r not in self.resource_types:
+                raise ModelUsageError("unknown resource type {}".format(r))
+            if self.resource_types.index(r) != len(self.vector):
+                raise ModelUsageError("resources must be specified in the "
+                                      "order of the resource types")
+            self.vector = np.append(self.vector, value)
+            return
+        dtype = np.result_type(self.vector, value)
+        if dtype != self.vector.dtype: # e.g. int capacity, float demand
+            self.vector = self.vector.astype(dtype)
+        self.vector[i] = value
+
+    def __delitem__(self, r):
+        raise ModelUsageError("resources cannot be removed")
+
+    def __iter__(self):
+        return iter(self.resource_types[:len(self.vector)])
+
+    def __len__(self):
+        return len(self.vector)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def copy(self):
+        new = ResourceSpec.__new__(ResourceSpec)
+        new.vector = self.vector.copy()
+        new.resource_types = self.resource_types
+        return new
+
+    __copy__ = copy
+
+    def __reduce__(self):
+        return (ResourceSpec, (self.vector.tolist(), self.resource_types))
+
+    def aligned(self, resource_types):
+        """Return the values as a float vector aligned with resource_types
+        (0 for the resources that are not specified)."""
+        if resource_types == self.resource_types[:len(resource_types)]:
+            n = min(len(self.vector), len(resource_types))
+            vector = np.zeros(len(resource_types))
+            vector[:n] = self.vector[:n]
+            return vector
+        return np.array([self.get(r, 0) for r in resource_types], dtype=float)
+
+def _as_spec(spec):
+    """Convert a dict resource -> value into a ResourceSpec."""
+    if isinstance(spec, ResourceSpec):
+        return spec
+    resource_types = Machine.resource_types
+    values = []
+    for r in resource_types:
+        if r not in spec:
+            break
+        values.append(spec[r])
+    if len(values) != len(spec):
+        raise ModelUsageError("resources must be specified in the "
+                              "order of the resource types")
+    return ResourceSpec(values, resource_types)
+
 # some non-semantic functionality common for VMs and servers
 class Machine(object):
     resource_types = ['RAM', '#CPUs'] # can be overridden
     _weights = None
+    __slots__ = ('id', '_spec', 'cloud')
 
     def __init__(self, *args):
         self.id = type(self)._new_id()
-        self.spec = {}
-        for (i, arg) in enumerate(args):
-            self.spec[self.resource_types[i]] = arg
+        self._spec = ResourceSpec(args, self.resource_types)
+
+    def get_spec(self):
+        return self._spec
+
+    def set_spec(self, spec):
+        self._spec = _as_spec(spec)
+
+    spec = property(get_spec, set_spec, doc="resource -> value")
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple): # (__dict__, slots) - protocol 2 default
+            state = dict(state[0] or {}, **(state[1] or {}))
+        for name, value in state.iteritems():
+            if name in ('spec', 'res', 'cap', '_spec'):
+                self.spec = value
+            else:
+                try:
+                    setattr(self, name, value)
+                except AttributeError: # attribute no longer in the model
+                    pass
 
     def __str__(self):
         return self.__repr__()
@@ -98,10 +224,10 @@ class VM(Machine):
 
     machine_type = 'VM'
     _new_id = itertools.count(start=1).next
+    __slots__ = ('price', 'beta')
 
     def __init__(self, *args):
         super(VM, self).__init__(*args)
-        self.res = self.spec
         self.price = 0.026 # $/h - default price Amazon US East t2.small
         # beta or CPU-boundedness: 1. CPU-bounded, towards 0. not CPU-bounded
         self.beta = 1.
@@ -114,6 +240,8 @@ class VM(Machine):
             pass
         return s
 
+    res = Machine.spec # resource requirements
+
     # calling (un)pause or migrate on a VM gets routed to the cloud
     # and then to the current state
 
@@ -138,11 +266,11 @@ class Server(Machine):
     freq_scale_min = 0.4
     freq_scale_delta = 0.1
     freq_scale_digits = 1
+    __slots__ = ('_loc',)
 
     def __init__(self, *args, **kwargs):
         """@param location: server's geographical location"""
         super(Server, self).__init__(*args)
-        self.cap = self.spec
         if 'location' in kwargs:
             self._loc = kwargs['location']
 
@@ -154,6 +282,7 @@ class Server(Machine):
 
     location = property(get_location, set_location, doc="geographical location")
     loc = property(get_location, set_location, doc="geographical location")
+    cap = Machine.spec # resource capacities
 
     def __repr__(self):
         try:
@@ -166,6 +295,138 @@ class Server(Machine):
             pass
         return s
 
+# Copy-on-write containers
+# ==========
+
+class _Deleted(object):
+    """Marks keys deleted in a _CopyOnWriteDict overlay."""
+    def __reduce__(self):
+        return '_DELETED' # unpickle as the same singleton
+
+_DELETED = _Deleted()
+
+class _CopyOnWriteDict(MutableMapping):
+    """A dict whose copies share a read-only base dict and only keep their own
+    overlay of the changed keys, so copying costs O(changed keys) rather than
+    O(all keys). With mutable_values, the values (e.g. sets) are shared by the
+    copies too and writable() copies them on the first write.
+
+    """
+    def __init__(self, data=None, mutable_values=False):
+        self._base = dict(data) if data is not None else {}
+        self._own = {} # overlay of changed keys (_DELETED if removed)
+        # keys whose values nobody else references (initially all of them)
+        self._mine = set(self._base) if mutable_values else set()
+        self._len = len(self._base)
+        self.mutable_values = mutable_values
+
+    def __getitem__(self, key):
+        try:
+            value = self._own[key]
+        except KeyError:
+            return self._base[key]
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            return self._own[key] is not _DELETED
+        except KeyError:
+            return key in self._base
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._len += 1
+        self._own[key] = value
+        self._mine.add(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self._base:
+            self._own[key] = _DELETED
+        else:
+            del self._own[key]
+        self._mine.discard(key)
+        self._len -= 1
+
+    def __iter__(self):
+        own = self._own
+        for key in self._base:
+            if key not in own:
+                yield key
+        for key, value in own.iteritems():
+            if value is not _DELETED:
+                yield key
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def writable(self, key):
+        """Return the value of key, first copying it if it may be shared
+        with another copy of this dict."""
+        if key in self._mine:
+            return self[key]
+        value = copy.copy(self[key])
+        self._own[key] = value
+        self._mine.add(key)
+        return value
+
+    def _compact(self):
+        """Merge the overlay into a new base."""
+        base = dict(self.iteritems())
+        self._base, self._own = base, {}
+
+    def copy(self):
+        """Return a copy sharing the base and the values with this dict."""
+        # keep the overlay small compared to the base
+        if len(self._own) > max(16, math.sqrt(len(self._base))):
+            self._compact()
+        new = _CopyOnWriteDict.__new__(_CopyOnWriteDict)
+        new._base = self._base
+        new._own = dict(self._own)
+        new._len = self._len
+        new.mutable_values = self.mutable_values
+        new._mine = set()
+        if self.mutable_values: # the values are shared now
+            self._mine = set()
+        return new
+
+    __copy__ = copy
+
+def _vector_op(op, spec, other):
+    """Return op applied to the resource vectors of the ResourceSpecs spec
+    and other. AttributeError if they cannot be combined as vectors."""
+    if (spec.resource_types is not other.resource_types
+            and spec.resource_types != other.resource_types
+            or len(spec.vector) != len(other.vector)):
+        raise AttributeError("misaligned resource vectors")
+    return op(spec.vector, other.vector)
+
+def _aligned(spec, resource_types):
+    """Resource values in spec as a float vector aligned with
+    resource_types."""
+    try:
+        return spec.aligned(resource_types)
+    except AttributeError: # plain dict (e.g. old servers.pkl)
+        return np.array([spec.get(r, 0) for r in resource_types], dtype=float)
+
+def _cow(data, mutable_values=False):
+    """Convert data into a _CopyOnWriteDict (no copy if it already is one)."""
+    if isinstance(data, _CopyOnWriteDict):
+        return data
+    return _CopyOnWriteDict(data, mutable_values)
+
 # Schedule
 # ==========
 
@@ -183,19 +444,29 @@ class State(object):
         # When adding new properties also change:
         # - the copy method
         # - the limit_to_server method
+        # The per-server dicts are copy-on-write, so that a copy of the state
+        # only duplicates the servers that are changed afterwards.
         self.servers = servers
         self.vms = vms
-        self._alloc = {} # servers -> allocated machines
+        # servers -> allocated machines
+        self._alloc = _CopyOnWriteDict({s : set() for s in servers},
+                                       mutable_values=True)
+        # reverse index: allocated VMs -> their server
+        self._vm_host = _CopyOnWriteDict()
         # servers -> remaining free capacity
-        self.free_cap = {s : copy.copy(s.cap) for s in servers}
+        self.free_cap = _CopyOnWriteDict({s : copy.copy(s.cap)
+                                          for s in servers},
+                                         mutable_values=True)
         # server capacities in a handy DataFrame for further calculations
-        self.cap_df = pd.DataFrame({s: s.cap for s in self.servers})
+        self.cap_df = pd.DataFrame({s: dict(s.cap) for s in self.servers})
         self.paused = set() # those VMs that are paused
         self.suspended = set() # those VMs that are paused
         # the CPU frequency scale of the servers (initially full)
-        self.freq_scale = {s : 1. for s in servers}
-        for s in self.servers:
-            self._alloc[s] = set()
+        self.freq_scale = _CopyOnWriteDict({s : 1. for s in servers})
+        # attributes shared with a copy of the state - copied on first write
+        self._shared = set()
+        # running aggregates for the utilisation and constraint queries
+        self._init_aggregates()
         if auto_allocate:
             self.auto_allocate()
 
@@ -216,10 +487,25 @@ class State(object):
         return self._alloc
 
     def _copy_alloc(self, other_alloc):
-        """Copy other_alloc to your own alloc."""
-        self._alloc = {}
-        for s, vms in other_alloc.iteritems():
-            self.alloc[s] = set(vms) # create a new set
+        """Copy other_alloc to your own alloc (sharing the unchanged sets)."""
+        self._alloc = _cow(other_alloc, mutable_values=True).copy()
+
+    def _writable(self, name):
+        """Return the attribute called name, first copying it if it is
+        shared with another copy of this state."""
+        shared = getattr(self, '_shared', ())
+        if name in shared:
+            setattr(self, name, copy.copy(getattr(self, name)))
+            shared.discard(name)
+        return getattr(self, name)
+
+    def _share(self, other, names):
+        """Let the other state use the attributes called names, which are
+        from now on copied before either of the states changes them."""
+        for name in names:
+            setattr(other, name, getattr(self, name))
+        self._shared = set(names)
+        other._shared = set(names)
 
     def auto_allocate(self):
         """Place all VMs on the first server."""
@@ -228,28 +514,96 @@ class State(object):
         return self
 
 
+    def _rebuild_vm_host(self):
+        """Recreate the VM -> server reverse index from alloc."""
+        self._vm_host = _CopyOnWriteDict()
+        for s in self.servers:
+            for vm in self._alloc[s]:
+                if vm not in self._vm_host:
+                    self._vm_host[vm] = s
+
     def place(self, vm, s):
         """Change current state to have vm on server s."""
         if vm not in self._alloc[s]:
-            self._alloc[s].add(vm)
-            for r in s.resource_types: # update free capacity
-                self.free_cap[s][r] -= vm.res[r]
+            self._alloc.writable(s).add(vm)
+            if vm not in self._vm_host:
+                self._count_allocated(vm, 1)
+            self._vm_host[vm] = s
+            self._stale.add(s)
+            free_cap = self.free_cap.writable(s)
+            try: # update free capacity
+                free_cap.vector = _vector_op(np.subtract, free_cap, vm.res)
+            except AttributeError: # plain dict (e.g. old servers.pkl)
+                for r in s.resource_types:
+                    free_cap[r] -= vm.res[r]
         return self
 
     def remove(self, vm, s):
         """Change current state to not have vm on server s."""
         if vm in self._alloc[s]:
-            self._alloc[s].remove(vm)
-            for r in s.resource_types: # update free capacity
-                self.free_cap[s][r] += vm.res[r]
+            self._alloc.writable(s).remove(vm)
+            if self._vm_host.get(vm) == s:
+                del self._vm_host[vm]
+                self._count_allocated(vm, -1)
+            self._stale.add(s)
+            free_cap = self.free_cap.writable(s)
+            try: # update free capacity
+                free_cap.vector = _vector_op(np.add, free_cap, vm.res)
+            except AttributeError: # plain dict (e.g. old servers.pkl)
+                for r in s.resource_types:
+                    free_cap[r] += vm.res[r]
         return self
 
     def remove_all(self, s):
         """Change current state to have no VMs on server s."""
+        for vm in self._alloc[s]:
+            if self._vm_host.get(vm) == s:
+                del self._vm_host[vm]
+                self._count_allocated(vm, -1)
         self._alloc[s] = set()
         self.free_cap[s] = copy.copy(s.cap)
+        self._stale.add(s)
         return self
 
+    def _init_aggregates(self):
+        """Calculate the running aggregates from scratch."""
+        # the utilisation and overcapacity ratio of the servers in _stale are
+        # brought up to date by _refresh on the next query
+        self._util = _CopyOnWriteDict()
+        self._overcap = _CopyOnWriteDict() # overcapacitated server -> ratio
+        self._stale = set(self.servers)
+        self._num_allocated = sum(1 for vm in set(self.vms)
+                                  if self.is_allocated(vm))
+
+    def _copy_aggregates(self, new_state):
+        try:
+            new_state._util = self._util.copy()
+        except AttributeError: # temp fix due to supporting old pickles
+            self._init_aggregates()
+            new_state._util = self._util.copy()
+        new_state._overcap = self._overcap.copy()
+        new_state._stale = set(self._stale)
+        new_state._num_allocated = self._num_allocated
+
+    def _count_allocated(self, vm, delta):
+        """Keep the count of the allocated VMs that were booted."""
+        if vm in self.vms:
+            self._num_allocated += delta
+
+    def _refresh(self):
+        """Update the aggregates of the servers changed since the last
+        query."""
+        if self._stale:
+            weights = Machine.weights
+            for s in self._stale:
+                self._util[s] = self._utilisation(s, weights)
+                ratio = self._overcap_ratio(s)
+                if ratio > 0:
+                    self._overcap[s] = ratio
+                elif s in self._overcap:
+                    del self._overcap[s]
+            self._stale = set()
+
     # action effects (consequence of applying Action to State)
     #---------------
 
@@ -257,44 +611,44 @@ class State(object):
         """change current state to have vm in s instead of the old location"""
         if vm not in self.vms:
             raise ModelUsageError("attempt to migrate VM that isn't booted")
-        for server, vms in self._alloc.iteritems():
-            if vm in vms:
-                if server == s:
-                    # it's already there
-                    return
-                else: # VM was elsewhere - removing
-                    # remove from old server
-                    self.remove(vm, server)
+        server = self.allocation(vm)
+        if server is not None:
+            if server == s:
+                # it's already there
+                return
+            else: # VM was elsewhere - removing
+                # remove from old server
+                self.remove(vm, server)
         # add it to the new one
         if s is not None: # if s is None, vm is being deleted
             self.place(vm, s)
-        # TODO: faster reverse-dictionary lookup
-        # http://stackoverflow.com/a/2569076/544059
         return self
 
     def pause(self, vm):
         """Pause vm."""
-        self.paused.add(vm) # add to paused set
+        self._writable('paused').add(vm) # add to paused set
         return self
 
     def unpause(self, vm):
         """Unpause vm."""
         try:
-            self.paused.remove(vm) # remove from paused set
+            self._writable('paused').remove(vm) # remove from paused set
         except KeyError:
             pass
         return self
 
     def boot(self, vm):
         """A VM is requested by the user, but is not yet allocated."""
-        self.vms.add(vm)
+        if vm not in self.vms:
+            self._writable('vms').add(vm)
+            self._count_allocated(vm, self.is_allocated(vm))
         return self
 
     def delete(self, vm):
         """User requested for a vm to be deleted."""
         self.migrate(vm, None) # remove vm from its host server
         try: #  remove the vm from this state's active vms
-            self.vms.remove(vm)
+            self._writable('vms').remove(vm)
         except KeyError: # the VM wasn't even there (booted outside environment)
             pass
         return self
@@ -317,38 +671,98 @@ class State(object):
     #---------------
 
     def copy(self):
-        """Return a copy of the state with a new alloc instance."""
+        """Return a copy of the state. The copy shares all the data with this
+        state and either of them copies only what it changes afterwards, so
+        this is O(servers changed since the last compaction), not O(servers).
+
+        """
         new_state = State.__new__(State) # new empty State instance
-        #new_state.__dict__.update(self.__dict__)
         # these two don't copy objects, as we assume servers don't change
         new_state.servers = self.servers
         new_state.cap_df = self.cap_df
-        new_state.vms = copy.copy(self.vms)
         new_state._copy_alloc(self._alloc)
-        new_state.free_cap = {}
-        for s in self.servers:
-            # copy the free_cap dictionary
-            try:
-                new_state.free_cap[s] = copy.copy(self.free_cap[s])
-            except AttributeError: # temp fix due to supporting old servers.pkl
-                self.free_cap = {s : copy.copy(s.cap) for s in self.servers}
-                new_state.free_cap[s] = copy.copy(self.free_cap[s])
-        #TODO: copy.copy - probably faster
-        new_state.paused = copy.copy(self.paused)
-        new_state.suspended = copy.copy(self.suspended)
-        new_state.freq_scale = copy.copy(self.freq_scale)
+        try:
+            self._vm_host = _cow(self._vm_host)
+        except AttributeError: # temp fix due to supporting old servers.pkl
+            self._rebuild_vm_host()
+        new_state._vm_host = self._vm_host.copy()
+        try:
+            self.free_cap = _cow(self.free_cap, mutable_values=True)
+        except AttributeError: # temp fix due to supporting old servers.pkl
+            self.free_cap = _cow({s : copy.copy(s.cap) for s in self.servers},
+                                 mutable_values=True)
+        new_state.free_cap = self.free_cap.copy()
+        self.freq_scale = _cow(self.freq_scale)
+        new_state.freq_scale = self.freq_scale.copy()
+        # the VM sets are copied lazily, when first changed
+        self._share(new_state, ['vms', 'paused', 'suspended'])
+        self._copy_aggregates(new_state)
         return new_state
 
     def limit_to_server(self, server):
         """Modifies itself to only provide information about a single server."""
+        alloc = _cow(self._alloc, mutable_values=True).writable(server)
         self.servers = [server]
-        self.vms = self._alloc[server]
-        self._alloc = {server : self._alloc[server]}
-        self.free_cap = {server : self.free_cap[server]}
-        self.cap_df = pd.DataFrame({server: server.cap})
+        self.vms = alloc
+        self._alloc = _CopyOnWriteDict({server : alloc}, mutable_values=True)
+        self._vm_host = _CopyOnWriteDict({vm : server for vm in alloc})
+        self.free_cap = _CopyOnWriteDict(
+            {server : copy.copy(self.free_cap[server])}, mutable_values=True)
+        self.cap_df = pd.DataFrame({server: dict(server.cap)})
         self.paused = self.paused & set([server])
         self.suspended = self.suspended & set([server])
-        self.freq_scale = {server : self.freq_scale[server]}
+        self._shared = set()
+        self.freq_scale = _CopyOnWriteDict({server : self.freq_scale[server]})
+        self._init_aggregates()
+
+    def _unboot(self, vm):
+        """Reverse boot - forget a VM that isn't allocated anywhere."""
+        self._writable('vms').remove(vm)
+        self._num_allocated -= self.is_allocated(vm)
+        return self
+
+    def _set_freq(self, server, freq_scale):
+        self.freq_scale[server] = freq_scale
+        return self
+
+    def inverse(self, action):
+        """Return a list of (method name, args) which, called in this order,
+        undo the effect of action on this state. Must be called before the
+        action is applied. None if the action has no known inverse.
+
+        """
+        name, args = action.name, action.args
+        if name == 'migrate':
+            vm, s = args
+            host = self.allocation(vm)
+            if host == s:
+                return []
+            undo = []
+            if s is not None:
+                undo.append(('remove', (vm, s)))
+            if host is not None:
+                undo.append(('place', (vm, host)))
+            return undo
+        elif name == 'boot':
+            vm = args[0]
+            return [] if vm in self.vms else [('_unboot', (vm,))]
+        elif name == 'delete':
+            vm = args[0]
+            undo = [('boot', (vm,))] if vm in self.vms else []
+            host = self.allocation(vm)
+            if host is not None:
+                undo.append(('place', (vm, host)))
+            return undo
+        elif name == 'pause':
+            vm = args[0]
+            return [] if vm in self.paused else [('unpause', (vm,))]
+        elif name == 'unpause':
+            vm = args[0]
+            return [('pause', (vm,))] if vm in self.paused else []
+        elif name in ('increase_freq', 'decrease_freq'):
+            server = args[0]
+            return [('_set_freq', (server, self.freq_scale[server]))]
+        return None
 
     # creates a new VMs list
     def transition(self, action, inplace=False):
@@ -367,7 +781,14 @@ class State(object):
     def utilisation(self, s, weights=None):
         """Utilisation ratio of a server s."""
         if weights is None:
-            weights = Machine.weights
+            self._refresh()
+            try:
+                return self._util[s]
+            except KeyError: # not one of this state's servers
+                weights = Machine.weights
+        return self._utilisation(s, weights)
+
+    def _utilisation(self, s, weights):
         total_utilisation = 0.
         for r in s.resource_types:
             used = s.cap[r] - self.free_cap[s][r]
@@ -379,7 +800,8 @@ class State(object):
 
     def calculate_utilisations(self):
         """Return dict server -> utilisation rate."""
-        return {server: self.utilisation(server) for server in self.servers}
+        self._refresh()
+        return dict(self._util.iteritems())
 
     def calculate_prices(self):
         """Return dict vm -> price."""
@@ -389,39 +811,26 @@ class State(object):
     # C1
     def is_allocated(self, vm):
         """True if @param vm is allocated to any server in this state."""
-        for s in self.servers:
-            if vm in self._alloc[s]:
-                return True
-        return False
+        return self.allocation(vm) is not None
 
     def allocation(self, vm):
         """The server to which @param vm is allocated or None."""
-        for s in self.servers:
-            if vm in self._alloc[s]:
-                return s
-        return None
+        return self._vm_host.get(vm)
 
     def unallocated_vms(self):
         """Return the set of unallocated VMs."""
-        unallocated = set(copy.copy(self.vms))
-        for s in self.servers:
-            unallocated = unallocated.difference(self._alloc[s])
-        return unallocated
+        return set(vm for vm in self.vms if not self.is_allocated(vm))
 
     def all_allocated(self):
         """True if all currently requested VMs are allocated."""
-        return len(self.unallocated_vms()) == 0
+        return self._num_allocated == len(self.vms)
 
     def ratio_allocated(self):
         """The ratio of allocated VMs compared to all the requested VMs."""
-        to_check = set(copy.copy(self.vms))
-        total = len(to_check)
+        total = len(self.vms)
         if total == 0:
             return 1.0
-        for s in self.servers:
-            to_check = to_check.difference(self._alloc[s])
-        allocated = total - len(to_check)
-        ratio = float(allocated) / total
+        ratio = float(self._num_allocated) / total
         return ratio
 
     #C2
@@ -432,25 +841,24 @@ class State(object):
         """
         if s is None:
             pass
-        for i in s.resource_types:
-            if self.free_cap[s][i] < 0:
-                return False
-        return True
+        free_cap = self.free_cap[s]
+        try:
+            return not (free_cap.vector < 0).any()
+        except AttributeError: # plain dict (e.g. old servers.pkl)
+            for i in s.resource_types:
+                if free_cap[i] < 0:
+                    return False
+            return True
 
     def overcapacitated_servers(self):
         """Return the set of servers that are not within capacity."""
-        servers = set(self.servers)
-        overcap = servers.difference(
-            set([s for s in servers if self.within_capacity(s)])
-        )
-        return overcap
+        self._refresh()
+        return set(self._overcap)
 
     def all_within_capacity(self):
         """Are all the servers within capacity?"""
-        for s in self.servers:
-            if not self.within_capacity(s):
-                return False
-        return True
+        self._refresh()
+        return len(self._overcap) == 0
 
     def capacity_penalty(self):
         """Return a penalty 0-1.0, indicating by how much the capacity
@@ -458,34 +866,32 @@ class State(object):
         are overcapacitated).
 
         """
-        # TODO: see if this method using DataFrames could be faster
-        # (free_cap instance of DataFrame?)
-        # free_cap_df = pd.DataFrame(self.free_cap)
-        # ratio_overcap = -1 * free_cap_df[free_cap_df < 0] / self.cap_df
-        # ratio_overcap[ratio_overcap.isnull()] = 0
-        # penalty = ratio_overcap.max().mean()
-        ratio_overcap = {s: 0. for s in self.servers}
-        for s in self.servers:
-            max_overcap_ratio = 0
-            for r in Machine.resource_types:
-                overcap = -1 * self.free_cap[s][r]
-                res_ratio_overcap = float(overcap) / s.cap[r]
-                if res_ratio_overcap > max_overcap_ratio:
-                    max_overcap_ratio = res_ratio_overcap
-                    ratio_overcap[s] = res_ratio_overcap
-        penalty = pd.Series(ratio_overcap).mean()
+        if len(self.servers) == 0:
+            return np.nan
+        self._refresh()
+        # only the overcapacitated servers contribute
+        penalty = math.fsum(self._overcap.itervalues()) / len(self.servers)
         if penalty > 1.:
             penalty = 1.
         return penalty
 
+    def _overcap_ratio(self, s):
+        """The highest ratio by which a resource of server s is exceeded
+        (0 if it is within capacity)."""
+        max_overcap_ratio = 0.
+        for r in Machine.resource_types:
+            overcap = -1 * self.free_cap[s][r]
+            res_ratio_overcap = float(overcap) / s.cap[r]
+            if res_ratio_overcap > max_overcap_ratio:
+                max_overcap_ratio = res_ratio_overcap
+        return max_overcap_ratio
+
     def ratio_within_capacity(self): # TODO: by resource overflows
         """Ratio of servers that are within capacity."""
-        num_ok = 0
-        for s in self.servers:
-            if self.within_capacity(s):
-                num_ok += 1
         if len(self.servers) == 0:
             return 1.0
+        self._refresh()
+        num_ok = len(self.servers) - len(self._overcap)
         ratio = float(num_ok) / len(self.servers)
         return ratio
 
@@ -497,19 +903,399 @@ class State(object):
         """If the server is non-empty and utilisation below threshold."""
         return not self.server_free(s) and self.utilisation(s) < threshold
 
+# Array-backed State
+# ==========
+
+class _VMIndex(object):
+    """Dense integer ids for VMs and a matrix of their resource demands
+    (rows aligned with the ids, columns with resource_types). Shared by all
+    the copies of an ArrayState, as VMs never change their demands.
+
+    """
+    def __init__(self, resource_types):
+        self.resource_types = resource_types
+        self.ids = {} # vm -> dense id
+        self.vms = [] # dense id -> vm
+        self.res = np.zeros((16, len(resource_types)))
+
+    def __len__(self):
+        return len(self.vms)
+
+    def id(self, vm):
+        """Return vm's dense id, registering it on the first call."""
+        try:
+            return self.ids[vm]
+        except KeyError:
+            i = len(self.vms)
+            if i == len(self.res): # grow the demands matrix
+                self.res = np.vstack([self.res, np.zeros_like(self.res)])
+            self.res[i] = _aligned(vm.res, self.resource_types)
+            self.ids[vm] = i
+            self.vms.append(vm)
+            return i
+
+class _ResourceRowView(MutableMapping):
+    """dict-like view resource -> value of row i of an ArrayState's 2-D array
+    attribute"""
+    def __init__(self, state, attr, i):
+        self._state = state
+        self._attr = attr
+        self._i = i
+        self._resource_types = state.resource_types
+        self._res_idx = {r : k for k, r in enumerate(self._resource_types)}
+
+    def __getitem__(self, r):
+        return getattr(self._state, self._attr)[self._i, self._res_idx[r]]
+
+    def __setitem__(self, r, value):
+        arr = self._state._writable(self._attr)
+        arr[self._i, self._res_idx[r]] = value
+
+    def __delitem__(self, r):
+        raise ModelUsageError("resources cannot be removed")
+
+    def __iter__(self):
+        return iter(self._resource_types)
+
+    def __len__(self):
+        return len(self._resource_types)
+
+    def __copy__(self):
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+class _ServerArrayView(MutableMapping):
+    """dict-like view server -> value (or row view for 2-D arrays)
+    of an ArrayState's array attribute
+
+    """
+    def __init__(self, state, attr):
+        self._state = state
+        self._attr = attr
+
+    def __getitem__(self, s):
+        arr = getattr(self._state, self._attr)
+        i = self._state._server_idx[s]
+        if arr.ndim == 1:
+            return float(arr[i])
+        return _ResourceRowView(self._state, self._attr, i)
+
+    def __setitem__(self, s, value):
+        arr = self._state._writable(self._attr)
+        i = self._state._server_idx[s]
+        if arr.ndim == 1:
+            arr[i] = value
+        else:
+            arr[i] = [value[r] for r in self._state.resource_types]
+
+    def __delitem__(self, s):
+        raise ModelUsageError("servers cannot be removed")
+
+    def __iter__(self):
+        return iter(self._state.servers)
+
+    def __len__(self):
+        return len(self._state.servers)
+
+    def __contains__(self, s):
+        return s in self._state._server_idx
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+class ArrayState(State):
+    """A State backend that keeps the server capacities, free capacities,
+    VM allocations and frequency scales in NumPy arrays indexed by dense
+    server/VM ids, so that the capacity, utilisation and constraint
+    calculations are vectorised. free_cap and freq_scale are dict-like views
+    on these arrays, so the public interface is the same as State's.
+
+    """
+
+    def __init__(self, servers=[], vms=set(), auto_allocate=False):
+        self.servers = servers
+        self.vms = vms
+        self.resource_types = list(Machine.resource_types)
+        self._vm_index = _VMIndex(self.resource_types)
+        self._alloc = _CopyOnWriteDict({s : set() for s in servers},
+                                       mutable_values=True)
+        self._set_servers(servers)
+        self._free = self._cap.copy()
+        self._freq = np.ones(len(servers))
+        self._host = -np.ones(16, dtype=int) # vm id -> server idx (-1: none)
+        self.paused = set()
+        self.suspended = set()
+        # arrays and sets shared with a copy of the state
+        self._shared = set()
+        self._num_allocated = 0 # allocated VMs that were booted
+        if auto_allocate:
+            self.auto_allocate()
+
+    def _set_servers(self, servers):
+        """(Re)build the server index and the capacity arrays."""
+        self._server_idx = {s : i for i, s in enumerate(servers)}
+        # servers without a resource spec (e.g. in the peak pauser) get 0s
+        self._cap = np.array([_aligned(s.cap, self.resource_types)
+                              for s in servers], dtype=float)
+        self._cap.shape = (len(servers), len(self.resource_types))
+        weights = Machine.weights
+        self._weights = np.array([weights[r] for r in self.resource_types])
+
+    @property
+    def free_cap(self):
+        """A dict-like view server -> free capacity of each resource."""
+        return _ServerArrayView(self, '_free')
+
+    @property
+    def freq_scale(self):
+        """A dict-like view server -> CPU frequency scale."""
+        return _ServerArrayView(self, '_freq')
+
+    @property
+    def cap_df(self):
+        return pd.DataFrame(self._cap.T, index=self.resource_types,
+                            columns=self.servers)
+
+    def _vm_id(self, vm):
+        """Dense id of the VM, making room for it in the host array."""
+        i = self._vm_index.id(vm)
+        if i >= len(self._host):
+            extra = -np.ones(max(i + 1, 2 * len(self._host)) - len(self._host),
+                             dtype=int)
+            self._host = np.concatenate([self._host, extra])
+            self._shared.discard('_host')
+        return i
+
+    def place(self, vm, s):
+        """Change current state to have vm on server s."""
+        if vm not in self._alloc[s]:
+            self._alloc.writable(s).add(vm)
+            i = self._vm_id(vm)
+            j = self._server_idx[s]
+            if self._host[i] < 0:
+                self._count_allocated(vm, 1)
+            self._writable('_host')[i] = j
+            self._writable('_free')[j] -= self._vm_index.res[i]
+        return self
+
+    def remove(self, vm, s):
+        """Change current state to not have vm on server s."""
+        if vm in self._alloc[s]:
+            self._alloc.writable(s).remove(vm)
+            i = self._vm_id(vm)
+            j = self._server_idx[s]
+            if self._host[i] == j:
+                self._writable('_host')[i] = -1
+                self._count_allocated(vm, -1)
+            self._writable('_free')[j] += self._vm_index.res[i]
+        return self
+
+    def remove_all(self, s):
+        """Change current state to have no VMs on server s."""
+        j = self._server_idx[s]
+        for vm in self._alloc[s]:
+            i = self._vm_id(vm)
+            if self._host[i] == j:
+                self._writable('_host')[i] = -1
+                self._count_allocated(vm, -1)
+        self._alloc[s] = set()
+        self._writable('_free')[j] = self._cap[j]
+        return self
+
+    def _change_freq(self, server, delta, limit):
+        j = self._server_idx[server]
+        current = self._freq[j]
+        if current != limit:
+            self._writable('_freq')[j] = round(current + delta,
+                                               Server.freq_scale_digits)
+
+    def increase_freq(self, server):
+        """Put the server into a higher frequency mode (if it exists)"""
+        self._change_freq(server, Server.freq_scale_delta,
+                          Server.freq_scale_max)
+
+    def decrease_freq(self, server):
+        """Put the server into a lower frequency mode (if it exists)"""
+        self._change_freq(server, -Server.freq_scale_delta,
+                          Server.freq_scale_min)
+
+    def copy(self):
+        """Return a copy of the state sharing the arrays, which either of the
+        states copies before changing them."""
+        new_state = ArrayState.__new__(ArrayState)
+        # these don't copy objects, as we assume servers don't change
+        new_state.servers = self.servers
+        new_state.resource_types = self.resource_types
+        new_state._vm_index = self._vm_index
+        new_state._server_idx = self._server_idx
+        new_state._cap = self._cap
+        new_state._weights = self._weights
+        new_state._copy_alloc(self._alloc)
+        self._share(new_state, ['vms', 'paused', 'suspended',
+                                '_free', '_freq', '_host'])
+        new_state._num_allocated = self._num_allocated
+        return new_state
+
+    def limit_to_server(self, server):
+        """Modifies itself to only provide information about a single server."""
+        j = self._server_idx[server]
+        free, freq = self._free[j:j+1].copy(), self._freq[j:j+1].copy()
+        self.servers = [server]
+        self.vms = self._alloc.writable(server)
+        self._alloc = _CopyOnWriteDict({server : self.vms},
+                                       mutable_values=True)
+        self._set_servers(self.servers)
+        self._free, self._freq = free, freq
+        self._host = np.where(self._host == j, 0, -1)
+        self.paused = self.paused & set([server])
+        self.suspended = self.suspended & set([server])
+        self._shared = set()
+        self._num_allocated = len(self.vms)
+
+    def _utilisations(self):
+        """Vector of utilisation ratios of all the servers."""
+        util = (self._cap - self._free) / self._cap
+        np.minimum(util, 1, out=util)
+        return util.dot(self._weights)
+
+    def utilisation(self, s, weights=None):
+        """Utilisation ratio of a server s."""
+        j = self._server_idx[s]
+        util = np.minimum((self._cap[j] - self._free[j]) / self._cap[j], 1)
+        if weights is None:
+            return float(util.dot(self._weights))
+        return float(sum(weights[r] * util[i]
+                         for i, r in enumerate(self.resource_types)))
+
+    def calculate_utilisations(self):
+        """Return dict server -> utilisation rate."""
+        return dict(zip(self.servers, self._utilisations().tolist()))
+
+    def allocation(self, vm):
+        """The server to which @param vm is allocated or None."""
+        try:
+            i = self._vm_index.ids[vm]
+        except KeyError: # never placed anywhere
+            return None
+        if i >= len(self._host) or self._host[i] < 0:
+            return None
+        return self.servers[self._host[i]]
+
+    def _allocated_mask(self, vms):
+        ids = np.array([self._vm_id(vm) for vm in vms], dtype=int)
+        return self._host[ids] >= 0
+
+    def unallocated_vms(self):
+        """Return the set of unallocated VMs."""
+        vms = list(set(self.vms))
+        return set(vm for vm, allocated in
+                   zip(vms, self._allocated_mask(vms)) if not allocated)
+
+    def within_capacity(self, s):
+        """Server s within capacity? Check resources occupied by the allocated
+        VMs and check if it exceeds the available resource capacity.
+
+        """
+        return bool((self._free[self._server_idx[s]] >= 0).all())
+
+    def _within_capacity_mask(self):
+        return (self._free >= 0).all(axis=1)
+
+    def overcapacitated_servers(self):
+        """Return the set of servers that are not within capacity."""
+        mask = self._within_capacity_mask()
+        return set(s for s, ok in zip(self.servers, mask) if not ok)
+
+    def all_within_capacity(self):
+        """Are all the servers within capacity?"""
+        return bool(self._within_capacity_mask().all())
+
+    def capacity_penalty(self):
+        """Return a penalty 0-1.0, indicating by how much the capacity
+        of all the servers has been exceeded (closer to 1. means more servers
+        are overcapacitated).
+
+        """
+        if len(self.servers) == 0:
+            return np.nan
+        ratio_overcap = (-self._free / self._cap).max(axis=1)
+        np.maximum(ratio_overcap, 0, out=ratio_overcap)
+        penalty = ratio_overcap.mean()
+        if penalty > 1.:
+            penalty = 1.
+        return penalty
+
+    def ratio_within_capacity(self):
+        """Ratio of servers that are within capacity."""
+        if len(self.servers) == 0:
+            return 1.0
+        return float(self._within_capacity_mask().mean())
+
 # The ranking determines which the order in which to apply the actions,
 # given the same timestamps.
 actions = ['boot', 'delete', 'increase_freq', 'decrease_freq',
            'migrate', 'pause', 'unpause']
 action_rank = dict(zip(actions, range(len(actions))))
 
-class Action(CommonEqualityMixin):
+class Action(object):
     """A static representation of an action on the cloud.
-    Has to be immutable (no dicts).
+    Immutable - the arguments are set once, so the hash and the integer
+    action type code (its rank) are computed when the action is created.
 
     """
+    __slots__ = ('args', 'code', '_hash')
     name = ''
-    args = None
+
+    def _set_args(self, *args):
+        """Initialise the (immutable) arguments of the action."""
+        code = action_rank[self.name]
+        object.__setattr__(self, 'args', args)
+        object.__setattr__(self, 'code', code)
+        object.__setattr__(self, '_hash', hash((code,) + args))
+
+    def _set(self, **attrs):
+        """Initialise named attributes of the action."""
+        for attr, value in attrs.iteritems():
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("actions are immutable")
+
+    def __delattr__(self, attr):
+        raise AttributeError("actions are immutable")
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        try:
+            return (self._hash == other._hash and self.code == other.code and
+                    type(self) is type(other) and self.args == other.args)
+        except AttributeError:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return self._hash
+
+    def _constructor_args(self):
+        return self.args
+
+    def __reduce__(self):
+        return (type(self), self._constructor_args())
+
+    def __setstate__(self, state):
+        """Restore an action pickled before actions had slots."""
+        if isinstance(state, tuple): # (dict, slots) - protocol 2
+            state = dict(state[0] or {}, **(state[1] or {}))
+        if 'what' in state:
+            self.__init__(state['vm'], state['what'])
+        else:
+            self.__init__(*state['args'])
+
     def __repr__(self):
         return '{0}: {1}'.format(self.name, str(self.args))
     def __str__(self):
@@ -517,42 +1303,48 @@ class Action(CommonEqualityMixin):
 
     def rank(self):
         """The action's rank - used for sorting."""
-        return action_rank[self.name]
+        return self.code
 
 class Migration(Action):
     """Migrate vm to server."""
+    __slots__ = ('vm', 'server')
     def __init__(self, vm, server):
-        self.vm = vm
-        self.server = server
-        self.args = (vm, server)
+        self._set(vm=vm, server=server)
+        self._set_args(vm, server)
     name = 'migrate'
     def __repr__(self):
         return '{} -> {}'.format(str(self.vm), str(self.server))
 
 class Pause(Action):
     """Pause vm."""
+    __slots__ = ('vm',)
     def __init__(self, vm):
-        self.args = (vm,)
+        self._set(vm=vm)
+        self._set_args(vm)
     name = 'pause'
 
 class Unpause(Action):
     """Unpause vm."""
+    __slots__ = ('vm',)
     def __init__(self, vm):
-        self.args = (vm,)
+        self._set(vm=vm)
+        self._set_args(vm)
     name = 'unpause'
 
 class IncreaseFreq(Action):
     """Increase a server's CPU frequency if possible."""
+    __slots__ = ('server',)
     def __init__(self, server):
-        self.args = (server,)
-        self.server = server
+        self._set(server=server)
+        self._set_args(server)
     name = 'increase_freq'
 
 class DecreaseFreq(Action):
     """Decrease a server's CPU frequency if possible."""
+    __slots__ = ('server',)
     def __init__(self, server):
-        self.args = (server,)
-        self.server = server
+        self._set(server=server)
+        self._set_args(server)
     name = 'decrease_freq'
 
 class VMRequest(Action):
@@ -561,11 +1353,12 @@ class VMRequest(Action):
     action also unallocates the VM and frees the server's resources.
 
     """
+    __slots__ = ('vm', 'what', 'name')
     def __init__(self, vm, what):
-        self.vm = vm
-        self.args = (vm,)
-        self.what = what
-        self.name = self.what
+        self._set(vm=vm, what=what, name=what)
+        self._set_args(vm)
+    def _constructor_args(self):
+        return self.vm, self.what
     def __str__(self):
         return "{0} {1}".format(self.what, self.vm)
     def __repr__(self):
@@ -637,6 +1430,22 @@ class Schedule(object):
         self.sort()
         return True
 
+    def extend(self, actions, t):
+        """Add a list of actions at time t, like calling add for each of them,
+        but sorting only once when there is no environment (no duplicate
+        or superseded actions to look for)."""
+        if hasattr(self, 'environment'):
+            for action in actions:
+                self.add(action, t)
+            return
+        if len(actions) == 0:
+            return
+        values = np.empty(len(actions), dtype=object)
+        values[:] = actions
+        new_actions = pd.Series(values, [t] * len(actions))
+        self.actions = pd.concat([self.actions, new_actions])
+        self.sort()
+
     def filter_current_actions(self, t, period=None):
         """return time series of actions in interval
         (closed on the left, open on the right)
@@ -654,6 +1463,226 @@ class Schedule(object):
     def __str__(self):
         return self.actions.__str__()
 
+def _index_key(action):
+    """Actions which can duplicate or supersede each other share this key."""
+    return action.name, action.args[0]
+
+class ArraySchedule(Schedule):
+    """A Schedule that keeps the actions in sorted parallel lists of
+    (time, rank) keys and actions, so that adding an action is a bisect
+    insertion rather than a re-sort of the whole time series. Datetime times
+    are stored as int64 nanoseconds. The actions attribute is a pandas view
+    (built on demand and cached), and assigning to it replaces the content,
+    which is kept sorted.
+
+    A hash index (action name, VM/server) -> sorted times and actions makes
+    finding duplicate and superseded actions in add() independent of the
+    schedule's size.
+
+    """
+    def __init__(self):
+        self._keys = [] # (time, rank) - sorted
+        self._actions = [] # aligned with _keys
+        self._by_key = {} # (name, vm/server) -> ([times], [actions]) - sorted
+        self._datetime = False # are the times datetimes (stored as ns)
+        self._tz = None
+        self._view = None # cached pandas view
+
+    def __copy__(self):
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new._keys = list(self._keys)
+        new._actions = list(self._actions)
+        new._by_key = {key : (list(times), list(actions))
+                       for key, (times, actions) in self._by_key.iteritems()}
+        return new
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_view'] = None
+        return state
+
+    def __len__(self):
+        return len(self._actions)
+
+    def _time_key(self, t):
+        """The int64 nanoseconds for datetimes, other times as they are."""
+        if isinstance(t, (datetime, np.datetime64)):
+            t = pd.Timestamp(t)
+            if not self._actions:
+                self._datetime, self._tz = True, t.tz
+            return t.value
+        return t
+
+    def _time_index(self, keys):
+        times = [key[0] for key in keys]
+        if not self._datetime:
+            return pd.Index(times)
+        index = pd.DatetimeIndex(np.array(times, dtype='datetime64[ns]'))
+        if self._tz is not None:
+            index = index.tz_localize('UTC').tz_convert(self._tz)
+        return index
+
+    def _series(self, i=0, j=None):
+        """pandas view of the actions with positions i:j"""
+        keys, actions = self._keys[i:j], self._actions[i:j]
+        if len(actions) == 0:
+            return pd.Series(name='actions')
+        values = np.empty(len(actions), dtype=object)
+        values[:] = actions
+        return pd.Series(values, self._time_index(keys), name='actions')
+
+    def _get_actions(self):
+        if self._view is None:
+            self._view = self._series()
+        return self._view
+
+    def _set_actions(self, actions):
+        self._keys, self._actions = [], []
+        self._view = None
+        entries = [(self._time_key(t), action.rank(), action)
+                   for t, action in actions.iteritems()]
+        entries.sort(key=lambda entry: entry[:2]) # stable sort
+        self._keys = [entry[:2] for entry in entries]
+        self._actions = [entry[2] for entry in entries]
+        self._by_key = {}
+        for (t, rank), action in zip(self._keys, self._actions):
+            times, actions = self._by_key.setdefault(_index_key(action),
+                                                    ([], []))
+            times.append(t)
+            actions.append(action)
+
+    actions = property(_get_actions, _set_actions,
+                       doc="pandas view of the sorted actions")
+
+    def sort(self):
+        pass # always sorted
+
+    def _range(self, start, end=None):
+        """Positions i:j of the actions with start <= time <= end."""
+        t_start = self._time_key(start)
+        i = bisect.bisect_left(self._keys, (t_start,))
+        if end is None:
+            return i, len(self._keys)
+        t_end = self._time_key(end)
+        j = bisect.bisect_right(self._keys, (t_end, len(action_rank)))
+        return i, j
+
+    def _remove_all(self, action):
+        """Remove every occurrence of action."""
+        times, actions = self._by_key[_index_key(action)]
+        rank = action.rank()
+        for k in reversed(range(len(actions))):
+            if actions[k] != action:
+                continue
+            # find this occurrence among the actions with the same key
+            key = (times[k], rank)
+            i = bisect.bisect_left(self._keys, key)
+            while self._actions[i] is not actions[k]:
+                i += 1
+            del self._keys[i]
+            del self._actions[i]
+            del times[k]
+            del actions[k]
+        self._view = None
+
+    def add(self, action, t):
+        """Add an action to the schedule. Make sure it's still sorted.
+        Return True/False to indicate success."""
+        index_key = _index_key(action)
+        t_key = self._time_key(t)
+        try:
+            period = self.environment.period
+        except AttributeError: # if no environment available
+            pass
+        else:
+            # the actions with the same name and VM/server within the period
+            times, actions = self._by_key.get(index_key, ([], []))
+            i = bisect.bisect_left(times, t_key)
+            j = bisect.bisect_right(
+                times, self._time_key(t + period - pd.offsets.Micro(1)))
+            for existing in actions[i:j]:
+                if existing == action:
+                    # the same action already exists at time t
+                    return False
+                # the new action supersedes the old one
+                self._remove_all(existing)
+        key = (t_key, action.rank())
+        i = bisect.bisect_right(self._keys, key)
+        self._keys.insert(i, key)
+        self._actions.insert(i, action)
+        times, actions = self._by_key.setdefault(index_key, ([], []))
+        k = bisect.bisect_right(times, t_key)
+        times.insert(k, t_key)
+        actions.insert(k, action)
+        self._view = None
+        return True
+
+    def filter_current_actions(self, t, period=None):
+        """return time series of actions in interval
+        (closed on the left, open on the right)
+
+        """
+        if period is None:
+            return self._series(*self._range(t))
+        justabit = pd.offsets.Micro(1)
+        return self._series(*self._range(t, t + period - justabit))
+
+# State history
+# ==========
+
+class StateHistory(object):
+    """Timestamped history of the real states of a cloud: the actions applied
+    and a snapshot of the state after every snapshot_interval actions.
+    The state at any time t is the closest snapshot before t with the few
+    remaining actions reapplied - O(log n + snapshot_interval).
+
+    """
+    snapshot_interval = 100 # can be overridden
+
+    def __init__(self, initial):
+        self._times = [] # times of the recorded actions (non-decreasing)
+        self._actions = []
+        # _snapshots[k]: state after the first k * snapshot_interval actions
+        self._snapshots = [initial.copy()]
+
+    def __len__(self):
+        return len(self._actions)
+
+    @property
+    def end(self):
+        """Time of the last recorded action (None if there are none)."""
+        return self._times[-1] if self._times else None
+
+    def record(self, action, t, state=None):
+        """Note that action was applied at time t, resulting in state
+        (which is then used as a snapshot if one is due)."""
+        if self._times and t < self._times[-1]:
+            raise ModelUsageError("actions must be recorded in time order")
+        self._times.append(t)
+        self._actions.append(action)
+        if len(self._actions) % self.snapshot_interval == 0:
+            if state is None:
+                state = self._replay(len(self._actions))
+            self._snapshots.append(state.copy())
+
+    def _replay(self, n):
+        """The state after the first n recorded actions."""
+        k = min(n // self.snapshot_interval, len(self._snapshots) - 1)
+        state = self._snapshots[k].copy()
+        for action in self._actions[k * self.snapshot_interval:n]:
+            state.transition(action, inplace=True)
+        return state
+
+    def state_at(self, t, inclusive=True):
+        """Return (a copy of) the state at time t - after the actions at t
+        if inclusive, otherwise just before them."""
+        if inclusive:
+            n = bisect.bisect_right(self._times, t)
+        else:
+            n = bisect.bisect_left(self._times, t)
+        return self._replay(n)
+
 # Cloud
 # ==========
 
@@ -677,13 +1706,30 @@ class Cloud():
     Workflow:
     - action on Cloud -> create Action instance -> add to Schedule
 
+    Speculative changes can be undone with checkpoint() and rollback(token),
+    which revert everything done through the Cloud's methods since the
+    checkpoint by walking back an undo log (cost proportional to the number
+    of changes, not to the size of the cloud). Checkpoints can be nested.
+
     """
-    def __init__(self, servers=[], initial_vms=set(), auto_allocate=False):
+    # the State implementation used for the cloud's states (can be overridden)
+    state_class = State
+
+    def __init__(self, servers=[], initial_vms=set(), auto_allocate=False,
+                 state_class=None):
+        """@param state_class: State implementation to use instead of the
+        Cloud.state_class default (e.g. ArrayState)"""
+        if state_class is not None:
+            self.state_class = state_class
         self._servers = servers
-        self._initial = State(servers, set(initial_vms), auto_allocate)
+        self._checkpoints = [] # undo log positions of the open checkpoints
+        self._undo_log = [] # changes since the outermost open checkpoint
+        self._initial = self.state_class(servers, set(initial_vms),
+                                         auto_allocate)
         for machine in servers + list(initial_vms): # know thy parent
             machine.cloud = self
         self._real = self._initial.copy()
+        self.history = StateHistory(self._initial) # of the real states
         self.reset_to_real()
 
     def __repr__(self):
@@ -699,15 +1745,115 @@ class Cloud():
         visualiser.show_usage(self, self.get_current())
     #----------------------------------
 
+    # checkpoints ---
+    def _recording(self):
+        return len(getattr(self, '_checkpoints', ())) > 0
+
+    def _replace(self, attr, value):
+        """Set attribute attr, noting the old value in the undo log."""
+        if self._recording():
+            self._undo_log.append(('set', attr, getattr(self, attr)))
+        setattr(self, attr, value)
+
+    def _transition(self, attr, action, inplace):
+        """Apply action on the state in attribute attr and log its undo."""
+        state = getattr(self, attr)
+        if not inplace or not self._recording():
+            self._replace(attr, state.transition(action, inplace=inplace))
+            return getattr(self, attr)
+        undo = state.inverse(action)
+        if undo is None: # unknown effect - remember a copy of the state
+            self._undo_log.append(('set', attr, state.copy()))
+        state.transition(action, inplace=True)
+        if undo:
+            self._undo_log.append(('undo', attr, undo))
+        return state
+
+    def checkpoint(self):
+        """Start recording changes and return a token for rollback/commit."""
+        if not hasattr(self, '_checkpoints'): # cloud from an old pickle
+            self._checkpoints, self._undo_log = [], []
+        self._checkpoints.append(len(self._undo_log))
+        return len(self._checkpoints) - 1
+
+    def _release(self, token):
+        """Close checkpoint token and the ones opened after it. Return
+        the undo log position it was taken at."""
+        if not 0 <= token < len(getattr(self, '_checkpoints', ())):
+            raise ModelUsageError("unknown or already released checkpoint")
+        position = self._checkpoints[token]
+        del self._checkpoints[token:]
+        return position
+
+    def rollback(self, token):
+        """Undo all the changes since checkpoint(), which returned token.
+        Checkpoints taken after it are released as well."""
+        position = self._release(token)
+        log = self._undo_log
+        while len(log) > position:
+            kind, attr, data = log.pop()
+            if kind == 'set':
+                setattr(self, attr, data)
+            else:
+                state = getattr(self, attr)
+                for method, args in data:
+                    getattr(state, method)(*args)
+
+    def commit(self, token):
+        """Keep the changes since checkpoint token (they can still be undone
+        by rolling back an outer checkpoint)."""
+        self._release(token)
+        if not self._checkpoints:
+            del self._undo_log[:]
+    #----------------------------------
+
     #TODO: this seems wrong - current should always be a copy?
     def reset_to_real(self):
         """Set the current state to a copy of what the real state of the
         cloud is."""
-        self._current = self._real.copy()
+        self._replace('_current', self._real.copy())
 
     def reset_to_initial(self):
         """Set the current state to a copy of the initial state."""
-        self._current = self._initial.copy()
+        self._replace('_current', self._initial.copy())
+
+    def state_at(self, t, inclusive=True):
+        """The real state at time t as recorded in the history (after the
+        actions at t if inclusive, otherwise just before them)."""
+        return self.history.state_at(t, inclusive)
+
+    def reset_to_time(self, t, inclusive=True):
+        """Set the current state to a copy of the real state at time t."""
+        self._replace('_current', self.state_at(t, inclusive))
+
+    def make_current_real(self):
+        """Treat the current virtual state as the real one (e.g. to evaluate
+        what follows the scheduled actions) - best used inside a checkpoint.
+        """
+        self._replace('_real', self._current)
+        self.reset_to_real()
+
+    def copy_real(self):
+        """A new cloud with the same servers that starts in (and is in) this
+        cloud's real state, without its history or checkpoints (e.g. to send
+        to other processes). The machines still belong to this cloud."""
+        cloud = copy.copy(self)
+        cloud._checkpoints, cloud._undo_log = [], []
+        cloud._initial = self._real.copy()
+        cloud._real = self._real.copy()
+        cloud.history = StateHistory(cloud._initial)
+        cloud.reset_to_real()
+        return cloud
+
+    def limit_to_server(self, server):
+        """Consider only this server and its VMs as the cloud (for faster
+        evaluations of a single server) - best used inside a checkpoint.
+        """
+        real = self._real.copy()
+        real.limit_to_server(server)
+        self._replace('_servers', [server])
+        self._replace('_real', real)
+        self.reset_to_real()
 
     def get_vms(self):
         """return the VMs in the current state"""
@@ -720,6 +1866,10 @@ class Cloud():
         """Get the current state."""
         return self._current
 
+    def get_real(self):
+        """Get the real state (not to be modified - see apply_real)."""
+        return self._real
+
     vms = property(get_vms, doc="get the VMs in the current state")
     servers = property(get_servers, doc="get the servers (always the same)")
 
@@ -729,15 +1879,29 @@ class Cloud():
         unless inplace is True.
 
         """
-        self._current = self._current.transition(action, inplace=inplace)
+        return self._transition('_current', action, inplace)
+
+    def apply_all(self, actions, inplace=False):
+        """Apply a list of Actions on the current state in order, like apply,
+        but copying the current state only once (not at all if inplace is
+        True)."""
+        if not inplace:
+            self._replace('_current', self._current.copy())
+        for action in actions:
+            self._transition('_current', action, inplace=True)
         return self._current
 
-    def apply_real(self, action, inplace=False):
+    def apply_real(self, action, inplace=False, t=None):
         """Apply an Action on the real state (reflecting the actual physical
         state) and reset the virtual state.
 
+        @param t: if given, the action is recorded in the history at time t
+        (not undone by rollback)
+
         """
-        self._real = self._real.transition(action, inplace=inplace)
+        self._transition('_real', action, inplace)
+        if t is not None:
+            self.history.record(action, t, self._real)
         self.reset_to_real()
         return self._real
 
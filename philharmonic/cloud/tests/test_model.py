@@ -10,6 +10,7 @@ from nose.tools import *
 import pandas as pd
 
 from philharmonic import *
+from philharmonic.cloud import model
 from philharmonic.simulator.environment import Environment
 
 def test_machine_id():
@@ -36,6 +37,46 @@ def test_machine_repr_not_exploding():
         repr(m)
         str(m)
 
+def test_machine_resource_vector():
+    s = Server(4000, 2, location='A')
+    vm = VM(2000, 0.5)
+    assert_false(hasattr(s, '__dict__'))
+    assert_equals(s.cap, {'RAM': 4000, '#CPUs': 2})
+    assert_equals(list(s.cap.vector), [4000, 2])
+    assert_true(vm.res is vm.spec)
+    assert_equals(vm.res['#CPUs'], 0.5)
+    free_cap = s.cap.copy()
+    free_cap['RAM'] -= vm.res['RAM']
+    assert_equals(free_cap['RAM'], 2000)
+    assert_equals(s.cap['RAM'], 4000)
+    free_cap['#CPUs'] -= vm.res['#CPUs'] # int vector upcast to float
+    assert_equals(free_cap['#CPUs'], 1.5)
+    with assert_raises(KeyError):
+        Server(4000).cap['#CPUs']
+    assert_equals(list(Server(4000).cap.aligned(['RAM', '#CPUs'])), [4000, 0])
+    vm.res = {'RAM': 1000, '#CPUs': 1}
+    assert_equals(list(vm.res.vector), [1000, 1])
+
+def test_machine_pickle():
+    import pickle
+    s = Server(4000, 2, location='A')
+    vm = VM(2000, 1)
+    vm.beta = 0.5
+    for protocol in range(3):
+        s2 = pickle.loads(pickle.dumps(s, protocol))
+        assert_equals(s2, s)
+        assert_equals(s2.cap, s.cap)
+        assert_equals(s2.loc, 'A')
+        vm2 = pickle.loads(pickle.dumps(vm, protocol))
+        assert_equals(vm2.res, vm.res)
+        assert_equals(vm2.beta, 0.5)
+    # servers pickled when they still had a __dict__
+    old = Server.__new__(Server)
+    old.__setstate__({'id': s.id, 'spec': {'RAM': 4000, '#CPUs': 2},
+                      'cap': {'RAM': 4000, '#CPUs': 2}, '_loc': 'A'})
+    assert_equals(old, s)
+    assert_equals(list(old.cap.vector), [4000, 2])
+
 def test_constraints():
     Machine.resource_types = ['RAM', '#CPUs']
     # some servers
@@ -694,6 +735,28 @@ def test_schedule_add_existing():
     # TODO: add existing
     assert_true((schedule.actions == pd.Series({t1: a1, t2: a2})).all())
 
+def test_schedule_extend():
+    vm1, vm2 = VM(2000, 1), VM(2000, 1)
+    s1, s2 = Server(5000, 2), Server(5000, 2)
+    t1 = pd.Timestamp('2002-01-01 03:00')
+    t2 = t1 + pd.offsets.Hour(1)
+    actions = [Migration(vm1, s1), Pause(vm2), Migration(vm2, s2)]
+    for environment in [False, True]:
+        schedule, expected = Schedule(), Schedule()
+        if environment:
+            for s in [schedule, expected]:
+                s.environment = Environment()
+                s.environment.period = pd.offsets.Hour(1)
+        for s in [schedule, expected]:
+            s.add(Migration(vm1, s2), t2)
+            s.add(Migration(vm1, s1), t1)
+        schedule.extend(actions, t1)
+        for action in actions:
+            expected.add(action, t1)
+        assert_true(schedule.actions.equals(expected.actions))
+    schedule.extend([], t2)
+    assert_true(schedule.actions.equals(expected.actions))
+
 def test_schedule_filter():
     s = Schedule()
     vm1 = VM(2000, 1);
@@ -720,6 +783,107 @@ def test_cloud():
     #TODO: test that auto_allocate doesn't break constraints
     assert_equals(cloud.vms, VMs)
 
+def test_cloud_apply_all():
+    s1, s2 = Server(4000, 2), Server(8000, 4)
+    vm1, vm2 = VM(2000, 1), VM(2000, 2)
+    actions = [Migration(vm1, s1), Migration(vm2, s2), Migration(vm1, s2)]
+    cloud, expected = Cloud([s1, s2], [vm1, vm2]), Cloud([s1, s2], [vm1, vm2])
+    real = cloud.get_current()
+    cloud.apply_all(actions)
+    for action in actions:
+        expected.apply(action)
+    assert_equals(cloud.get_current().alloc, expected.get_current().alloc)
+    assert_true(real.server_free(s1) and real.server_free(s2),
+                'the original current state is left untouched')
+    token = cloud.checkpoint()
+    cloud.apply_all([Migration(vm2, s1)], inplace=True)
+    assert_equals(cloud.get_current().allocation(vm2), s1)
+    cloud.rollback(token)
+    assert_equals(cloud.get_current().allocation(vm2), s2)
+
+def test_cloud_checkpoint_rollback():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    vm2 = VM(2000, 2)
+    cloud = Cloud([s1, s2], [vm1])
+    cloud.apply_real(Migration(vm1, s1))
+    before = cloud.get_current()
+    token = cloud.checkpoint()
+    cloud.apply(VMRequest(vm2, 'boot'))
+    cloud.apply(Migration(vm2, s1))
+    inner = cloud.checkpoint()
+    cloud.apply(Migration(vm1, s2), inplace=True)
+    cloud.apply(DecreaseFreq(s2), inplace=True)
+    cloud.apply(Pause(vm2), inplace=True)
+    cloud.apply(VMRequest(vm2, 'delete'), inplace=True)
+    current = cloud.get_current()
+    assert_equals(current.allocation(vm1), s2)
+    assert_equals(current.vms, set([vm1]))
+    cloud.rollback(inner)
+    assert_true(cloud.get_current() is current, 'undone in place')
+    assert_equals(current.allocation(vm1), s1)
+    assert_equals(current.allocation(vm2), s1)
+    assert_equals(current.vms, set([vm1, vm2]))
+    assert_equals(current.paused, set())
+    assert_equals(current.freq_scale[s2], 1.)
+    assert_equals(current.free_cap[s1]['RAM'], 0)
+    assert_equals(current.free_cap[s2]['RAM'], 8000)
+    cloud.limit_to_server(s1)
+    cloud.make_current_real()
+    assert_equals(cloud.servers, [s1])
+    cloud.rollback(token)
+    assert_true(cloud.get_current() is before)
+    assert_equals(cloud.servers, [s1, s2])
+    assert_equals(cloud.vms, set([vm1]))
+    assert_equals(cloud._real.allocation(vm2), None)
+    assert_raises(ModelUsageError, cloud.rollback, inner)
+
+def test_cloud_checkpoint_commit():
+    s1 = Server(4000, 2)
+    vm1 = VM(2000, 1)
+    cloud = Cloud([s1], [vm1])
+    outer = cloud.checkpoint()
+    inner = cloud.checkpoint()
+    cloud.apply(Migration(vm1, s1), inplace=True)
+    cloud.commit(inner)
+    assert_equals(cloud.get_current().allocation(vm1), s1)
+    cloud.rollback(outer) # the committed changes are still undone
+    assert_true(cloud.get_current().allocation(vm1) is None)
+    cloud.apply(Migration(vm1, s1), inplace=True)
+    assert_equals(cloud._undo_log, [], 'nothing recorded without checkpoints')
+
+def test_state_history():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    vm2 = VM(2000, 2)
+    cloud = Cloud([s1, s2], [vm1, vm2])
+    cloud.history.snapshot_interval = 3
+    hosts = [s1, s2]
+    times = pd.date_range('2010-02-26 8:00', periods=10, freq='H')
+    for i, t in enumerate(times):
+        cloud.apply_real(Migration(vm1, hosts[i % 2]), t=t)
+        cloud.apply_real(Migration(vm2, hosts[(i + 1) % 2]), t=t)
+    assert_equals(len(cloud.history), 20)
+    assert_equals(len(cloud.history._snapshots), 1 + 20 // 3)
+    assert_equals(cloud.history.end, times[-1])
+    for i, t in enumerate(times):
+        state = cloud.state_at(t)
+        assert_equals(state.allocation(vm1), hosts[i % 2])
+        assert_equals(state.allocation(vm2), hosts[(i + 1) % 2])
+        assert_equals(state.free_cap[hosts[i % 2]]['RAM'],
+                      hosts[i % 2].cap['RAM'] - 2000)
+    before = cloud.state_at(times[0], inclusive=False)
+    assert_equals(before.unallocated_vms(), set([vm1, vm2]))
+    cloud.reset_to_time(times[4] + pd.Timedelta('30min'))
+    assert_equals(cloud.get_current().allocation(vm1), s1)
+    # the snapshots are not affected by changing the returned states
+    cloud.get_current().migrate(vm1, s2)
+    assert_equals(cloud.state_at(times[4]).allocation(vm1), s1)
+    assert_raises(ModelUsageError, cloud.history.record,
+                  Migration(vm1, s1), times[0])
+
 def test_schedule_sorted():
     schedule = Schedule()
     s1 = Server(4000, 2)
@@ -755,6 +919,40 @@ def test_hash_action():
     assert_equals(hash(a1), hash(a2))
     assert_not_equals(hash(a1), hash(a3))
 
+def test_action_immutable():
+    s1 = Server(4000, 2)
+    vm1 = VM(2000, 1)
+    a1 = Migration(vm1, s1)
+    assert_raises(AttributeError, setattr, a1, 'server', None)
+    assert_raises(AttributeError, setattr, a1, 'marked', True)
+    assert_false(hasattr(a1, '__dict__'))
+    assert_equals(a1.rank(), a1.code)
+    assert_not_equals(Pause(vm1), Unpause(vm1))
+    assert_not_equals(VMRequest(vm1, 'boot'), VMRequest(vm1, 'delete'))
+    assert_equals(len(set([IncreaseFreq(s1), IncreaseFreq(s1),
+                           DecreaseFreq(s1)])), 2)
+
+def test_action_pickle():
+    import pickle
+    s1 = Server(4000, 2)
+    vm1 = VM(2000, 1)
+    for action in [Migration(vm1, s1), Pause(vm1), Unpause(vm1),
+                   IncreaseFreq(s1), DecreaseFreq(s1),
+                   VMRequest(vm1, 'boot'), VMRequest(vm1, 'delete')]:
+        for protocol in [0, 2]:
+            loaded = pickle.loads(pickle.dumps(action, protocol))
+            assert_equals(loaded, action)
+            assert_equals(hash(loaded), hash(action))
+            assert_equals(loaded.name, action.name)
+    # actions pickled when they still had a __dict__
+    old = Migration.__new__(Migration)
+    old.__setstate__({'vm': vm1, 'server': s1, 'args': (vm1, s1)})
+    assert_equals(old, Migration(vm1, s1))
+    old = VMRequest.__new__(VMRequest)
+    old.__setstate__({'vm': vm1, 'args': (vm1,), 'what': 'boot',
+                      'name': 'boot'})
+    assert_equals(old, VMRequest(vm1, 'boot'))
+
 def test_schedule_clean():
     schedule = Schedule()
     s1 = Server(4000, 2)
@@ -782,6 +980,81 @@ def test_schedule_clean():
     assert_sequence_equal(list(schedule.actions.values),
                           [a01, a02, a1, b2, c1, c2])
 
+def test_array_schedule_same_as_schedule():
+    s1 = Server(4000, 2)
+    vm1 = VM(2000, 1)
+    vm2 = VM(2000, 1)
+    start = pd.Timestamp('2013-01-01 00:00')
+    actions = [VMRequest(vm1, 'boot'), Migration(vm1, s1), Pause(vm1),
+               Unpause(vm1), VMRequest(vm2, 'boot'), Migration(vm2, s1),
+               IncreaseFreq(s1), VMRequest(vm1, 'delete')]
+    schedule, array_schedule = Schedule(), ArraySchedule()
+    for i in range(40): # out-of-order times, several actions per time
+        action = actions[(7 * i) % len(actions)]
+        t = start + pd.offsets.Hour((5 * i) % 11)
+        schedule.add(action, t)
+        array_schedule.add(action, t)
+    assert_sequence_equal(list(array_schedule.actions.index),
+                          list(schedule.actions.index))
+    # the ranks are equal, but the order of the same actions doesn't matter
+    assert_sequence_equal([a.rank() for a in array_schedule.actions.values],
+                          [a.rank() for a in schedule.actions.values])
+    t = start + pd.offsets.Hour(3)
+    filtered = array_schedule.filter_current_actions(t, pd.offsets.Hour(2))
+    expected = schedule.filter_current_actions(t, pd.offsets.Hour(2))
+    assert_sequence_equal(list(filtered.index), list(expected.index))
+    assert_equals(len(array_schedule.filter_current_actions(t)),
+                  len(schedule.filter_current_actions(t)))
+
+def test_array_schedule():
+    vm1 = VM(2000, 1)
+    s1 = Server(5000, 2)
+    s2 = Server(5000, 2)
+    t1 = pd.Timestamp('2002-01-01 03:00')
+    t2 = t1 + pd.offsets.Hour(1)
+    a1, a2, a3 = Migration(vm1, s1), Migration(vm1, s2), Migration(vm1, s2)
+    schedule = ArraySchedule()
+    schedule.environment = Environment()
+    schedule.environment.period = pd.offsets.Hour(1)
+    schedule.add(a2, t2)
+    schedule.add(a1, t1)
+    assert_false(schedule.add(a3, t2), 'existing action not added')
+    assert_true((schedule.actions == pd.Series({t1: a1, t2: a2})).all())
+    copied = schedule.copy()
+    copied.add(Pause(vm1), t2)
+    assert_equals(len(schedule.actions), 2)
+    assert_equals(len(copied.actions), 3)
+    # assigning a time series keeps the schedule sorted
+    schedule.actions = pd.Series([a2, VMRequest(vm1, 'boot')], [t2, t1])
+    assert_sequence_equal(list(schedule.actions.index), [t1, t2])
+    assert_is_instance(schedule.actions.index, pd.DatetimeIndex)
+
+def test_array_schedule_supersede():
+    vm1, vm2 = VM(2000, 1), VM(2000, 1)
+    s1, s2 = Server(5000, 2), Server(5000, 2)
+    t1 = pd.Timestamp('2002-01-01 03:00')
+    t2 = t1 + pd.offsets.Minute(30)
+    t3 = t1 + pd.offsets.Hour(3)
+    schedule = ArraySchedule()
+    schedule.environment = Environment()
+    schedule.environment.period = pd.offsets.Hour(1)
+    old = Migration(vm1, s1)
+    schedule.add(old, t3)
+    schedule.add(Migration(vm2, s1), t2)
+    schedule.add(Migration(vm1, s1), t2)
+    schedule.add(Pause(vm1), t2)
+    # vm1 migrating elsewhere within the period supersedes the old migration
+    # (every occurrence of it), other actions are kept
+    assert_true(schedule.add(Migration(vm1, s2), t1))
+    assert_sequence_equal(list(schedule.actions.values),
+                          [Migration(vm1, s2), Migration(vm2, s1),
+                           Pause(vm1)])
+    assert_sequence_equal(list(schedule.actions.index), [t1, t2, t2])
+    assert_false(schedule.add(Migration(vm1, s2), t1 - pd.offsets.Minute(5)))
+    assert_true(schedule.add(IncreaseFreq(s1), t1))
+    assert_false(schedule.add(IncreaseFreq(s1), t1 - pd.offsets.Minute(10)))
+    assert_equals(len(schedule.actions), 4)
+
 def test_vm_requests():
     # some servers
     s1 = Server(4000, 2)
@@ -803,3 +1076,188 @@ def test_vm_requests():
     cloud.apply(VMRequest(vm2, 'boot'))
     assert_not_in(vm1, cloud.vms, 'vm1 should be booted')
     assert_in(vm2, cloud.vms, 'vm1 should not be booted')
+
+def test_state_reverse_index():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    vm2 = VM(2000, 2)
+    a = State([s1, s2], set([vm1, vm2]))
+    a.place(vm1, s1)
+    a.migrate(vm2, s2)
+    assert_equals(a.allocation(vm1), s1)
+    assert_equals(a.allocation(vm2), s2)
+    a.migrate(vm1, s2)
+    assert_equals(a.allocation(vm1), s2)
+    assert_equals(a.unallocated_vms(), set())
+    b = a.copy()
+    a.remove_all(s2)
+    assert_true(a.allocation(vm1) is None)
+    assert_equals(a.unallocated_vms(), set([vm1, vm2]))
+    assert_equals(b.allocation(vm2), s2, 'the copy keeps its own index')
+    b.migrate(vm2, None)
+    assert_false(b.is_allocated(vm2))
+    assert_almost_equals(b.ratio_allocated(), 0.5)
+    b.limit_to_server(s2)
+    assert_equals(b.allocation(vm1), s2)
+
+def test_state_copy_on_write():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1)
+    vm2 = VM(2000, 2)
+    a = State([s1, s2], set([vm1]))
+    a.place(vm1, s1)
+    b = a.transition(VMRequest(vm2, 'boot'))
+    b.place(vm2, s1)
+    b.decrease_freq(s2)
+    assert_true(a.alloc[s2] is b.alloc[s2], 'unchanged servers are shared')
+    assert_equals(a.alloc[s1], set([vm1]))
+    assert_equals(b.alloc[s1], set([vm1, vm2]))
+    assert_equals(a.free_cap[s1]['RAM'], 2000)
+    assert_equals(b.free_cap[s1]['RAM'], 0)
+    assert_equals(a.vms, set([vm1]))
+    assert_equals(a.freq_scale[s2], 1.)
+    assert_equals(b.freq_scale[s2], 0.9)
+    a.migrate(vm1, s2) # changing the original doesn't affect the copy
+    assert_equals(b.allocation(vm1), s1)
+    assert_equals(b.free_cap[s2]['RAM'], 8000)
+
+def test_state_running_aggregates():
+    import random
+    rand = random.Random(7)
+    servers = [Server(4000, 2), Server(8000, 4), Server(2000, 2)]
+    vms = [VM(rand.choice([1000, 2000]), rand.choice([1, 2]))
+           for _ in range(8)]
+    for state_class in [State, ArrayState]:
+        states = [state_class(servers, set(vms[:4]))]
+        for step in range(200):
+            state = rand.choice(states)
+            vm = rand.choice(vms)
+            op = rand.choice(['migrate', 'boot', 'delete', 'remove', 'copy'])
+            if op == 'migrate' and vm in state.vms:
+                state.migrate(vm, rand.choice(servers))
+            elif op == 'boot':
+                state.boot(vm)
+            elif op == 'delete' and vm in state.vms:
+                state.delete(vm)
+            elif op == 'remove':
+                state.remove_all(rand.choice(servers))
+            elif op == 'copy':
+                states.append(state.copy())
+            # compare with the aggregates calculated from scratch
+            allocated = [v for v in state.vms if state.is_allocated(v)]
+            assert_almost_equals(state.ratio_allocated(),
+                                 float(len(allocated)) / len(state.vms)
+                                 if state.vms else 1.0)
+            overcap = [s for s in servers if not state.within_capacity(s)]
+            assert_equals(state.overcapacitated_servers(), set(overcap))
+            assert_almost_equals(state.ratio_within_capacity(),
+                                 1 - float(len(overcap)) / len(servers))
+            fresh = State(servers, set(state.vms))
+            for s in servers:
+                for v in state.alloc[s]:
+                    fresh.place(v, s)
+            assert_almost_equals(state.capacity_penalty(),
+                                 fresh.capacity_penalty())
+            for s, u in fresh.calculate_utilisations().iteritems():
+                assert_almost_equals(state.utilisation(s), u)
+
+def test_copy_on_write_dict():
+    d = model._CopyOnWriteDict({i: set([i]) for i in range(100)},
+                               mutable_values=True)
+    copies = [d]
+    for i in range(100): # a long chain of copies, each changing one key
+        c = copies[-1].copy()
+        c.writable(i).add(-i)
+        if i % 2:
+            del c[i]
+        c[100 + i] = set()
+        copies.append(c)
+    assert_equals(d[5], set([5]))
+    last = copies[-1]
+    assert_equals(len(last), 150)
+    assert_equals(set(last), set(range(0, 100, 2)) | set(range(100, 200)))
+    assert_equals(last[4], set([4, -4]))
+    assert_not_in(5, last)
+    assert_true(last.get(5) is None)
+    assert_equals(copies[5][5], set([5]))
+    assert_equals(len(copies[5]), 103)
+
+def test_array_state_constraints():
+    Machine.resource_types = ['RAM', '#CPUs']
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1);
+    vm2 = VM(2000, 2);
+    a = ArrayState([s1, s2], set([vm1, vm2]))
+
+    a.place(vm1, s1)
+    assert_true(a.all_within_capacity())
+    assert_almost_equals(a.ratio_allocated(), 0.5)
+    assert_equals(a.allocation(vm1), s1)
+    assert_equals(a.unallocated_vms(), set([vm2]))
+    a.place(vm2, s1)
+    assert_false(a.within_capacity(s1))
+    assert_equals(a.overcapacitated_servers(), set([s1]))
+    assert_almost_equals(a.ratio_within_capacity(), 0.5)
+    assert_almost_equals(a.capacity_penalty(), 0.25)
+    a.migrate(vm2, s2)
+    assert_true(a.all_within_capacity())
+    assert_equals(a.allocation(vm2), s2)
+    assert_equals(a.free_cap[s1]['RAM'], 2000)
+    assert_equals(a.free_cap[s2]['#CPUs'], 2)
+    assert_almost_equals(a.utilisation(s2), 0.375)
+    a.remove_all(s2)
+    assert_true(a.allocation(vm2) is None)
+    assert_equals(a.free_cap[s2]['RAM'], 8000)
+
+def test_array_state_same_as_state():
+    Machine.resource_types = ['RAM', '#CPUs']
+    servers = [Server(4000, 2), Server(8000, 4), Server(4000, 4)]
+    vms = [VM(2000, 1), VM(2000, 2), VM(1000, 1), VM(3000, 3)]
+    actions = [VMRequest(vms[0], 'boot'), VMRequest(vms[1], 'boot'),
+               Migration(vms[0], servers[0]), Migration(vms[1], servers[0]),
+               VMRequest(vms[2], 'boot'), Migration(vms[2], servers[1]),
+               DecreaseFreq(servers[1]), Migration(vms[1], servers[2]),
+               VMRequest(vms[3], 'boot'), Migration(vms[3], servers[2]),
+               VMRequest(vms[0], 'delete'), IncreaseFreq(servers[1]),
+               DecreaseFreq(servers[2])]
+    state = State(servers, set())
+    array_state = ArrayState(servers, set())
+    for action in actions:
+        state = state.transition(action)
+        array_state = array_state.transition(action)
+        assert_equals(state.calculate_utilisations(),
+                      array_state.calculate_utilisations())
+        assert_almost_equals(state.capacity_penalty(),
+                             array_state.capacity_penalty())
+        assert_equals(state.ratio_within_capacity(),
+                      array_state.ratio_within_capacity())
+        assert_equals(state.ratio_allocated(), array_state.ratio_allocated())
+        assert_equals(dict(state.freq_scale), dict(array_state.freq_scale))
+        for vm in vms:
+            assert_equals(state.allocation(vm), array_state.allocation(vm))
+
+def test_array_state_copy():
+    s1 = Server(4000, 2)
+    vm1 = VM(2000, 1)
+    a = ArrayState([s1], set([vm1]))
+    a.place(vm1, s1)
+    b = a.copy()
+    b.remove(vm1, s1)
+    b.decrease_freq(s1)
+    assert_in(vm1, a.alloc[s1], 'changing one state must not affect the other')
+    assert_equals(a.free_cap[s1]['RAM'], 2000)
+    assert_equals(b.free_cap[s1]['RAM'], 4000)
+    assert_equals(a.freq_scale[s1], 1.)
+    assert_equals(b.freq_scale[s1], 0.9)
+
+def test_cloud_state_class():
+    s1 = Server(4000, 2)
+    vm1 = VM(2000, 1)
+    cloud = Cloud([s1], [vm1], state_class=ArrayState)
+    assert_is_instance(cloud.get_current(), ArrayState)
+    cloud.apply(Migration(vm1, s1))
+    assert_equals(cloud.get_current().allocation(vm1), s1)
+    assert_true(cloud._initial.allocation(vm1) is None)
@@ -6,4 +6,5 @@ from .bcf_scheduler import BCFScheduler
 from .bcffs_scheduler import BCFFSScheduler
 from .bfd_scheduler import BFDScheduler
 from .ga.gascheduler import GAScheduler
+from .ga.islands import IslandGAScheduler
 from .brute_force import BruteForceScheduler
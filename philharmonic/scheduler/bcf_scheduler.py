@@ -1,5 +1,10 @@
+import bisect
+
+import numpy as np
+
 from philharmonic.scheduler.ischeduler import IScheduler
-from philharmonic import Schedule, Migration
+from philharmonic.scheduler import placement
+from philharmonic import Schedule, Migration, Machine
 from philharmonic import calculate_pue
 from philharmonic import conf
 
@@ -37,6 +42,116 @@ def sort_inactive_pms(PMs, state, cost):
                                   -state.free_cap[x]['RAM'],
                                   cost[x.loc]))
 
+_INF = float('inf')
+
+class PlacementContext(object):
+    """Host choice data for one time step: the cost of every server's
+    location, calculated once, and the active and inactive hosts in sorted
+    lists keyed like in sort_active_pms and sort_inactive_pms (ties by the
+    servers' order), as well as their capacity and free capacity
+    matrices. The keys and free capacities are updated as VMs are assigned
+    (see place, which _place_vms calls), so finding a host takes a few
+    bisections and a vectorised fit check instead of sorting all the servers.
+
+    """
+
+    def __init__(self, servers, state, cost):
+        self.servers = list(servers)
+        self._position = {server: i for i, server in enumerate(self.servers)}
+        self._cost = {server: cost[server.loc] for server in self.servers}
+        self._cap = placement.capacity_matrix(self.servers)
+        self._free = placement.free_capacity_matrix(state, self.servers)
+        self._num_vms = [len(state.alloc[server]) for server in self.servers]
+        # TODO: don't hardcode the resources
+        resource_types = Machine.resource_types
+        self._cpus = resource_types.index('#CPUs')
+        self._ram = resource_types.index('RAM')
+        self._keys = {} # server -> (active, key)
+        self._active = [] # (free CPUs, free RAM, cost, position) - sorted
+        self._inactive = [] # (-free CPUs, -free RAM, cost, position) - sorted
+        for server in self.servers:
+            active, key = self._key(server)
+            self._keys[server] = active, key
+            (self._active if active else self._inactive).append(key)
+        self._active.sort()
+        self._inactive.sort()
+
+    def _key(self, server):
+        position = self._position[server]
+        cpus = self._free[position, self._cpus]
+        ram = self._free[position, self._ram]
+        if self._num_vms[position] == 0: # inactive
+            return False, (-cpus, -ram, self._cost[server], position)
+        return True, (cpus, ram, self._cost[server], position)
+
+    def _resort(self, server):
+        active, key = self._keys[server]
+        keys = self._active if active else self._inactive
+        del keys[bisect.bisect_left(keys, key)]
+        active, key = self._key(server)
+        self._keys[server] = active, key
+        bisect.insort(self._active if active else self._inactive, key)
+
+    def place(self, vm, server, previous_host=None):
+        """Re-sort server (and the previous host of vm) as if vm was
+        migrated to it - without changing a state."""
+        if server == previous_host:
+            return
+        demand = placement.demand_vector(vm)
+        if previous_host is not None:
+            position = self._position[previous_host]
+            self._free[position] += demand
+            self._num_vms[position] -= 1
+            self._resort(previous_host)
+        position = self._position[server]
+        self._free[position] -= demand
+        self._num_vms[position] += 1
+        self._resort(server)
+
+    def _first_fit(self, demand, keys):
+        """The first server of keys that the demand fits or None."""
+        positions = [key[3] for key in keys]
+        mask, _ = placement.fit(self._free[positions], self._cap[positions],
+                                demand)
+        if mask.any():
+            return self.servers[positions[np.argmax(mask)]]
+        return None
+
+    def find_host(self, vm):
+        """The first active host (in sort_active_pms order) that vm fits,
+        else the first such inactive host (in sort_inactive_pms order) or
+        None if there is none.
+
+        """
+        cpus, ram = vm.res['#CPUs'], vm.res['RAM']
+        demand = placement.demand_vector(vm)
+        # groups of active hosts with the same free CPUs - increasing,
+        # each sorted by free RAM
+        keys = self._active
+        i = bisect.bisect_left(keys, (cpus,))
+        while i < len(keys):
+            group = keys[i][0]
+            end = bisect.bisect_left(keys, (group, _INF), i)
+            server = self._first_fit(
+                demand, keys[bisect.bisect_left(keys, (group, ram), i):end])
+            if server is not None:
+                return server
+            i = end
+        # groups of inactive hosts - decreasing free CPUs and RAM
+        keys = self._inactive
+        i = 0
+        end_all = bisect.bisect_left(keys, (-cpus, _INF))
+        while i < end_all:
+            group = keys[i][0]
+            end = bisect.bisect_left(keys, (group, _INF), i)
+            server = self._first_fit(
+                demand, keys[i:bisect.bisect_left(keys, (group, -ram, _INF),
+                                                  i, end)])
+            if server is not None:
+                return server
+            i = end
+        return None
+
 class BCFScheduler(IScheduler):
     """Best Cost Fit (BCF) scheduling algorithm. Greedily places VMs on servers
     to favour locations with lower electricity and cooling costs and
@@ -49,30 +164,16 @@ class BCFScheduler(IScheduler):
         or -1 in case some resource's capacity is exceeded.
 
         """
-        # TODO: reuse free_cap data
-        # TODO: this method should probably be a part of Cloud
-        current = self.cloud.get_current()
-        total_utilisation = 0.
-        utilisations = {}
-        for i in server.resource_types:
-            used = 0.
-            for existing_vm in current.alloc[server]:
-                used += existing_vm.res[i]
-            # add our own VM's resource demand
-            used += vm.res[i]
-            utilisations[i] = used/server.cap[i]
-            if used > server.cap[i]: # capacity exceeded for this resource
-                return -1
-        uniform_weight = 1./len(server.resource_types)
-        weights = {res : uniform_weight for res in server.resource_types}
-        for resource_type, utilisation in utilisations.iteritems():
-            total_utilisation += weights[resource_type] * utilisation
-        return total_utilisation
+        mask, utilisation = placement.fit_vm(vm, [server],
+                                             self.cloud.get_current())
+        return utilisation[0] if mask[0] else -1
 
     def _place(self, vm, host, t):
         """Place vm on host. A migration will be scheduled if necessary or
         nothing will be done if the vm is already there.
 
+        Single-VM reference for _place_all, which reevaluate uses.
+
         """
         #TODO: the vm should be removed from the original server only here
         action = Migration(vm, host)
@@ -100,36 +201,54 @@ class BCFScheduler(IScheduler):
                 self.cloud.get_current().remove_all(s) # transition?
         return vms
 
-    def find_host(self, vm):
-        # TODO: this group of commands can be done only once for a list of VMs
-        # in the current moment
-        self.current = self.cloud.get_current()
+    def _placement_context(self):
+        """Host choice data for the current time step."""
         el, temp = self.environment.current_data()
         # take only current values - TODO: average over forecast window
         el = el.loc[self.environment.t]
         temp = temp.loc[self.environment.t]
         # combined cost based on el. price and temperature
         cost = el * calculate_pue(temp)
-        all_hosts = self.cloud.servers
-        hosts = filter(lambda s : not self.current.server_free(s), all_hosts)
-        inactive_hosts = filter(lambda s : self.current.server_free(s),
-                                all_hosts)
-        inactive_hosts = sort_inactive_pms(inactive_hosts, self.current, cost)
-        mapped = False
-        while not mapped:
-            # sort for one of - first pass, free_cap changed or new host
-            hosts = sort_active_pms(hosts, self.current, cost)
-            for host in hosts:
-                if self._fits(vm, host) != -1:
-                    mapped = True
+        return PlacementContext(self.cloud.servers, self.cloud.get_current(),
+                                cost)
+
+    def find_host(self, vm):
+        self.current = self.cloud.get_current()
+        context = getattr(self, '_context', None)
+        if context is None: # not within _place_vms - the state may change
+            context = self._placement_context()
+        return context.find_host(vm)
+
+    def _place_all(self, assignments, t):
+        """Place the VMs on their hosts (a list of (vm, host) pairs) like
+        _place does, but copying the current state and sorting the schedule
+        only once."""
+        actions = [Migration(vm, host) for vm, host in assignments]
+        self.cloud.apply_all(actions)
+        self.current = self.cloud.get_current()
+        self.schedule.extend([action for action in actions
+                              if self._original_vm_hosts.get(action.vm)
+                              != action.server], t) # migration necessary
+
+    def _place_vms(self, VMs, t):
+        """Find hosts for the VMs one by one (in the same order as placing
+        them one by one) on the host choice data of the time step only, then
+        place them all at once."""
+        state = self.cloud.get_current()
+        self._context = context = self._placement_context()
+        assignments = []
+        try:
+            for vm in VMs:
+                host = self.find_host(vm)
+                if host is None:
                     break
-            if not mapped:
-                if len(inactive_hosts) > 0: # activate an inactive host
-                    host = inactive_hosts.pop(0)
-                    hosts.append(host)
-                else:
-                    return None
-        return host
+                context.place(vm, host, state.allocation(vm))
+                assignments.append((vm, host))
+        finally:
+            self._context = None
+        self._place_all(assignments, t)
+        if len(assignments) < len(VMs):
+            raise Exception("not enough free resources")
 
     def reevaluate(self):
         self.schedule = Schedule()
@@ -152,10 +271,6 @@ class BCFScheduler(IScheduler):
         if len(VMs) == 0:
             return self.schedule
 
-        for vm in VMs:
-            host = self.find_host(vm)
-            if host is None:
-                raise Exception("not enough free resources")
-            self._place(vm, host, t)
+        self._place_vms(VMs, t)
 
         return self.schedule
@@ -42,40 +42,36 @@ class BCFFSScheduler(BCFScheduler):
 
     """
 
-    # TODO: these two methods should be a part of the model,
-    # as they touch too many model internals
-    # (available to the scheduler)
+    def __init__(self, cloud=None, driver=None):
+        BCFScheduler.__init__(self, cloud, driver)
+        # evaluate the frequency levels of a server on traces derived from
+        # a single pass through the cloud model (False - replay the
+        # frequency schedule for every level)
+        self.traced_frequency_scaling = True
+
     def _limit_cloud_to_server(self, server):
         """Temporarily consider only this server as the cloud, filter only
         actions and state properties for this server (for performance).
 
         """
-        all_servers = self.cloud.servers
-        self.cloud.servers = [server]
-        self._all_servers = all_servers
-        # preserve and limit state
-        self._all_servers_real = self.cloud._real
-        self.cloud._real = self.cloud._real.copy()
-        self.cloud._real.limit_to_server(server)
-        self.cloud.reset_to_real()
+        self._server_checkpoint = self.cloud.checkpoint()
+        self.cloud.limit_to_server(server)
 
     def _restore_cloud_actions(self):
         """Reverse _limit_cloud_to_server."""
-        # assemble the cloud and actions back
-        self.cloud.servers = self._all_servers
-        # restore state
-        self.cloud._real = self._all_servers_real
+        self.cloud.rollback(self._server_checkpoint)
 
-    def _get_profit_and_cost(self):
-        """Shorthand to calculate service profit and energy cost."""
+    def _get_profit_and_cost(self, trace=None):
+        """Shorthand to calculate service profit and energy cost
+        (of the ScheduleTrace trace if given, else of freq_schedule)."""
         # - calculate profit
         profit = ev.calculate_service_profit(self.cloud, self.environment,
                                              self.freq_schedule,
-                                             self.t, self.end)
+                                             self.t, self.end, trace=trace)
         # - calculate energy cost
         en_cost = ev.combined_cost(self.cloud, self.environment,
                                    self.freq_schedule, self.el, self.temp,
-                                   self.t, self.end)
+                                   self.t, self.end, trace=trace)
         return profit, en_cost
 
     def _add_freq_to_schedule(self, server):
@@ -88,9 +84,8 @@ class BCFFSScheduler(BCFScheduler):
         else:
             action = DecreaseFreq(server)
             self._server_freq_change = -self._server_freq_change
-        while self._server_freq_change > 0:
-            self.schedule.add(action, self.t)
-            self._server_freq_change -= 1
+        self.schedule.extend([action] * self._server_freq_change, self.t)
+        self._server_freq_change = 0
 
     def _increase_frequency(self, server):
         """Increase frequency and note it in the counter."""
@@ -109,17 +104,83 @@ class BCFFSScheduler(BCFScheduler):
         while self.state.freq_scale[server] != conf.freq_scale_max:
             self._increase_frequency(server)
 
+    def _scale_frequency(self, server):
+        """Decrease the frequency of server step by step while the energy
+        savings are at least as high as the profit losses.
+
+        @returns: True if at least one decrease was beneficial
+
+        """
+        decrease_feasible = False
+        profit_previous, en_cost_previous = self._get_profit_and_cost()
+        while True:
+            self._decrease_frequency(server)
+            # debug beta=1.0, en cost increase
+            profit, en_cost = self._get_profit_and_cost()
+            en_savings = en_cost_previous - en_cost
+            profit_loss = profit_previous - profit
+            if en_savings >= profit_loss: # change is beneficial
+                decrease_feasible = True # continue trying other servers
+                profit_previous, en_cost_previous = profit, en_cost
+            else: # not profitable
+                # undo last decrease, break inner loop
+                self._increase_frequency(server)
+                break
+            if self.state.freq_scale[server] == conf.freq_scale_min:
+                break # we reached the lowest frequency, break inner loop
+        return decrease_feasible
+
+    def _frequency_level_traces(self, server):
+        """Generate the ScheduleTraces of freq_schedule followed by 0, 1,
+        2... frequency decreases of server, down to the minimum frequency.
+        Only the frequencies differ between these levels, so the cloud
+        model is replayed once and the other traces are derived from it.
+
+        """
+        trace = ev.trace_schedule(self.cloud, self.environment,
+                                  self.freq_schedule, self.t, self.end)
+        yield trace
+        state = self.state.copy()
+        vms = [vm for vm in state.vms if state.allocation(vm) == server]
+        while True:
+            state.transition(DecreaseFreq(server), inplace=True)
+            yield trace.with_frequency(server, vms, state.freq_scale[server])
+            if state.freq_scale[server] == conf.freq_scale_min:
+                break
+
+    def _scale_frequency_traced(self, server):
+        """Like _scale_frequency, but comparing the frequency levels on
+        their traces (see _frequency_level_traces) and applying the
+        beneficial decreases at the end.
+
+        """
+        levels = self._frequency_level_traces(server)
+        profit_previous, en_cost_previous = self._get_profit_and_cost(
+            next(levels))
+        decreases = 0
+        for trace in levels:
+            profit, en_cost = self._get_profit_and_cost(trace)
+            en_savings = en_cost_previous - en_cost
+            profit_loss = profit_previous - profit
+            if en_savings >= profit_loss: # change is beneficial
+                decreases += 1
+                profit_previous, en_cost_previous = profit, en_cost
+            else: # not profitable
+                break
+        for i in range(decreases): # freq_schedule isn't needed any more
+            self.state.transition(DecreaseFreq(server), inplace=True)
+        self._server_freq_change -= decreases
+        return decreases > 0
+
     def _schedule_frequency_scaling(self):
         """Add the frequency change actions to the schedule which result in
         energy savings higher than the profit losses incurred by
         performance-based pricing.
 
         """
-        # TODO: implement simpler state checkpoints
-        self._original_real = self.cloud._real # preserve original real
+        checkpoint = self.cloud.checkpoint() # to restore the original real
         # pretend the migrations were really applied
-        self.cloud._real = self.cloud._current
-        self.cloud.reset_to_real()
+        self.cloud.make_current_real()
         # schedule of frequency changes for evaluation
         active_PMs = [s for s in self.cloud.servers \
                       if not self.cloud.get_current().server_free(s)]
@@ -130,31 +191,18 @@ class BCFFSScheduler(BCFScheduler):
             self.freq_schedule = Schedule()
             self._limit_cloud_to_server(server)
             self.state = self.cloud.get_current() # for testing effects
-            decrease_feasible = False
             self._server_freq_change = 0 # reset the counter of freq. changes
             self._reset_to_max_frequency(server)
-            profit_previous, en_cost_previous = self._get_profit_and_cost()
-            while True:
-                self._decrease_frequency(server)
-                # debug beta=1.0, en cost increase
-                profit, en_cost = self._get_profit_and_cost()
-                en_savings = en_cost_previous - en_cost
-                profit_loss = profit_previous - profit
-                if en_savings >= profit_loss: # change is beneficial
-                    decrease_feasible = True # continue trying other servers
-                    profit_previous, en_cost_previous = profit, en_cost
-                else: # not profitable
-                    # undo last decrease, break inner loop
-                    self._increase_frequency(server)
-                    break
-                if self.state.freq_scale[server] == conf.freq_scale_min:
-                    break # we reached the lowest frequency, break inner loop
+            if self.traced_frequency_scaling:
+                decrease_feasible = self._scale_frequency_traced(server)
+            else:
+                decrease_feasible = self._scale_frequency(server)
             self._restore_cloud_actions()
             self._add_freq_to_schedule(server) # add actions to schedule
             if conf.freq_breaks_after_nonfeasible and not decrease_feasible:
                 break # outer loop - as the servers are sorted by avg. beta
         # restore the real state
-        self.cloud._real = self._original_real
+        self.cloud.rollback(checkpoint)
         self.cloud.reset_to_real()
 
     def reevaluate(self):
@@ -178,11 +226,8 @@ class BCFFSScheduler(BCFScheduler):
         VMs = sort_vms_big_first(VMs)
 
         # stage 1: schedule migrations
-        for vm in VMs:
-            host = self.find_host(vm)
-            if host is None:
-                raise Exception("not enough free resources")
-            self._place(vm, host, self.t)
+        if len(VMs) > 0:
+            self._place_vms(VMs, self.t)
 
         # stage 2: schedule frequency scaling
         self._schedule_frequency_scaling()
@@ -1,4 +1,7 @@
+import numpy as np
+
 from philharmonic.scheduler.ischeduler import IScheduler
+from philharmonic.scheduler import placement
 from philharmonic import Schedule, Migration
 
 def sort_vms_decreasing(VMs):
@@ -25,30 +28,16 @@ class BFDScheduler(IScheduler):
         or -1 in case some resource's capacity is exceeded.
 
         """
-        # TODO: reuse free_cap data
-        # TODO: this method should probably be a part of Cloud
-        current = self.cloud.get_current()
-        total_utilisation = 0.
-        utilisations = {}
-        for i in server.resource_types:
-            used = 0.
-            for existing_vm in current.alloc[server]:
-                used += existing_vm.res[i]
-            # add our own VM's resource demand
-            used += vm.res[i]
-            utilisations[i] = used/server.cap[i]
-            if used > server.cap[i]: # capacity exceeded for this resource
-                return -1
-        uniform_weight = 1./len(server.resource_types)
-        weights = {res : uniform_weight for res in server.resource_types}
-        for resource_type, utilisation in utilisations.iteritems():
-            total_utilisation += weights[resource_type] * utilisation
-        return total_utilisation
+        mask, utilisation = placement.fit_vm(vm, [server],
+                                             self.cloud.get_current())
+        return utilisation[0] if mask[0] else -1
 
     def _place(self, vm, host, t):
         """Place vm on host. A migration will be scheduled if necessary or
         nothing will be done if the vm is already there.
 
+        Single-VM reference for _place_all, which reevaluate uses.
+
         """
         #TODO: the vm should be removed from the original server only here
         action = Migration(vm, host)
@@ -58,6 +47,16 @@ class BFDScheduler(IScheduler):
             return
         self.schedule.add(action, t)
 
+    def _place_all(self, assignments, t):
+        """Place the VMs on their hosts (a list of (vm, host) pairs) like
+        _place does, but copying the current state and sorting the schedule
+        only once."""
+        actions = [Migration(vm, host) for vm, host in assignments]
+        self.cloud.apply_all(actions)
+        self.schedule.extend([action for action in actions
+                              if self._original_vm_hosts.get(action.vm)
+                              != action.server], t) # migration necessary
+
     # TODO: maybe split into multiple functions and make this one immutable
     def _remove_vms_from_underutilised_hosts(self):
         """mutable method that finds underutilised hosts, removes VMs from
@@ -104,14 +103,27 @@ class BFDScheduler(IScheduler):
         inactive_hosts = filter(lambda s : current.server_free(s), all_hosts)
         inactive_hosts = sort_pms_increasing(inactive_hosts, current)
 
+        # find the hosts on the free capacity matrix, then place all the VMs
+        position = {s : i for i, s in enumerate(all_hosts)}
+        free = placement.free_capacity_matrix(current, all_hosts)
+        cap = placement.capacity_matrix(all_hosts)
+        assignments = []
         for vm in VMs:
+            demand = placement.demand_vector(vm)
             mapped = False
             while not mapped:
-                for host in hosts:
-                    if self._fits(vm, host) != -1:
-                        self._place(vm, host, t)
-                        mapped = True
-                        break
+                rows = [position[host] for host in hosts]
+                mask, utilisation = placement.fit(free[rows], cap[rows],
+                                                  demand)
+                if mask.any(): # the first host that the VM fits
+                    host = hosts[np.argmax(mask)]
+                    previous_host = current.allocation(vm)
+                    if previous_host != host:
+                        if previous_host is not None:
+                            free[position[previous_host]] += demand
+                        free[position[host]] -= demand
+                    assignments.append((vm, host))
+                    mapped = True
                 if not mapped:
                     if len(inactive_hosts) > 0:
                         host = inactive_hosts.pop(0)
@@ -119,5 +131,6 @@ class BFDScheduler(IScheduler):
                         hosts = sort_pms_increasing(hosts, current)
                     else:
                         break
+        self._place_all(assignments, t)
 
         return self.schedule
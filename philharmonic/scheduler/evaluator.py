@@ -3,7 +3,11 @@ performed schedule of actions.
 
 """
 
+from collections import OrderedDict
+import hashlib
+import itertools
 import math
+import threading
 
 import pandas as pd
 import numpy as np
@@ -34,28 +38,29 @@ def print_history(cloud, environment, schedule):
 # TODO: add optional start, end limiters for evaluating a certain period
 
 def calculate_cloud_utilisation(cloud, environment, schedule,
-                                start=None, end=None):
+                                start=None, end=None, from_history=False):
     """Calculate utilisations of all servers based on the given schedule.
 
     @param start, end: if given, only this period will be counted,
     cloud model starts from _real. If not, whole environment.start-end
     counted and the first state is _initial.
 
+    @param from_history: start from the state recorded in cloud.history
+    just before start, rather than from _real.
+
     """
-    if start is None:
-        start = environment.start
-        cloud.reset_to_initial() # TODO: timestamp states and be smarter
-    else:
-        cloud.reset_to_real()
-    if end is None:
-        end = environment.end
+    start, end = _reset_cloud_state(cloud, environment, start, end,
+                                    from_history)
     #TODO: use more precise pandas methods for indexing (performance)
     #TODO: maybe move some of this state iteration functionality into Cloud
     #TODO: see where schedule window should be propagated - here or Scheduler?
     initial_utilisations = cloud.get_current().calculate_utilisations()
     utilisations_list = [initial_utilisations]
     times = [start]
-    for t in schedule.actions.index.unique():
+    actions = schedule.actions
+    if from_history: # the earlier actions are in the recorded state
+        actions = actions[start:]
+    for t in actions.index.unique():
         if t == start: # we change the initial utilisation right away
             utilisations_list = []
             times = []
@@ -78,28 +83,32 @@ def calculate_cloud_utilisation(cloud, environment, schedule,
     return df_util
 
 def precreate_synth_power(start, end, servers):
-    # P_peak = conf.P_peak
-    # P_idle = conf.P_idle
-    # globals()['P_idle'] = P_idle
-    # P_delta = P_peak - P_idle
-    # power_freq = conf.power_freq
-
-    # index = pd.date_range(start, end, freq=power_freq)
-    # P_synth_flat = pd.DataFrame({s: P_delta for s in servers}, index)
-    # globals()['P_synth_flat'] = P_synth_flat
+    """Prepare the worst case utilisation for evaluate (see
+    Evaluator.precreate_synth_power)."""
+    _evaluator.precreate_synth_power(start, end, servers)
 
+def _full_util(start, end, servers):
+    """Full utilisation of all the servers, hourly from start to end."""
     full_util = {server : [1.0, 1.0] for server in servers}
     full_util = pd.DataFrame(full_util,
                              index=[start, end])
     full_util = full_util.resample('H', fill_method='pad')
-    globals()['full_util'] = full_util
+    return full_util
 
-    globals()['cached_end'] = None
+def _power_steps():
+    """Whether cloud power can be kept as a step function - without noise it
+    only changes when utilisation or frequency change."""
+    return not conf.P_std
 
-# TODO: get rid of this globals nonsense and create a Class (or a generator)
 def generate_cloud_power(util, start=None, end=None,
-                         power_freq_model=None, freq=None):
-    """Create power signals from varying utilisation rates."""
+                         power_freq_model=None, freq=None, steps=False):
+    """Create power signals from varying utilisation rates.
+
+    @param steps: if True, return the power as a step function (every value
+    holding until the next index) instead of resampling it to
+    conf.power_freq and adding the conf.P_std noise
+
+    """
     if power_freq_model is None:
         power_freq_model = conf.power_freq_model
     if freq is None:
@@ -113,34 +122,52 @@ def generate_cloud_power(util, start=None, end=None,
         )
     else:
         power = ph.calculate_power(util, conf.P_idle, conf.P_peak)
+    if steps:
+        return power
     # fill it out to the full frequency
     power = power.resample(conf.power_freq, fill_method='pad')
     # add random noise
     power[power > 0] += conf.P_std * np.random.randn(*power.shape)
     return power
 
-def calculate_cloud_cost(power, el_prices):
-    """Take power and el. prices DataFrames & calc. the el. cost."""
-    start = power.index[0]
-    end= power.index[-1]
+def calculate_cloud_cost(power, el_prices, steps=False):
+    """Take power and el. prices DataFrames & calc. the el. cost.
+
+    @param steps: power is a step function (see generate_cloud_power)
+
+    """
+    if steps:
+        start, end = ph.resampled_span(power.index, conf.power_freq)
+    else:
+        start = power.index[0]
+        end= power.index[-1]
     el_prices_loc = pd.DataFrame()
     for server in power.columns: # this might be very inefficient
         loc = server.loc
         el_prices_loc[server] = el_prices[loc][start:end]
+    if steps:
+        return ph.calculate_step_price(power, el_prices_loc, conf.power_freq)
     cost = ph.calculate_price(power, el_prices_loc)#ph.calculate_price_mean(power, el_prices_loc)
     return cost
 
-def calculate_cloud_cooling(power, temperature):
+def calculate_cloud_cooling(power, temperature, steps=False):
     """Take power and temperature DataFrames & calculate the power with
     cooling overhead.
 
+    @param steps: power is a step function (see generate_cloud_power)
+
     """
-    start = power.index[0]
-    end= power.index[-1]
+    if steps:
+        start, end = ph.resampled_span(power.index, conf.power_freq)
+    else:
+        start = power.index[0]
+        end= power.index[-1]
     temperature_server = pd.DataFrame()
     for server in power.columns: # this might be very inefficient
         loc = server.loc
         temperature_server[server] = temperature[loc][start:end]
+    if steps:
+        return ph.calculate_step_cooling_overhead(power, temperature_server)
     #cost = ph.calculate_price(power, el_prices_loc)
     power_with_cooling = ph.calculate_cooling_overhead(power,
                                                        temperature_server)
@@ -164,11 +191,12 @@ def _worst_case_power(cloud, environment, start, end): # TODO: use this
         full_freq = None
     full_power = generate_cloud_power(full_util, freq=full_freq)
 
-def combined_cost(cloud, environment, schedule, el_prices, temperature=None,
-                  start=None, end=None):
-    """Calculate energy costs including IT equipment energy cooling overhead and
-    the real-time electricity price."""
-
+def _util_and_freq(cloud, environment, schedule, start, end, trace):
+    """Server utilisations and frequencies (if the power model needs them)
+    from the trace or by replaying the schedule."""
+    if trace is not None:
+        freq = trace.freq if conf.power_freq_model else None
+        return trace.util, freq, trace.start, trace.end
     # we first calculate utilisation/freq with start, end = None / timestamp
     # this way it knows which state to start from
     # (this is a temp. hack until cloud states get timestamped)
@@ -179,14 +207,28 @@ def combined_cost(cloud, environment, schedule, el_prices, temperature=None,
         )
     else:
         freq = None
-    power = generate_cloud_power(util, freq=freq)
+    return util, freq, start, end
+
+def combined_cost(cloud, environment, schedule, el_prices, temperature=None,
+                  start=None, end=None, trace=None):
+    """Calculate energy costs including IT equipment energy cooling overhead and
+    the real-time electricity price.
+
+    @param trace: ScheduleTrace of the schedule to take the utilisations
+    and frequencies from, instead of replaying the schedule
+
+    """
+    util, freq, start, end = _util_and_freq(cloud, environment, schedule,
+                                            start, end, trace)
+    steps = _power_steps()
+    power = generate_cloud_power(util, freq=freq, steps=steps)
     if start is None:
         start = environment.start
     if end is None:
         end = environment.end
     if temperature is not None:
-        power = calculate_cloud_cooling(power, temperature[start:end])
-    cost = calculate_cloud_cost(power, el_prices[start:end])
+        power = calculate_cloud_cooling(power, temperature[start:end], steps)
+    cost = calculate_cloud_cost(power, el_prices[start:end], steps)
     total_cost = cost.sum() # for the whole cloud
     return total_cost
 
@@ -209,10 +251,12 @@ def normalised_combined_cost(cloud, environment, schedule,
     utilisations = {server : [1.0, 1.0] for server in cloud.servers}
     full_util = pd.DataFrame(utilisations,
                              index=[start, end])
-    full_power = generate_cloud_power(full_util)
+    steps = _power_steps()
+    full_power = generate_cloud_power(full_util, steps=steps)
     if temperature is not None:
-        full_power = calculate_cloud_cooling(full_power, temperature[start:end])
-    cost = calculate_cloud_cost(full_power, el_prices[start:end])
+        full_power = calculate_cloud_cooling(full_power, temperature[start:end],
+                                             steps)
+    cost = calculate_cloud_cost(full_power, el_prices[start:end], steps)
     worst_cost = cost.sum() # worst cost for the whole cloud
 
     # worst = 1.0, best = 0.0
@@ -220,30 +264,29 @@ def normalised_combined_cost(cloud, environment, schedule,
     return normalised
 
 def combined_energy(cloud, environment, schedule, temperature=None,
-                    start=None, end=None):
+                    start=None, end=None, trace=None):
     """Calculate energy of IT equipment and cooling if temperature provided.
 
+    @param trace: ScheduleTrace of the schedule to take the utilisations
+    and frequencies from, instead of replaying the schedule
+
     @returns: energy in kWh
 
     """
-
-    # we first calculate utilisation with start, end = None / some timestamp
-    # this way it knows which state to start from
-    # (this is a temp. hack until cloud states get timestamped)
-    util = calculate_cloud_utilisation(cloud, environment, schedule, start, end)
+    util, freq, start, end = _util_and_freq(cloud, environment, schedule,
+                                            start, end, trace)
     if start is None:
         start = environment.start
     if end is None:
         end = environment.end
-    if conf.power_freq_model:
-        freq = calculate_cloud_frequencies(cloud, environment, schedule,
-                                           start, end)
-    else:
-        freq = None
-    power = generate_cloud_power(util, freq=freq)
+    steps = _power_steps()
+    power = generate_cloud_power(util, freq=freq, steps=steps)
     if temperature is not None:
-        power = calculate_cloud_cooling(power, temperature[start:end])
-    energy = ph.calculate_energy(power)
+        power = calculate_cloud_cooling(power, temperature[start:end], steps)
+    if steps:
+        energy = ph.calculate_step_energy(power, conf.power_freq)
+    else:
+        energy = ph.calculate_energy(power)
     energy_total = energy.sum() # for the whole cloud
     energy_total = ph.joul2kwh(energy_total)
     return energy_total
@@ -253,7 +296,7 @@ def combined_energy(cloud, environment, schedule, temperature=None,
 #------------------------
 
 def calculate_constraint_penalties(cloud, environment, schedule,
-                                   start=None, end=None):
+                                   start=None, end=None, from_history=False):
     """Find all violated hard constraints for the given schedule
     and calculate appropriate penalties.
 
@@ -261,6 +304,9 @@ def calculate_constraint_penalties(cloud, environment, schedule,
     cloud model starts from _real. If not, whole environment.start-end
     counted and the first state is _initial.
 
+    @param from_history: start from the state recorded in cloud.history
+    just before start, rather than from _real.
+
     no constraints violated: 0.0
 
     the more constraintes valuated: closer to 1.0
@@ -270,13 +316,8 @@ def calculate_constraint_penalties(cloud, environment, schedule,
 
     utilisations = {server : [] for server in cloud.servers}
     penalties = {}
-    if start is None:
-        start = environment.start
-        cloud.reset_to_initial() # TODO: timestamp states and be smarter
-    else:
-        cloud.reset_to_real()
-    if end is None:
-        end = environment.end
+    start, end = _reset_cloud_state(cloud, environment, start, end,
+                                    from_history)
     # if no actions - scheduling penalty for >0 VMs
     penalties[start] = sched_weight * np.sign(len(cloud.vms))
     for t in schedule.actions[start:end].index.unique():
@@ -302,23 +343,21 @@ def calculate_constraint_penalties(cloud, environment, schedule,
     return constraint_penalty
 
 def calculate_sla_penalties(cloud, environment, schedule,
-                            start=None, end=None):
+                            start=None, end=None, from_history=False):
     """One migration per VM: 0.0; more migrations - closer to 1.0.
 
     @param start, end: if given, only this period will be counted,
     cloud model starts from _real. If not, whole environment.start-end
     counted and the first state is _initial.
 
+    @param from_history: start from the state recorded in cloud.history
+    just before start, rather than from _real.
+
     """
     # count migrations
     migrations_num = {vm: 0 for vm in cloud.vms}
-    if start is None:
-        start = environment.start
-        cloud.reset_to_initial() # TODO: timestamp states and be smarter
-    else:
-        cloud.reset_to_real()
-    if end is None:
-        end = environment.end
+    start, end = _reset_cloud_state(cloud, environment, start, end,
+                                    from_history)
     for t in schedule.actions[start:end].index.unique():
         # TODO: precise indexing, not dict
         if isinstance(schedule.actions[t], pd.Series):
@@ -327,6 +366,10 @@ def calculate_sla_penalties(cloud, environment, schedule,
         else:
             action = schedule.actions[t]
             migrations_num[action.vm] += 1
+    return _sla_penalty(migrations_num, start, end)
+
+def _sla_penalty(migrations_num, start, end):
+    """SLA penalty for the dict VM -> number of migrations in start-end."""
     migrations_num = pd.Series(migrations_num)
     if len(migrations_num) == 0:
         return 0. # no migrations - awesome!
@@ -350,7 +393,7 @@ R, D = 1000, 300
 V_thd = 100 # MB; treshold after which post-copying starts
 
 def calculate_migration_overhead(cloud, environment, schedule,
-                                 start=None, end=None):
+                                 start=None, end=None, from_history=False):
     """For every migration, calculate the energy using the  Liu et al. model,
     take the mean electricity price between the current and target locations,
     and calculate the resulting cost.
@@ -359,16 +402,14 @@ def calculate_migration_overhead(cloud, environment, schedule,
     cloud model starts from _real. If not, whole environment.start-end
     counted and the first state is _initial.
 
+    @param from_history: start from the state recorded in cloud.history
+    just before start, rather than from _real.
+
     @returns: energy in kWh, cost in $
 
     """
-    if start is None:
-        start = environment.start
-        cloud.reset_to_initial() # TODO: timestamp states and be smarter
-    else:
-        cloud.reset_to_real()
-    if end is None:
-        end = environment.end
+    start, end = _reset_cloud_state(cloud, environment, start, end,
+                                    from_history)
 
     total_energy = 0.
     total_cost = 0.
@@ -386,29 +427,195 @@ def calculate_migration_overhead(cloud, environment, schedule,
             cloud.apply(action)
             after = cloud.get_current()
             host_after = after.allocation(action.vm)
-            #if host_before or host_after is None, it's a boot/delete
-            if (action.name == 'migrate' and host_before and
-                host_after and host_before != host_after):
-                price_before = environment.el_prices[host_before.loc][t]
-                price_after = environment.el_prices[host_after.loc][t]
-                mean_el_price = (price_before + price_after) / 2.
-
-                memory = action.vm.res['RAM'] * 1000 # MB
-                try:
-                    n = int(math.ceil(math.log(V_thd/float(memory),
-                                               D/float(R))))
-                except ZeroDivisionError:
-                    n = 1 # TODO: check what raises this error
-                migration_data = V_mig(memory, R, D, n)
-                energy = E_mig(migration_data) # Joules
-                energy = ph.joul2kwh(energy) # kWh
+            energy, cost = _migration_overhead(environment, action, t,
+                                               host_before, host_after)
+            total_energy += energy
+            total_cost += cost
+    return total_energy, total_cost
+
+def _migration_overhead(environment, action, t, host_before, host_after):
+    """Energy (kWh) and cost ($) of action at t, which moved its VM from
+    host_before to host_after (0 unless it is an actual migration)."""
+    #if host_before or host_after is None, it's a boot/delete
+    if not (action.name == 'migrate' and host_before and
+            host_after and host_before != host_after):
+        return 0., 0.
+    price_before = environment.el_prices[host_before.loc][t]
+    price_after = environment.el_prices[host_after.loc][t]
+    mean_el_price = (price_before + price_after) / 2.
+
+    memory = action.vm.res['RAM'] * 1000 # MB
+    try:
+        n = int(math.ceil(math.log(V_thd/float(memory),
+                                   D/float(R))))
+    except ZeroDivisionError:
+        n = 1 # TODO: check what raises this error
+    migration_data = V_mig(memory, R, D, n)
+    energy = E_mig(migration_data) # Joules
+    energy = ph.joul2kwh(energy) # kWh
+    cost = energy * mean_el_price
+    return energy, cost
+
+#------------------------
+# single-pass evaluation
+#------------------------
+
+class ScheduleTrace(object):
+    """What the evaluation functions need to know about a schedule, recorded
+    by trace_schedule in a single pass through the cloud model.
+
+    util, freq, vm_freq: DataFrames of the server utilisations, server
+    frequencies (Hz) and VM frequencies (Hz, those of the host servers)
+    over time, as calculate_cloud_utilisation and calculate_cloud_frequencies
+    return them
+
+    """
+
+    def __init__(self, start, end, vms, util, freq, vm_freq,
+                 unscaled_freq, unscaled_vm_freq, constraint_penalty,
+                 migrations_num, migration_energy, migration_cost):
+        self.start, self.end = start, end
+        self.vms = vms # the VMs in the state at start
+        self.util = util
+        self.freq = freq
+        self.vm_freq = vm_freq
+        self._unscaled_freq = unscaled_freq
+        self._unscaled_vm_freq = unscaled_vm_freq
+        self.constraint_penalty = constraint_penalty
+        self.migrations_num = migrations_num # VM -> number of actions
+        self.migration_energy = migration_energy
+        self.migration_cost = migration_cost
+
+    @property
+    def sla_penalty(self):
+        return _sla_penalty(self.migrations_num, self.start, self.end)
+
+    def unscaled(self):
+        """The trace of the same schedule without the frequency scaling
+        actions - the allocations and thus utilisations are the same, but
+        the frequencies stay as they were at start."""
+        return ScheduleTrace(self.start, self.end, self.vms, self.util,
+                             self._unscaled_freq, self._unscaled_vm_freq,
+                             self._unscaled_freq, self._unscaled_vm_freq,
+                             self.constraint_penalty, self.migrations_num,
+                             self.migration_energy, self.migration_cost)
+
+    def with_frequency(self, server, vms, freq_scale):
+        """The trace with the frequency of server and of its vms set to
+        freq_scale all the time - as if the schedule scaled the server's
+        frequency to freq_scale at start instead."""
+        freq = self.freq.copy()
+        freq[server] = conf.f_max * freq_scale
+        vm_freq = self.vm_freq.copy()
+        for vm in vms:
+            vm_freq[vm] = conf.f_max * freq_scale
+        return ScheduleTrace(self.start, self.end, self.vms, self.util,
+                             freq, vm_freq, self._unscaled_freq,
+                             self._unscaled_vm_freq, self.constraint_penalty,
+                             self.migrations_num, self.migration_energy,
+                             self.migration_cost)
+
+def _time_frame(values_list, times, end):
+    """DataFrame of the values at times, the last ones holding until end."""
+    if times[-1] < end:
+        # the last values hold until the end - duplicate last
+        times = times + [end]
+        values_list = values_list + [values_list[-1]]
+    return pd.DataFrame(values_list, times)
+
+def trace_schedule(cloud, environment, schedule, start=None, end=None,
+                   from_history=False):
+    """Walk through the schedule once, applying its actions to the cloud
+    model and recording the utilisations, frequencies, constraint penalties,
+    migration counts and migration overhead along the way. The result gives
+    the same values as the calculate_* functions, which each replay the
+    schedule.
+
+    @param start, end: if given, only this period will be counted,
+    cloud model starts from _real. If not, whole environment.start-end
+    counted and the first state is _initial.
+
+    @param from_history: start from the state recorded in cloud.history
+    just before start, rather than from _real.
+
+    @returns: a ScheduleTrace
+
+    """
+    cap_weight, sched_weight = 0.6, 0.4
+    start, end = _reset_cloud_state(cloud, environment, start, end,
+                                    from_history)
+    state = cloud.get_current()
+    vms = set(state.vms)
+    initial_freq = _get_frequencies(state)
+    migrations_num = {vm: 0 for vm in state.vms}
+    penalties = {start: sched_weight * np.sign(len(state.vms))}
+    total_energy, total_cost = 0., 0.
+
+    def snapshot(state):
+        return (state.calculate_utilisations(), _get_frequencies(state),
+                _get_frequencies(state, for_vms=True),
+                _get_frequencies(state, for_vms=True, freq=initial_freq))
+
+    rows = [snapshot(state)]
+    times = [start]
+    # like in calculate_cloud_utilisation, all the actions change the
+    # timelines, but only those in start-end count for the other metrics
+    actions = schedule.actions
+    if from_history: # the earlier actions are in the recorded state
+        actions = actions[start:]
+    if (actions.index < start).any():
+        window_state = state.copy() # without the actions before start
+    else:
+        window_state = None
+    penalty = None
+    for t, group in itertools.groupby(zip(actions.index, actions.values),
+                                      key=lambda item : item[0]):
+        if t == start: # we change the initial values right away
+            rows = []
+            times = []
+        in_window = start <= t <= end
+        for _, action in group:
+            if not in_window:
+                state = cloud.apply(action, inplace=True)
+                continue
+            vm = getattr(action, 'vm', None)
+            if vm is not None:
+                migrations_num[vm] = migrations_num.get(vm, 0) + 1
+            window = state if window_state is None else window_state
+            if action.name == 'migrate':
+                host_before = window.allocation(vm)
+            state = cloud.apply(action, inplace=True)
+            if window_state is None:
+                window = state
+            else:
+                window.transition(action, inplace=True)
+            if action.name == 'migrate':
+                energy, cost = _migration_overhead(
+                    environment, action, t, host_before,
+                    window.allocation(vm))
                 total_energy += energy
-                cost = energy * mean_el_price
                 total_cost += cost
-    return total_energy, total_cost
+        rows.append(snapshot(state))
+        times.append(t)
+        if not in_window:
+            continue
+        # find violated server capacity constraints and unscheduled VMs
+        cap_penalty = 1 - window.ratio_within_capacity()
+        sched_penalty = 1 - window.ratio_allocated()
+        penalty = cap_weight * cap_penalty + sched_weight * sched_penalty
+        penalties[t] = penalty
+    if penalty is not None:
+        penalties[end] = penalty # last penalty holds 'til end
+    constraint_penalty = ph.weighted_mean(pd.Series(penalties))
 
-# TODO: utilisation, constraint and sla penalties could all be
-# calculated in one pass through the states
+    util, freq, vm_freq, unscaled_vm_freq = [
+        _time_frame(list(values), times, end) for values in zip(*rows)
+    ]
+    unscaled_freq = pd.DataFrame([initial_freq] * len(freq), freq.index)
+    return ScheduleTrace(start, end, vms, util, conf.f_max * freq,
+                         conf.f_max * vm_freq, conf.f_max * unscaled_freq,
+                         conf.f_max * unscaled_vm_freq, constraint_penalty,
+                         migrations_num, total_energy, total_cost)
 
 # TODO: add migration energy overhead into the energy calculation
 
@@ -435,179 +642,461 @@ def _calculate_constraint_penalty(state):
     sched_penalty = 1 - state.ratio_allocated()
     return cap_penalty, sched_penalty
 
-def _reset_cloud_state(cloud, environment, start=None, end=None):
+def _evaluation_row(state, servers, cap_weight=0.6, sched_weight=0.4):
+    """Utilisations of the servers (an array in their order) and the weighted
+    constraint penalty of a state."""
+    cap_penalty, sched_penalty = _calculate_constraint_penalty(state)
+    penalty = cap_weight * cap_penalty + sched_weight * sched_penalty
+    utilisations = state.calculate_utilisations()
+    return np.array([utilisations[s] for s in servers], dtype=float), penalty
+
+def _mean_of_means(values):
+    """Mean of the column means of 2D arrays (the last two axes of values),
+    skipping NaN values (like DataFrame.mean().mean())."""
+    counts = (~np.isnan(values)).sum(axis=-2)
+    sums = np.nansum(values, axis=-2)
+    used = counts > 0
+    means = np.where(used, sums / np.maximum(counts, 1), 0.)
+    num_used = used.sum(axis=-1)
+    return np.where(num_used > 0, means.sum(axis=-1) / np.maximum(num_used, 1),
+                    np.nan)
+
+def _action_groups(schedule, vms):
+    """The schedule's actions as a list of (time, tuple of actions) and
+    a dict VM -> number of its actions (the VMs have to be in vms)."""
+    migrations_num = {vm: 0 for vm in vms}
+    actions = schedule.actions
+    groups = []
+    for t, group in itertools.groupby(zip(actions.index, actions.values),
+                                      key=lambda item : item[0]):
+        group = tuple(action for _, action in group)
+        for action in group:
+            try:
+                migrations_num[action.vm] += 1
+            except KeyError:
+                error('Explosion! Check environment.get_requests.')
+                raise
+        groups.append((t, group))
+    return groups, migrations_num
+
+class Replay(object):
+    """The states that Evaluator.evaluate went through when applying
+    a schedule's actions: for every time with actions, the actions, a copy
+    of the resulting state and its utilisations and constraint penalty.
+
+    Evaluating a schedule that has the same actions up to some time (e.g.
+    a GA unit after a mutation or a crossover) can resume from the state
+    after them, provided it starts at the same time from the same real state.
+
+    """
+
+    def __init__(self, start, origin, servers, initial_row):
+        self.start = start
+        self.origin = origin # the real state the evaluation started from
+        self.servers = servers # the order of the utilisations in the rows
+        self.initial_row = initial_row # of the state at start
+        self.times = []
+        self.actions = []
+        self.states = []
+        self.rows = []
+
+    def resumable(self, start, origin):
+        """Whether an evaluation from origin at start can reuse this."""
+        return (origin is not None and self.origin is origin and
+                self.start == start)
+
+    def common_prefix(self, groups):
+        """Number of the leading (time, actions) groups already replayed."""
+        done = 0
+        for (t, actions), t_done, actions_done in itertools.izip(
+                groups, self.times, self.actions):
+            if t != t_done or actions != actions_done:
+                break
+            done += 1
+        return done
+
+    def resume(self, done):
+        """A new Replay with the first done steps of this one."""
+        replay = Replay(self.start, self.origin, self.servers,
+                        self.initial_row)
+        replay.times = self.times[:done]
+        replay.actions = self.actions[:done]
+        replay.states = self.states[:done]
+        replay.rows = self.rows[:done]
+        return replay
+
+    def record(self, t, actions, state):
+        """Note the state after applying actions at time t."""
+        self.times.append(t)
+        self.actions.append(actions)
+        self.states.append(state.copy())
+        self.rows.append(_evaluation_row(state, self.servers))
+
+    def timeline(self, end):
+        """The utilisations (an array with a row per time) and the constraint
+        penalties (a Series) over time, until end.
+
+        """
+        # if no actions - penalty for the current state
+        # or penalty for start -> t
+        utilisations, penalty = self.initial_row
+        utilisations_list = [utilisations]
+        times = [self.start]
+        penalties = {self.start: penalty}
+        for t, (utilisations, penalty) in zip(self.times, self.rows):
+            if t == self.start: # we change the initial utilisation right away
+                utilisations_list = []
+                times = []
+                # we remove the initial penalty, as there are immediate actions
+                penalties = {}
+            utilisations_list.append(utilisations)
+            times.append(t)
+            penalties[t] = penalty
+        if times[-1] < end:
+            # the last utilisation values hold until the end - duplicate last
+            times.append(end)
+            utilisations_list.append(utilisations_list[-1])
+        #if len(schedule.actions) > 0: # <- not sure why this if was necessary
+        penalties[end] = penalty # last penalty holds 'til end
+        times = np.array([t.value for t in times])
+        return times, np.vstack(utilisations_list), sorted(penalties.items())
+
+def _reset_cloud_state(cloud, environment, start=None, end=None,
+                       from_history=False):
     """Undo any actions applied after the _real (if start given)
     or _initial state (if start is None).
 
+    @param from_history: start from the real state recorded in the cloud's
+    history just before start instead (to evaluate a past period of the
+    simulation without replaying everything before it)
+
     """
     if start is None:
         start = environment.start
-        cloud.reset_to_initial() # TODO: timestamp states and be smarter
+        cloud.reset_to_initial()
+    elif from_history:
+        cloud.reset_to_time(start, inclusive=False)
     else:
         cloud.reset_to_real()
     if end is None:
         end = environment.end
     return start, end
 
-def evaluate(cloud, environment, schedule,
-             el_prices, temperature=None,
-             start=None, end=None):
-    """Calculate utilprice, sla and contstraint penalties
-    of all servers based on the given schedule.
-
-    @param start, end: if given, only this period will be counted,
-    cloud model starts from _real. If not, whole environment.start-end
-    counted and the first state is _initial.
+def _fingerprint(data):
+    """Identify the contents of a DataFrame/Series (None for None), so that
+    a changed data set is noticed even if it's the same object."""
+    if data is None:
+        return None
+    digest = hashlib.md5()
+    digest.update(np.ascontiguousarray(data.index.values).view(np.uint8))
+    digest.update(np.ascontiguousarray(data.values, dtype=float).view(np.uint8))
+    columns = tuple(getattr(data, 'columns', ()))
+    return data.shape, columns, digest.hexdigest()
 
-    """
-    start, end = _reset_cloud_state(cloud, environment, start, end)
-    #TODO: use more precise pandas methods for indexing (performance)
-    #TODO: maybe move some of this state iteration functionality into Cloud
-    #TODO: see where schedule window should be propagated - here or Scheduler?
-    initial_utilisations = cloud.get_current().calculate_utilisations()
-    utilisations_list = [initial_utilisations]
-    times = [start]
+class Evaluator(object):
+    """Evaluates schedules (see evaluate), caching the data that only depends
+    on the evaluated period and the geotemporal inputs - the el. prices
+    (with the cooling overhead) per server and the worst case cost.
 
-    # CONSTRAINTS
-    cap_weight, sched_weight = 0.6, 0.4
-    penalties = {}
-    # if no actions - penalty for the current state
-    # or penalty for start -> t
-    cap_penalty, sched_penalty = _calculate_constraint_penalty(
-        cloud.get_current())
-    penalty = cap_weight * cap_penalty + sched_weight * sched_penalty
-    penalties[start] = penalty
+    The cache holds the last cache_size periods. It is keyed on the period,
+    the contents of the inputs and the servers, so changed inputs are
+    recognised. Each scheduler can have its own Evaluator; evaluate and
+    precreate_synth_power use a shared one.
 
-    # SLA
-    migrations_num = {vm: 0 for vm in cloud.vms}
+    """
 
-    for t in schedule.actions.index.unique():
-        if t == start: # we change the initial utilisation right away
-            utilisations_list = []
-            times = []
-            # we remove the initial penalty, as there are immediate actions
-            penalties = {}
-        # TODO: precise indexing, not dict
-        if isinstance(schedule.actions[t], pd.Series):
-            for action in schedule.actions[t].values:
-                cloud.apply(action, inplace=True)
-                try:
-                    migrations_num[action.vm] += 1
-                except KeyError:
-                    error('Explosion! Check environment.get_requests.')
-                    raise
-        else:
-            action = schedule.actions[t]
+    cache_size = 16
+
+    def __init__(self, cache_size=None):
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self._cache = OrderedDict() # key -> period data, least recent first
+        self._lock = threading.Lock()
+        self.full_util = None
+        self.hits = 0
+        self.misses = 0
+
+    def precreate_synth_power(self, start, end, servers):
+        """Prepare the worst case (full) utilisation of the servers for the
+        whole simulation, start-end."""
+        # P_peak = conf.P_peak
+        # P_idle = conf.P_idle
+        # P_delta = P_peak - P_idle
+        # power_freq = conf.power_freq
+
+        # index = pd.date_range(start, end, freq=power_freq)
+        # P_synth_flat = pd.DataFrame({s: P_delta for s in servers}, index)
+
+        self.full_util = _full_util(start, end, servers)
+        self.clear()
+
+    def clear(self):
+        """Forget all the cached data."""
+        with self._lock:
+            self._cache.clear()
+
+    def _period_data(self, start, end, el_prices, temperature, servers):
+        """Return el. prices in start-end (with the cooling overhead),
+        the same per server and the average worst case utilprice."""
+        servers = tuple(servers)
+        key = (start, end, _fingerprint(el_prices), _fingerprint(temperature),
+               servers, tuple(server.loc for server in servers))
+        with self._lock:
             try:
-                migrations_num[action.vm] += 1
+                data = self._cache.pop(key)
             except KeyError:
-                error('Explosion! Check environment.get_requests.')
-                raise
-            cloud.apply(action, inplace=True)
-        state = cloud.get_current()
-        new_utilisations = state.calculate_utilisations()
-        utilisations_list.append(new_utilisations)
-        times.append(t)
-
-        # CONSTRAINTS
-        cap_penalty, sched_penalty = _calculate_constraint_penalty(state)
-        penalty = cap_weight * cap_penalty + sched_weight * sched_penalty
-        penalties[t] = penalty
-
-    if times[-1] < end:
-        # the last utilisation values hold until the end - duplicate last
-        times.append(end)
-        utilisations_list.append(utilisations_list[-1])
-
-    util = pd.DataFrame(utilisations_list, times)
-
-    # CONSTRAINTS
-    #if len(schedule.actions) > 0: # <- not sure why this if was necessary
-    penalties[end] = penalty # last penalty holds 'til end
-    # CONSTRAINTS
-    penalties = pd.Series(penalties)
-    constraint_penalty = ph.weighted_mean(penalties)
-
-    # SLA
-    migrations_num = pd.Series(migrations_num)
-    if len(migrations_num) == 0:
-        sla_penalty = 0. # no migrations - awesome!
-    else:
-        # average migration rate per 4 hours
-        duration = (end - start).total_seconds() / 3600 # hours
-        migrations_rate = 4 * migrations_num / duration
-        # Migration rate penalty - linear 1-4 migr/4 hours -> 0.0-1.0
-        penalty =  (migrations_rate - 1) / 3.
-        penalty[penalty<0] = 0
-        penalty[penalty>1] = 1
-        # 1 / 4 hours - tolerated, >1 / 4 hours - bad
-        sla_penalty = penalty.mean()
-
-    # COST GOAL
-    #----------
-    # utility + cooling + el. price penalty
-    # -load some cached data (or create & cache if it's a miss)
-    if globals()['cached_end'] == end:
-        el_prices_server = globals()['el_prices_server']
-        utilprice_worst_avg = globals()['utilprice_worst_avg']
-        el_prices_current = globals()['el_prices_current']
-    else:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._cache[key] = data # now the most recently used
+                return data
+        data = self._calculate_period_data(start, end, el_prices, temperature,
+                                           servers)
+        with self._lock:
+            self._cache[key] = data
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False) # least recently used
+        return data
+
+    def _calculate_period_data(self, start, end, el_prices, temperature,
+                               servers):
         el_prices_current = el_prices[start:end]
         if temperature is not None:
             pPUE = ph.calculate_pue(temperature[start:end])
             el_prices_current = el_prices_current * pPUE
-        globals()['el_prices_current'] = el_prices_current
         el_prices_server = pd.DataFrame()
         # TODO: multiply with pPUE - from the temperature model
-        for server in util.columns: # this might be very inefficient
+        for server in servers: # this might be very inefficient
             loc = server.loc
             el_prices_server[server] = el_prices_current[loc]
-        globals()['el_prices_server'] = el_prices_server
-        globals()['cached_end'] = end
 
         # - worst case util
-        full_util_current = globals()['full_util'][start:end]
+        full_util = self.full_util
+        if full_util is None: # not precreated - just for this period
+            full_util = _full_util(start, end, servers)
+        full_util_current = full_util[start:end]
         utilprice_worst = el_prices_server * full_util_current
         utilprice_worst_avg = utilprice_worst.mean().mean()
-        globals()['utilprice_worst_avg'] = utilprice_worst_avg
+        return el_prices_current, el_prices_server, utilprice_worst_avg
 
-    # -based on this utility
-    util = util.reindex(el_prices_current.index, method='pad')
-    utilprice = el_prices_server * util
-    utilprice_avg = utilprice.mean().mean()
-    utilprice_penalty = utilprice_avg / float(utilprice_worst_avg)
+    def evaluate(self, cloud, environment, schedule,
+                 el_prices, temperature=None,
+                 start=None, end=None):
+        """Calculate utilprice, sla and contstraint penalties
+        of all servers based on the given schedule.
 
-    # mean nonzero utilisation
-    nonzero_utilisation_avg = util[util>0].mean().mean()
-    if np.isnan(nonzero_utilisation_avg):
-        nonzero_utilisation_avg = 0
-    # goal: high utilisation -> 0.0 good, high utilisation; 1.0 low utilisation
-    util_penalty = float(1 - nonzero_utilisation_avg)
+        @param start, end: if given, only this period will be counted,
+        cloud model starts from _real. If not, whole environment.start-end
+        counted and the first state is _initial.
 
-    #cost_penalty = 0.2 * util_penalty + 0.8 * utilprice_penalty
+        """
+        penalties, replay = self.evaluate_incremental(
+            cloud, environment, schedule, el_prices, temperature, start, end
+        )
+        return penalties
+
+    def evaluate_incremental(self, cloud, environment, schedule,
+                             el_prices, temperature=None,
+                             start=None, end=None, replay=None):
+        """Like evaluate, but also return the Replay of this evaluation.
+
+        @param replay: Replay of an earlier evaluation (e.g. of the parent of
+        a GA unit) - if it started at the same time from the same real state,
+        the actions up to the first time at which the schedules differ
+        are not applied again, but the recorded states are reused
+
+        @returns: (util_penalty, utilprice_penalty, constraint_penalty,
+        sla_penalty), Replay
+
+        """
+        return self.evaluate_many(cloud, environment, [schedule], el_prices,
+                                  temperature, start, end, [replay])[0]
+
+    def evaluate_many(self, cloud, environment, schedules,
+                      el_prices, temperature=None,
+                      start=None, end=None, replays=None):
+        """Evaluate several schedules for the same period and inputs (e.g.
+        a GA population) like evaluate_incremental. The cloud state and the
+        period data are prepared once and the penalties of all the schedules
+        are calculated together, with their utilisations stacked into
+        a schedules x el. price times x servers array.
+
+        @param replays: Replays to resume from (see evaluate_incremental),
+        one per schedule (or None)
+
+        @returns: a list of (util_penalty, utilprice_penalty,
+        constraint_penalty, sla_penalty), Replay - one per schedule
+
+        """
+        if len(schedules) == 0:
+            return []
+        if replays is None:
+            replays = [None] * len(schedules)
+        origin = cloud.get_real() if start is not None else None
+        start, end = _reset_cloud_state(cloud, environment, start, end)
+        #TODO: use more precise pandas methods for indexing (performance)
+        #TODO: maybe move some of this state iteration functionality into Cloud
+        #TODO: see where schedule window should be propagated - here or Scheduler?
+        initial = cloud.get_current()
+        servers = tuple(cloud.servers)
+        vms = list(cloud.vms)
+        initial_row = None
+        new_replays = []
+        migrations_num = np.zeros((len(schedules), len(vms)))
+        for i, (schedule, replay) in enumerate(zip(schedules, replays)):
+            # SLA
+            groups, migrations = _action_groups(schedule, vms)
+            migrations_num[i] = [migrations[vm] for vm in vms]
+            if replay is not None and replay.resumable(start, origin):
+                done = replay.common_prefix(groups)
+                replay = replay.resume(done)
+            else:
+                done = 0
+                if initial_row is None:
+                    initial_row = _evaluation_row(initial, servers)
+                replay = Replay(start, origin, servers, initial_row)
+            if done > 0:
+                state = replay.states[done - 1].copy()
+            else:
+                state = initial.copy()
+            for t, actions in groups[done:]:
+                for action in actions:
+                    state.transition(action, inplace=True)
+                replay.record(t, actions, state)
+            new_replays.append(replay)
+        _reset_cloud_state(cloud, environment, start, end)
+        timelines = [replay.timeline(end) for replay in new_replays]
+
+        # CONSTRAINTS - mean weighted on the time durations
+        # (see ph.weighted_mean)
+        constraint_penalties = np.empty(len(schedules))
+        values, durations, offsets = [], [], []
+        for i, (_, _, penalties) in enumerate(timelines):
+            penalty_times, penalty_values = zip(*penalties)
+            if len(penalty_values) == 1:
+                constraint_penalties[i] = penalty_values[0]
+                continue
+            offsets.append(len(values))
+            values.extend(penalty_values[:-1])
+            durations.extend(np.diff([t.value for t in penalty_times]))
+        weighted = [i for i, (_, _, penalties) in enumerate(timelines)
+                    if len(penalties) > 1]
+        if weighted:
+            values, durations = np.array(values), np.array(durations, float)
+            constraint_penalties[weighted] = (
+                np.add.reduceat(values * durations, offsets) /
+                np.add.reduceat(durations, offsets)
+            )
+
+        # SLA
+        if len(vms) == 0:
+            sla_penalties = np.zeros(len(schedules)) # no migrations - awesome!
+        else:
+            # average migration rate per 4 hours
+            duration = (end - start).total_seconds() / 3600 # hours
+            migrations_rate = 4 * migrations_num / duration
+            # Migration rate penalty - linear 1-4 migr/4 hours -> 0.0-1.0
+            penalty =  (migrations_rate - 1) / 3.
+            penalty = np.clip(penalty, 0, 1)
+            # 1 / 4 hours - tolerated, >1 / 4 hours - bad
+            sla_penalties = penalty.mean(axis=1)
+
+        # COST GOAL
+        #----------
+        # utility + cooling + el. price penalty
+        el_prices_current, el_prices_server, utilprice_worst_avg = \
+            self._period_data(start, end, el_prices, temperature, servers)
+
+        # -based on this utility, padded to the el. price times:
+        # all the utilisation rows (and a NaN row before the first time)
+        # stacked, indexed by schedule and el. price time
+        price_times = el_prices_current.index.asi8
+        blocks, rows, offset = [], [], 0
+        for times, utilisations, _ in timelines:
+            blocks.append(np.nan * utilisations[:1])
+            blocks.append(utilisations)
+            rows.append(offset + np.searchsorted(times, price_times,
+                                                 side='right'))
+            offset += len(utilisations) + 1
+        util = np.vstack(blocks)[np.array(rows, dtype=int)]
+        utilprice = el_prices_server.values * util
+        utilprice_avg = _mean_of_means(utilprice)
+        utilprice_penalties = utilprice_avg / float(utilprice_worst_avg)
+
+        # mean nonzero utilisation
+        nonzero_utilisation_avg = _mean_of_means(
+            np.where(util > 0, util, np.nan))
+        nonzero_utilisation_avg[np.isnan(nonzero_utilisation_avg)] = 0
+        # goal: high utilisation -> 0.0 good, high utilisation; 1.0 low utilisation
+        util_penalties = 1 - nonzero_utilisation_avg
+
+        #cost_penalty = 0.2 * util_penalty + 0.8 * utilprice_penalty
+
+        results = []
+        for i, replay in enumerate(new_replays):
+            penalties = (float(util_penalties[i]),
+                         float(utilprice_penalties[i]),
+                         float(constraint_penalties[i]),
+                         float(sla_penalties[i]))
+            results.append((penalties, replay))
+        return results
+
+_evaluator = Evaluator() # used by the module-level functions
 
-    _reset_cloud_state(cloud, environment, start, end)
+def evaluate(cloud, environment, schedule,
+             el_prices, temperature=None,
+             start=None, end=None):
+    """Calculate utilprice, sla and contstraint penalties
+    of all servers based on the given schedule (see Evaluator.evaluate).
+
+    """
+    return _evaluator.evaluate(cloud, environment, schedule, el_prices,
+                               temperature, start, end)
+
+def evaluate_incremental(cloud, environment, schedule,
+                         el_prices, temperature=None,
+                         start=None, end=None, replay=None):
+    """Evaluate the schedule, resuming from the replay of an earlier
+    evaluation (see Evaluator.evaluate_incremental).
 
-    return util_penalty, utilprice_penalty, constraint_penalty, sla_penalty
+    """
+    return _evaluator.evaluate_incremental(cloud, environment, schedule,
+                                           el_prices, temperature, start, end,
+                                           replay)
+
+def evaluate_many(cloud, environment, schedules,
+                  el_prices, temperature=None,
+                  start=None, end=None, replays=None):
+    """Evaluate several schedules at once (see Evaluator.evaluate_many).
+
+    """
+    return _evaluator.evaluate_many(cloud, environment, schedules, el_prices,
+                                    temperature, start, end, replays)
 
 # TODO: maybe move to State.freq_scale_vms
-def _server_freqs_to_vm_freqs(state):
+def _server_freqs_to_vm_freqs(state, freq=None):
     """Return a dict with VMs as keys and showing frequencies
     of servers hosting them in @param state.
 
+    @param freq: server -> frequency to use instead of state.freq_scale
+
     """
-    vm_freq = {vm : state.freq_scale[state.allocation(vm)] for vm in state.vms}
+    if freq is None:
+        freq = state.freq_scale
+    vm_freq = {vm : freq[state.allocation(vm)] for vm in state.vms}
     return vm_freq
 
-def _get_frequencies(state, for_vms=False):
+def _get_frequencies(state, for_vms=False, freq=None):
     """Get frequencies for VMs/servers in the given state as needed"""
     if for_vms:
         try:
-            freq = _server_freqs_to_vm_freqs(state)
+            freq = _server_freqs_to_vm_freqs(state, freq)
         except KeyError: # when VMs are not allocated anywhere
             freq = {}
     else:
         freq = state.freq_scale
+        if not isinstance(freq, dict): # e.g. an ArrayState view
+            freq = dict(freq)
     return freq
 
 def calculate_cloud_frequencies(cloud, environment, schedule,
@@ -650,21 +1139,31 @@ def calculate_cloud_frequencies(cloud, environment, schedule,
     return df_freq_hz
 
 def calculate_service_profit(cloud, environment, schedule,
-                             start=None, end=None):
-    """Calculate the profit for the cloud provider for hosting the VMs."""
+                             start=None, end=None, trace=None):
+    """Calculate the profit for the cloud provider for hosting the VMs.
 
-    if conf.power_freq_model:
-        freq = calculate_cloud_frequencies(cloud, environment, schedule,
-                                           start, end, for_vms=True)
-    else:
-        freq = None
+    @param trace: ScheduleTrace of the schedule to take the VM frequencies
+    from, instead of replaying the schedule
+
+    """
     whole_timeline = (start is None) # called for whole simulation timeline
-    start, end = _reset_cloud_state(cloud, environment, start, end)
+    if trace is not None:
+        freq = trace.vm_freq if conf.power_freq_model else None
+        start, end = trace.start, trace.end
+        vms = trace.vms
+    else:
+        if conf.power_freq_model:
+            freq = calculate_cloud_frequencies(cloud, environment, schedule,
+                                               start, end, for_vms=True)
+        else:
+            freq = None
+        start, end = _reset_cloud_state(cloud, environment, start, end)
+        vms = cloud.get_current().vms
     # TODO: test both cases
     if whole_timeline:
         considered_vms = set(environment._requests.apply(lambda a : a.vm))
     else:
-        considered_vms = cloud.get_current().vms
+        considered_vms = vms
 
     df_beta = pd.DataFrame(
         [{vm : vm.beta for vm in considered_vms}], [start]
@@ -690,9 +1189,3 @@ def calculate_service_profit(cloud, environment, schedule,
     df_price = df_price.resample(conf.pricing_freq, fill_method='pad')
     total_profit = df_price.sum().sum()
     return total_profit
-
-# TODO: move all the functions as methods in here, make global caches attributes
-# and have it automatically recognise when geotemp. inputs have changed to
-# cache the new results.
-class Evaluator(object):
-    pass
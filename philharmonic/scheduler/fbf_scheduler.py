@@ -1,4 +1,7 @@
+import numpy as np
+
 from philharmonic.scheduler.ischeduler import IScheduler
+from philharmonic.scheduler import placement
 from philharmonic import Schedule, Migration
 
 class FBFScheduler(IScheduler):
@@ -6,37 +9,27 @@ class FBFScheduler(IScheduler):
 
     def __init__(self, cloud=None, driver=None):
         IScheduler.__init__(self, cloud, driver)
+        self._index = None # first-fit index of the servers in reevaluate
 
     def _fits(self, vm, server):
         """Returns the utilisation of adding vm to server
         or -1 in case some resource's capacity is exceeded.
 
         """
-        #TODO: this method should probably be a part of Cloud
-        current = self.cloud.get_current()
-        total_utilisation = 0.
-        utilisations = {}
-        for i in server.resource_types:
-            used = 0.
-            for existing_vm in current.alloc[server]:
-                used += existing_vm.res[i]
-            # add our own VM's resource demand
-            used += vm.res[i]
-            utilisations[i] = used/server.cap[i]
-            if used > server.cap[i]: # capacity exceeded for this resource
-                return -1
-        uniform_weight = 1./len(server.resource_types)
-        weights = {res : uniform_weight for res in server.resource_types}
-        for resource_type, utilisation in utilisations.iteritems():
-            total_utilisation += weights[resource_type] * utilisation
-        return total_utilisation
+        mask, utilisation = placement.fit_vm(vm, [server],
+                                             self.cloud.get_current())
+        return utilisation[0] if mask[0] else -1
 
     def find_host(self, vm):
-        for server in self.cloud.servers:
-            utilisation = self._fits(vm, server)
-            #TODO: compare utilisations of different potential hosts
-            if utilisation != -1:
-                return server
+        """The first server that vm fits or None if there is none."""
+        if self._index is not None: # within reevaluate
+            return self._index.find(vm)
+        servers = self.cloud.servers
+        mask, utilisation = placement.fit_vm(vm, servers,
+                                             self.cloud.get_current())
+        #TODO: compare utilisations of different potential hosts
+        if mask.any():
+            return servers[np.argmax(mask)]
         return None
 
     def reevaluate(self):
@@ -46,15 +39,26 @@ class FBFScheduler(IScheduler):
         requests = self.environment.get_requests()
         # if len(requests) > 0:
         #    import ipdb; ipdb.set_trace()
-        for request in requests:
-            if request.what == 'boot':
+        self._index = placement.FirstFitIndex(self.cloud.servers,
+                                              self.cloud.get_current())
+        try:
+            for request in requests:
+                if request.what == 'boot':
 
-                server = self.find_host(request.vm)
-                if server is None:
-                    raise Exception("not enough free resources")
-                action = Migration(request.vm, server)
-                self.cloud.apply(action)
-                self.schedule.add(action, t)
+                    server = self.find_host(request.vm)
+                    if server is None:
+                        raise Exception("not enough free resources")
+                    action = Migration(request.vm, server)
+                    previous_host = self.cloud.get_current().allocation(
+                        request.vm)
+                    self.cloud.apply(action)
+                    self._index.update(server, self.cloud.get_current())
+                    if previous_host is not None and previous_host != server:
+                        self._index.update(previous_host,
+                                           self.cloud.get_current())
+                    self.schedule.add(action, t)
+        finally:
+            self._index = None
         # for each boot request:
         # find the best server
         #  - find server that can host this VM
@@ -1,22 +1,28 @@
+from collections import OrderedDict
 import copy
+import hashlib
+import multiprocessing
 import random
+import time
 
 import pandas as pd
 import numpy as np
 
-from philharmonic import Schedule, Migration
+from philharmonic import Schedule, ArraySchedule, Migration
 from philharmonic.scheduler.ischeduler import IScheduler
 from philharmonic.scheduler import evaluator
+from philharmonic.scheduler.ga import genome
 from philharmonic.scheduler import BCFScheduler
 from philharmonic import random_time
 from philharmonic.logger import *
 
-class ScheduleUnit(Schedule):
+class ScheduleUnit(ArraySchedule):
 
     def __init__(self):
         self.changed = True
         self.no_temperature = False
         self.no_el_price = False
+        self.replay = None # of the last evaluation, to resume from
         super(ScheduleUnit, self).__init__()
 
     #TODO: make operators functions, not methods
@@ -26,41 +32,58 @@ class ScheduleUnit(Schedule):
         if self.changed:
             #TODO: maybe move this method to the Scheduler
             #TODO: set start, end for sla, constraint
+            start, end, el_prices, temperature = self._evaluation_inputs()
             try:
-                w_util = self.w_util
-                w_cost = self.w_cost
-                w_sla = self.w_sla
-                w_constraint = self.w_constraint
-            except AttributeError: # not configured, stick to the defaults
-                # fitness function weights - default values
-                w_util, w_cost, w_sla, w_constraint = 0.18, 0.17, 0.25, 0.4
-            start, end = self.environment.t, self.environment.forecast_end
-            # we get new data about the future temp. and el. prices
-            el_prices, temperature = self.environment.current_data()
-            if self.no_temperature:
-                temperature = None # we don't consider the temp. factor
-            if self.no_el_price:
-                w_util = w_cost + w_util
-                w_cost = 0.0 # we don't consider the cost factor
-            self.util, self.cost, self.constr, self.sla = evaluator.evaluate(
+                evaluate = self.evaluator.evaluate_incremental
+            except AttributeError: # no own evaluator, use the shared one
+                evaluate = evaluator.evaluate_incremental
+            # only the actions after those the unit shares with the
+            # last evaluated one (itself or its parent) are applied again
+            penalties, replay = evaluate(
                 self.cloud, self.environment, self, el_prices, temperature,
-                start, end
+                start, end, getattr(self, 'replay', None)
             )
-            weighted_sum = (
-                w_util * self.util +
-                w_cost * self.cost + w_sla * self.sla +
-                w_constraint * self.constr
-            )
-            self.fitness = weighted_sum
-            self.rfitness = 1 - self.fitness
-            #if len(self.environment.get_requests()) > 0:
-            #   import ipdb; ipdb.set_trace()
-            if np.isnan(self.fitness):
-                #import ipdb; ipdb.set_trace()
-                pass
-            self.changed = False
+            self._set_fitness(penalties, replay)
         return self.fitness
 
+    def _evaluation_inputs(self):
+        """The period and the geotemporal inputs to evaluate the unit on."""
+        start, end = self.environment.t, self.environment.forecast_end
+        # we get new data about the future temp. and el. prices
+        el_prices, temperature = self.environment.current_data()
+        if self.no_temperature:
+            temperature = None # we don't consider the temp. factor
+        return start, end, el_prices, temperature
+
+    def _set_fitness(self, penalties, replay):
+        """Combine the evaluated penalties into the fitness."""
+        try:
+            w_util = self.w_util
+            w_cost = self.w_cost
+            w_sla = self.w_sla
+            w_constraint = self.w_constraint
+        except AttributeError: # not configured, stick to the defaults
+            # fitness function weights - default values
+            w_util, w_cost, w_sla, w_constraint = 0.18, 0.17, 0.25, 0.4
+        if self.no_el_price:
+            w_util = w_cost + w_util
+            w_cost = 0.0 # we don't consider the cost factor
+        self.util, self.cost, self.constr, self.sla = penalties
+        self.replay = replay
+        weighted_sum = (
+            w_util * self.util +
+            w_cost * self.cost + w_sla * self.sla +
+            w_constraint * self.constr
+        )
+        self.fitness = weighted_sum
+        self.rfitness = 1 - self.fitness
+        #if len(self.environment.get_requests()) > 0:
+        #   import ipdb; ipdb.set_trace()
+        if np.isnan(self.fitness):
+            #import ipdb; ipdb.set_trace()
+            pass
+        self.changed = False
+
     def _random_migration(self):
         """Return a migration of a random VM, to a random server at a random
         moment within the forecast horizon."""
@@ -117,6 +140,8 @@ class ScheduleUnit(Schedule):
 
         child2 = copy.copy(self) # TODO: better to create a new unit? state etc.
         child2.changed = True
+        # child2 starts like other, so it resumes from other's evaluation
+        child2.replay = getattr(other, 'replay', None)
         actions1 = other.actions[:t]
         justabit = pd.offsets.Micro(1)
         actions2 = self.actions[t + justabit:]
@@ -158,14 +183,152 @@ class ScheduleUnit(Schedule):
             #s += super(ScheduleUnit, self).__repr__()
         return s
 
-def create_random(environment, cloud, no_el_price=False, no_temperature=False):
-    """create a random unit"""
+class GenomeUnit(ScheduleUnit):
+    """A ScheduleUnit whose migrations are stored as a genome (see genome).
+    The genetic operators work on its gene arrays and the actions are decoded
+    only when needed - for the evaluation or the selected schedule (decode).
+
+    """
+
+    def __init__(self, encoding, genes=None):
+        super(GenomeUnit, self).__init__()
+        self.encoding = encoding
+        self.genes = genome.empty() if genes is None else genes
+
+    def __copy__(self):
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        return new
+
+    def __len__(self):
+        return len(self.genes)
+
+    def _get_genes(self):
+        return self._genes
+
+    def _set_genes(self, genes):
+        self._genes = genes
+        self._view = None
+
+    genes = property(_get_genes, _set_genes, doc="the genome's gene array")
+
+    def _get_actions(self):
+        if self._view is None:
+            self._view = self.encoding.decode(self.genes)
+        return self._view
+
+    def _set_actions(self, actions):
+        self.genes = self.encoding.encode(actions)
+
+    actions = property(_get_actions, _set_actions,
+                       doc="pandas view of the decoded actions")
+
+    def _period(self):
+        """The environment's period in ns (None if there is none)."""
+        try:
+            return pd.Timedelta(self.environment.period).value
+        except AttributeError:
+            return None
+
+    def add(self, action, t):
+        """Add a Migration like ArraySchedule.add.
+        Return True/False to indicate success."""
+        self.genes, added = genome.add_gene(
+            self.genes, self.encoding.gene(action, t), self._period())
+        return added
+
+    def filter_current_actions(self, t, period=None):
+        return Schedule.filter_current_actions(self, t, period)
+
+    def _random_gene(self):
+        """A migration of a random VM, to a random server at a random
+        moment within the forecast horizon."""
+        genes = genome.random_genes(
+            [1], self.environment.t, self.environment.forecast_end,
+            len(self.encoding.vms), len(self.encoding.servers))
+        return genes[0][0]
+
+    def _genes_of(self, other):
+        """The genes of other in this unit's encoding."""
+        if getattr(other, 'encoding', None) == self.encoding:
+            return other.genes
+        return self.encoding.encode(other.actions)
+
+    def mutation(self):
+        """Change the unit by changing a random gene."""
+        self.changed = True
+        new_unit = copy.copy(self)
+        random_gene = None
+        if len(self.encoding.vms) > 0:
+            random_gene = self._random_gene
+        new_unit.genes = genome.mutation(self.genes, random_gene,
+                                         self._period())
+        return new_unit
+
+    def crossover(self, other, t=None):
+        """Single-point crossover of both parent's genes."""
+        start = self.environment.t
+        end = self.environment.forecast_end
+        if not t:
+            t = random_time(start, end)
+        genes, genes2 = genome.crossover(self.genes, self._genes_of(other),
+                                         pd.Timestamp(t).value)
+        child = copy.copy(self)
+        child.changed = True
+        child.genes = genes
+        child2 = copy.copy(self)
+        child2.changed = True
+        # child2 starts like other, so it resumes from other's evaluation
+        child2.replay = getattr(other, 'replay', None)
+        child2.genes = genes2
+        return child, child2
+
+    def update(self):
+        """Update to match the new forecast horizon and the cloud's VMs.
+        Throw away old genes and those of non-existing VMs."""
+        encoding = genome.Encoding(self.cloud.vms, self.cloud.servers,
+                                   self.encoding.tz)
+        genes = self.genes
+        vms = np.array([encoding.vm_index(vm) for vm in self.encoding.vms],
+                       dtype=np.int32)[genes['vm']]
+        t = pd.Timestamp(self.environment.t).value
+        end = pd.Timestamp(self.environment.forecast_end).value
+        keep = (genes['t'] >= t) & (genes['t'] <= end) & (vms >= 0)
+        new_genes = genes[keep]
+        new_genes['vm'] = vms[keep]
+        self.encoding = encoding
+        self.genes = new_genes
+        if len(new_genes) != len(genes): # the unit has changed
+            self.changed = True
+
+    def decode(self):
+        """A ScheduleUnit with the decoded actions and the same settings
+        and fitness."""
+        unit = ScheduleUnit()
+        for name in ['changed', 'no_temperature', 'no_el_price', 'replay',
+                     'environment', 'cloud', 'evaluator', 'fitness',
+                     'rfitness', 'util', 'cost', 'constr', 'sla']:
+            if hasattr(self, name):
+                setattr(unit, name, getattr(self, name))
+        unit.actions = self.actions
+        return unit
+
+def create_random(environment, cloud, no_el_price=False, no_temperature=False,
+                  evaluator=None):
+    """create a random unit
+
+    @param evaluator: Evaluator to calculate the unit's fitness with
+    (the shared one if None)
+
+    """
     # TODO: maybe kick out migrations that make no sense
     unit = ScheduleUnit() # empty schedule unit
     unit.environment = environment
     unit.cloud = cloud
     unit.no_el_price = no_el_price
     unit.no_temperature = no_temperature
+    if evaluator is not None:
+        unit.evaluator = evaluator
     start = environment.t
     end = environment.forecast_end
     min_migrations = 0
@@ -191,6 +354,287 @@ def create_random(environment, cloud, no_el_price=False, no_temperature=False):
     unit.sort() # TODO: kick out duplicates/overrides like unit.add
     return unit
 
+def _decoded(unit):
+    """The unit as a ScheduleUnit (decoded if it is a GenomeUnit)."""
+    if isinstance(unit, GenomeUnit):
+        return unit.decode()
+    return unit
+
+def create_random_genomes(num_units, environment, cloud, no_el_price=False,
+                          no_temperature=False, evaluator=None):
+    """create num_units random GenomeUnits at once, with the same number of
+    migrations as create_random would give them
+
+    @param evaluator: Evaluator to calculate the units' fitness with
+    (the shared one if None)
+
+    """
+    start = environment.t
+    end = environment.forecast_end
+    encoding = genome.Encoding(cloud.vms, cloud.servers,
+                               pd.Timestamp(start).tz)
+    plan_duration = int((end - start).total_seconds() / 3600) # in hours
+    max_migrations = plan_duration * len(encoding.vms) // 3
+    num_genes = np.random.randint(0, max_migrations + 1, num_units)
+    units = []
+    for genes in genome.random_genes(num_genes, start, end,
+                                     len(encoding.vms),
+                                     len(encoding.servers)):
+        unit = GenomeUnit(encoding, genes)
+        unit.environment = environment
+        unit.cloud = cloud
+        unit.no_el_price = no_el_price
+        unit.no_temperature = no_temperature
+        if evaluator is not None:
+            unit.evaluator = evaluator
+        units.append(unit)
+    return units
+
+def _actions_digest(unit):
+    """Canonical hash of the unit's actions - the same for units with the
+    same actions at the same times, whatever the order of the simultaneous
+    actions on different VMs (or the encoding of their genes)."""
+    digest = hashlib.md5()
+    if isinstance(unit, GenomeUnit):
+        genes, encoding = unit.genes, unit.encoding
+        times = genes['t']
+        vm_ids = np.array([vm.id for vm in encoding.vms],
+                          dtype=np.int64)[genes['vm']]
+        server_ids = np.array([server.id for server in encoding.servers],
+                              dtype=np.int64)[genes['server']]
+    else:
+        actions = unit.actions
+        times = pd.DatetimeIndex(actions.index).asi8
+        if not all(type(action) is Migration for action in actions.values):
+            # other actions - hash their names and machines in time order
+            digest.update(repr([
+                (t, action.name, [str(arg) for arg in action.args])
+                for t, action in zip(times, actions.values)
+            ]))
+            return digest.hexdigest()
+        vm_ids = np.array([action.vm.id for action in actions.values],
+                          dtype=np.int64)
+        server_ids = np.array([action.server.id for action in actions.values],
+                              dtype=np.int64)
+    order = np.lexsort((vm_ids, times)) # stable for actions on the same VM
+    for values in [times, vm_ids, server_ids]:
+        digest.update(np.ascontiguousarray(values[order],
+                                           dtype=np.int64).view(np.uint8))
+    return digest.hexdigest()
+
+class FitnessMemo(object):
+    """The penalties of the units evaluated in one reevaluate call, keyed by
+    the canonical hash of their actions and the window, so that units with
+    the same actions as an already evaluated one (e.g. after a crossover of
+    similar parents or a window shift) are not evaluated again.
+
+    """
+
+    def __init__(self):
+        self._penalties = {} # key -> (penalties, replay)
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, unit):
+        return (unit.environment.t, unit.environment.forecast_end,
+                unit.cloud, unit.environment, unit.no_temperature,
+                getattr(unit, 'evaluator', None), _actions_digest(unit))
+
+    def split(self, units):
+        """Set the fitness of the changed units that were already evaluated.
+
+        @returns: key -> unit to evaluate (one per key), a list of
+        (key, unit) for the other units with the same keys
+
+        """
+        new, duplicates = OrderedDict(), []
+        for unit in units:
+            if not unit.changed:
+                continue
+            key = self._key(unit)
+            if key in self._penalties:
+                self.hits += 1
+                unit._set_fitness(*self._penalties[key])
+            elif key in new:
+                duplicates.append((key, unit))
+            else:
+                self.misses += 1
+                new[key] = unit
+        return new, duplicates
+
+    def update(self, new, duplicates=()):
+        """Remember the units evaluated after split and set the fitness of
+        their duplicates."""
+        for key, unit in new.iteritems():
+            self._penalties[key] = (
+                (unit.util, unit.cost, unit.constr, unit.sla), unit.replay)
+        for key, unit in duplicates:
+            self.hits += 1
+            unit._set_fitness(*self._penalties[key])
+
+def calculate_fitnesses(units, memo=None):
+    """Calculate the fitness of all the changed units. Units with the same
+    cloud, environment and evaluator are evaluated together, in one batch
+    (see Evaluator.evaluate_many).
+
+    @param memo: FitnessMemo to skip the units with already evaluated
+    actions
+
+    """
+    if memo is not None:
+        new, duplicates = memo.split(units)
+        units = new.values()
+    batches = OrderedDict()
+    for unit in units:
+        if unit.changed:
+            key = (getattr(unit, 'evaluator', None), unit.cloud,
+                   unit.environment, unit.no_temperature)
+            batches.setdefault(key, []).append(unit)
+    for (own_evaluator, cloud, environment, _), batch in batches.iteritems():
+        if own_evaluator is None: # use the shared one
+            evaluate_many = evaluator.evaluate_many
+        else:
+            evaluate_many = own_evaluator.evaluate_many
+        start, end, el_prices, temperature = batch[0]._evaluation_inputs()
+        results = evaluate_many(
+            cloud, environment, batch, el_prices, temperature, start, end,
+            [getattr(unit, 'replay', None) for unit in batch]
+        )
+        for unit, (penalties, replay) in zip(batch, results):
+            unit._set_fitness(penalties, replay)
+    if memo is not None:
+        memo.update(new, duplicates)
+
+# parallel fitness evaluation
+#------------------------------
+
+# evaluation context of a FitnessPool worker process
+_worker = None
+
+def _init_worker(cloud, vms, start, end, el_prices, temperature, full_util):
+    """Keep the window's evaluation context in the worker process."""
+    global _worker
+    own_evaluator = evaluator.Evaluator()
+    own_evaluator.full_util = full_util
+    _worker = (own_evaluator, cloud, vms, start, end, el_prices, temperature)
+
+def _evaluate_encoded(encoded_units):
+    """Evaluate the units encoded by FitnessPool._encode in the worker.
+
+    @returns: a list of penalty tuples - one per unit
+
+    """
+    own_evaluator, cloud, vms, start, end, el_prices, temperature = _worker
+    servers = cloud.servers
+    schedules = []
+    for times, vm_indices, server_indices in encoded_units:
+        index = pd.DatetimeIndex(times)
+        if start.tzinfo is not None:
+            index = index.tz_localize('UTC').tz_convert(start.tzinfo)
+        schedule = Schedule()
+        schedule.actions = pd.Series(
+            [Migration(vms[i], servers[j])
+             for i, j in zip(vm_indices, server_indices)],
+            index, name='actions'
+        )
+        schedules.append(schedule)
+    results = own_evaluator.evaluate_many(cloud, None, schedules, el_prices,
+                                          temperature, start, end)
+    return [penalties for penalties, _ in results]
+
+class FitnessPool(object):
+    """Worker processes that calculate the fitness of units for one
+    scheduling window. The cloud's real state and the window's inputs are
+    sent to the workers once, when they start - afterwards only the units'
+    actions, as arrays of times and VM and server indices.
+
+    The penalties are the same as with calculate_fitnesses, so for a fixed
+    seed the GA selects the same schedules.
+
+    """
+
+    def __init__(self, processes, cloud, environment, no_temperature=False,
+                 full_util=None):
+        self.processes = processes
+        self.cloud = cloud
+        self.environment = environment
+        self.no_temperature = no_temperature
+        vms = list(cloud.vms)
+        self._vm_index = {vm: i for i, vm in enumerate(vms)}
+        self._server_index = {server: i
+                              for i, server in enumerate(cloud.servers)}
+        start, end = environment.t, environment.forecast_end
+        el_prices, temperature = environment.current_data()
+        if no_temperature:
+            temperature = None
+        self._pool = multiprocessing.Pool(
+            processes, _init_worker,
+            (cloud.copy_real(), vms, start, end, el_prices, temperature,
+             full_util)
+        )
+
+    def _encode(self, unit):
+        """The unit's actions as arrays of times and VM and server indices
+        (None if it has other actions than migrations of the cloud's VMs).
+        """
+        actions = unit.actions
+        try:
+            vm_indices = np.array([self._vm_index[action.vm]
+                                   for action in actions.values
+                                   if type(action) is Migration], dtype=int)
+            server_indices = np.array([self._server_index[action.server]
+                                       for action in actions.values
+                                       if type(action) is Migration],
+                                      dtype=int)
+        except KeyError:
+            return None
+        if len(vm_indices) < len(actions):
+            return None
+        times = pd.DatetimeIndex(actions.index).asi8
+        return times, vm_indices, server_indices
+
+    def _in_window(self, unit):
+        """Whether the unit is evaluated for the pool's cloud and inputs."""
+        return (unit.cloud is self.cloud and
+                unit.environment is self.environment and
+                unit.no_temperature == self.no_temperature)
+
+    def calculate_fitnesses(self, units, memo=None):
+        """Calculate the fitness of all the changed units (like
+        calculate_fitnesses), splitting them evenly among the workers."""
+        if memo is not None:
+            new, duplicates = memo.split(units)
+            units = new.values()
+        local, remote, encoded = [], [], []
+        for unit in units:
+            if not unit.changed:
+                continue
+            encoding = None
+            if self._in_window(unit):
+                encoding = self._encode(unit)
+            if encoding is None:
+                local.append(unit)
+            else:
+                remote.append(unit)
+                encoded.append(encoding)
+        chunks = [list(chunk) for chunk in
+                  np.array_split(np.arange(len(remote)), self.processes)
+                  if len(chunk) > 0]
+        results = self._pool.map(_evaluate_encoded,
+                                 [[encoded[i] for i in chunk]
+                                  for chunk in chunks])
+        for chunk, chunk_penalties in zip(chunks, results):
+            for i, penalties in zip(chunk, chunk_penalties):
+                remote[i]._set_fitness(penalties, None)
+        calculate_fitnesses(local)
+        if memo is not None:
+            memo.update(new, duplicates)
+
+    def close(self):
+        """Stop the worker processes."""
+        self._pool.close()
+        self._pool.join()
+
 def roulette_selection(individuals, k):
     """Select *k* individuals from the input *individuals* using *k*
     spins of a roulette. The selection is made by at the rfitness attributes,
@@ -237,9 +681,21 @@ class GAScheduler(IScheduler):
         self.artificial_boot_ratio = 0.15
         self.no_temperature = False
         self.no_el_price = False
+        # worker processes for the fitness evaluation (0 - evaluate serially)
+        self.processes = 0
+        # evolve GenomeUnits (NumPy genes) instead of pandas-based units
+        self.genome = False
+        # stop earlier than max_generations (after min_generations) if
+        # reevaluate took time_budget seconds or the best fitness hasn't
+        # improved in stall_generations generations (None - no such limit)
+        self.time_budget = None
+        self.stall_generations = None
+        self.min_generations = 1
 
     def initialize(self):
-        evaluator.precreate_synth_power( # need this for efficient schedule eval
+        # own evaluator, so that its caches aren't shared with other schedulers
+        self.evaluator = evaluator.Evaluator()
+        self.evaluator.precreate_synth_power( # for efficient schedule eval
             self.environment.start, self.environment.end, self.cloud.servers
         )
         self.bcf = BCFScheduler()
@@ -255,24 +711,31 @@ class GAScheduler(IScheduler):
         try: # prepare old population for the new environment if it exists
             existing_population = self.population
         except AttributeError: # doesn't exist -> initial population generation
-            self.population = []
-            for i in range(self.population_size):
-                unit = create_random(self.environment, self.cloud,
-                                     self.no_el_price, self.no_temperature)
-                self.population.append(unit)
+            self.population = self._create_random(self.population_size)
         else:
-            new_random_units = []
             # randomly create self.num_random_recreate new units
-            for i in range(self.num_random_recreate):
-                unit = create_random(self.environment, self.cloud,
-                    self.no_el_price, self.no_temperature)
-                new_random_units.append(unit)
+            new_random_units = self._create_random(self.num_random_recreate)
             len_new = len(new_random_units)
             existing_population = existing_population[:-len_new]
             self.population = existing_population + new_random_units
             for unit in existing_population:
                 unit.update() # reusing old population, so "move window"
 
+    def _create_random(self, num_units):
+        """Create num_units random units."""
+        if self.genome:
+            return create_random_genomes(
+                num_units, self.environment, self.cloud, self.no_el_price,
+                self.no_temperature, self._unit_evaluator())
+        return [create_random(self.environment, self.cloud,
+                              self.no_el_price, self.no_temperature,
+                              self._unit_evaluator())
+                for i in range(num_units)]
+
+    def _unit_evaluator(self):
+        """The scheduler's own Evaluator (None before initialize)."""
+        return getattr(self, 'evaluator', None)
+
     def _artificially_add_boots(self, num_units):
         """Artificially add Migration actions to satisfy Boot requests to
         random units.
@@ -288,7 +751,28 @@ class GAScheduler(IScheduler):
                     unit.changed = True
 
     def _termination_condition(self):
-        return (self._iteration == self.max_generations)
+        if self._iteration >= self.max_generations:
+            return True
+        if self._iteration < self.min_generations:
+            return False
+        if (self.time_budget is not None and
+                time.time() - self._start_time >= self.time_budget):
+            debug('- time budget exhausted')
+            return True
+        if (self.stall_generations is not None and
+                self._stalled >= self.stall_generations):
+            debug('- no improvement in {} generations'.format(self._stalled))
+            return True
+        return False
+
+    def _track_improvement(self):
+        """Count the generations since the best fitness last improved."""
+        fitness = self.population[0].fitness
+        if fitness < self._best_fitness:
+            self._best_fitness = fitness
+            self._stalled = 0
+        else:
+            self._stalled += 1
 
     def _best_satisfies_constraints(self):
         """Best unit that satisfies hard constraints or None if none do."""
@@ -358,17 +842,29 @@ class GAScheduler(IScheduler):
         the fittest one.
 
         """
-        num_children = int(round(self.population_size *
-                                 self.recombination_rate))
-        num_mutation = int(round(self.population_size *self.mutation_rate))
+        self._start_generations()
+        while True: # get new generation
+            self._evaluate_generation()
+            # check termination condition
+            if self._termination_condition():
+                break
+            self._breed()
+        info('- GA ran {} generations in {:.2f}s'.format(
+            self._iteration, time.time() - self._start_time))
+        return self._select_best()
+
+    def _start_generations(self):
+        """Prepare the population and the counters for the generations."""
+        self._start_time = time.time()
+        self._num_children = int(round(self.population_size *
+                                       self.recombination_rate))
+        self._num_mutation = int(round(self.population_size *
+                                       self.mutation_rate))
         self.num_random_recreate = int(round(self.population_size *
                                              self.random_recreate_ratio))
         num_artificial_boot = int(round(self.population_size *
                                         self.artificial_boot_ratio))
 
-        start = self.environment.t
-        end = self.environment.forecast_end
-
         self._create_or_update_population()
 
         # if there are any new boot requests, artificially add them
@@ -376,49 +872,64 @@ class GAScheduler(IScheduler):
 
         # TODO: check for deleted VMs and remove these actions
 
-        # main loop TODO: split into smaller functions
         self._iteration = 0
-        while True: # get new generation
-            # calculate fitness
-            for unit in self.population:
-                unit.calculate_fitness()
-
-            self._iteration += 1
-            debug('- generation {}'.format(self._iteration))
-
-            self.population.sort(key=lambda u : u.fitness, reverse=False)
-            debug('  - best fitness: {}'.format(self.population[0].fitness))
-            debug('  - wrst {}'.format(repr(self.population[-1])))
-            debug('  - best {}'.format(repr(self.population[0])))
-            #if self.population[0].fitness == 0.06:
-            #    import ipdb; ipdb.set_trace()
-
-            # check termination condition
-            if self._termination_condition():
-                break
-
-            # recombination
-            # TODO: generate two children from one pair
-            # choose parents weight. among all
-            parents = roulette_selection(self.population, num_children)
-            children = []
-            for j in range(num_children / 2):
-                parent1, parent2 = parents[j], parents[j + 1]
-                child, child2 = parent1.crossover(parent2)
-                children.append(child)
-                children.append(child2)
-            # new generation
-            self.population = self.population[:-num_children] + children
-            # mutation
-            for unit in random.sample(self.population, num_mutation):
-                unit = unit.mutation()
+        self._best_fitness, self._stalled = float('inf'), 0
+        # units with the same actions are evaluated once
+        self._memo = FitnessMemo()
+
+    def _evaluate_generation(self):
+        """Calculate the fitness of the population and sort it, fittest
+        first."""
+        memo = self._memo
+        pool = getattr(self, 'pool', None)
+        if pool is None:
+            calculate_fitnesses(self.population, memo)
+        else:
+            pool.calculate_fitnesses(self.population, memo)
+
+        self._iteration += 1
+        debug('- generation {}'.format(self._iteration))
+
+        self.population.sort(key=lambda u : u.fitness, reverse=False)
+        debug('  - best fitness: {}'.format(self.population[0].fitness))
+        debug('  - wrst {}'.format(repr(self.population[-1])))
+        debug('  - best {}'.format(repr(self.population[0])))
+        debug('  - fitness memo: {} hits, {} misses'.format(memo.hits,
+                                                            memo.misses))
+        #if self.population[0].fitness == 0.06:
+        #    import ipdb; ipdb.set_trace()
+        self._track_improvement()
+
+    def _breed(self):
+        """Replace the worst units with the children of parents chosen by
+        roulette selection and mutate random units."""
+        num_children = self._num_children
+        # recombination
+        # TODO: generate two children from one pair
+        # choose parents weight. among all
+        parents = roulette_selection(self.population, num_children)
+        children = []
+        for j in range(num_children / 2):
+            parent1, parent2 = parents[j], parents[j + 1]
+            child, child2 = parent1.crossover(parent2)
+            children.append(child)
+            children.append(child2)
+        # new generation
+        self.population = self.population[:-num_children] + children
+        # mutation
+        for unit in random.sample(self.population, self._num_mutation):
+            unit = unit.mutation()
+
+    def _select_best(self):
+        """The fittest unit of the (sorted) population as a ScheduleUnit,
+        fixed greedily if configured."""
         if self.greedy_constraint_fix:
             # first try to get best that satisfies hard constraints
             best = self._best_satisfies_constraints()
             if best is None or self.always_greedy_fix:
                 # none satisfy hard constraints or we always fix
                 debug('- greedy constraint fix')
-                best = self.population[0]
+                best = _decoded(self.population[0])
                 self.cloud.reset_to_real()
                 self._add_boot_actions_greedily(best)
                 self.cloud.reset_to_real()
@@ -426,6 +937,7 @@ class GAScheduler(IScheduler):
                 best.calculate_fitness()
         else:
             best = self.population[0]
+        best = _decoded(best)
         debug(u' \u2502\n \u2514\u2500\u25BA selected {}'.format(repr(best)))
         # debug unallocated VMs
         if best.constr > 0:
@@ -434,9 +946,24 @@ class GAScheduler(IScheduler):
             pass
         return best
 
+    def _create_pool(self):
+        """Start the worker processes for this window (if configured)."""
+        if not self.processes:
+            return None
+        return FitnessPool(
+            self.processes, self.cloud, self.environment, self.no_temperature,
+            getattr(self._unit_evaluator(), 'full_util', None)
+        )
+
     def reevaluate(self):
         debug('\nREEVALUATE (t={})\n---------------'.format(self.environment.t))
-        return self.genetic_algorithm()
+        self.pool = self._create_pool()
+        try:
+            return self.genetic_algorithm()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+            self.pool = None
 
     def debug_population(self):
         self.population.reverse()
@@ -0,0 +1,178 @@
+"""GA genomes - schedules of migrations encoded as NumPy arrays of genes
+(time in ns, VM index, server index), sorted by time. The genetic operators
+work on whole arrays, so that large populations can be generated and evolved
+quickly. The genes are decoded into actions only when they are needed
+(e.g. for the evaluation or the selected schedule).
+
+Gene arrays are never modified in place - the operators return new ones.
+
+"""
+
+import random
+
+import pandas as pd
+import numpy as np
+
+from philharmonic import Schedule, Migration
+
+gene_dtype = np.dtype([('t', np.int64), ('vm', np.int32),
+                       ('server', np.int32)])
+
+HOUR = 3600 * 10**9 # in ns
+
+def empty():
+    """A genome without genes."""
+    return np.empty(0, dtype=gene_dtype)
+
+class Encoding(object):
+    """Maps between genes and Migration actions for a list of VMs and
+    servers (and the timezone of the times).
+
+    """
+
+    def __init__(self, vms, servers, tz=None):
+        self.vms = list(vms)
+        self.servers = list(servers)
+        self.tz = tz
+        self._vm_index = {vm: i for i, vm in enumerate(self.vms)}
+        self._server_index = {server: i
+                              for i, server in enumerate(self.servers)}
+        self._migrations = {} # (vm index, server index) -> Migration
+
+    def __eq__(self, other):
+        return (self is other or
+                isinstance(other, Encoding) and self.tz == other.tz and
+                self.vms == other.vms and self.servers == other.servers)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def vm_index(self, vm):
+        """Index of the VM in the genes (-1 if it isn't encoded)."""
+        return self._vm_index.get(vm, -1)
+
+    def gene(self, action, t):
+        """The gene of a Migration action at time t."""
+        gene = np.empty(1, dtype=gene_dtype)
+        gene['t'] = pd.Timestamp(t).value
+        gene['vm'] = self._vm_index[action.vm]
+        gene['server'] = self._server_index[action.server]
+        return gene[0]
+
+    def encode(self, actions):
+        """Genes of a time series of Migration actions."""
+        genes = np.empty(len(actions), dtype=gene_dtype)
+        if len(actions) == 0:
+            return genes
+        if any(type(action) is not Migration for action in actions.values):
+            raise ValueError('only migrations can be encoded')
+        genes['t'] = pd.DatetimeIndex(actions.index).asi8
+        genes['vm'] = [self._vm_index[action.vm]
+                       for action in actions.values]
+        genes['server'] = [self._server_index[action.server]
+                           for action in actions.values]
+        return genes[np.argsort(genes['t'], kind='mergesort')]
+
+    def _migration(self, vm, server):
+        try:
+            return self._migrations[vm, server]
+        except KeyError:
+            action = Migration(self.vms[vm], self.servers[server])
+            self._migrations[vm, server] = action
+            return action
+
+    def decode(self, genes):
+        """Time series of the Migration actions of the genes."""
+        if len(genes) == 0:
+            return pd.Series(name='actions')
+        values = np.empty(len(genes), dtype=object)
+        values[:] = [self._migration(vm, server) for vm, server
+                     in zip(genes['vm'], genes['server'])]
+        index = pd.DatetimeIndex(genes['t'])
+        if self.tz is not None:
+            index = index.tz_localize('UTC').tz_convert(self.tz)
+        return pd.Series(values, index, name='actions')
+
+    def schedule(self, genes):
+        """A Schedule with the decoded actions of the genes."""
+        schedule = Schedule()
+        schedule.actions = self.decode(genes)
+        return schedule
+
+def random_times(num, start, end):
+    """num random times in ns between start & end, rounded to a full hour
+    (like random_time)."""
+    start = pd.Timestamp(start)
+    delta = (pd.Timestamp(end) - start).total_seconds()
+    offsets = np.random.uniform(0., delta, num).astype(np.int64) * 10**9
+    times = start.value + offsets
+    return times - times % HOUR
+
+def random_genes(num_genes, start, end, num_vms, num_servers):
+    """Random genomes with num_genes[i] genes each - migrations of random
+    VMs to random servers at random times between start & end, all
+    generated at once.
+
+    @returns: a list of gene arrays
+
+    """
+    num_genes = np.asarray(num_genes, dtype=int)
+    total = num_genes.sum()
+    genes = np.empty(total, dtype=gene_dtype)
+    if total > 0:
+        genes['t'] = random_times(total, start, end)
+        genes['vm'] = np.random.randint(0, num_vms, total)
+        genes['server'] = np.random.randint(0, num_servers, total)
+    owners = np.repeat(np.arange(len(num_genes)), num_genes)
+    genes = genes[np.lexsort((genes['t'], owners))] # stable
+    return np.split(genes, np.cumsum(num_genes)[:-1])
+
+def crossover(genes1, genes2, t):
+    """Single-point crossover at time t (in ns): the first child has the
+    genes of genes1 up to and including t and those of genes2 after t,
+    the second child vice versa."""
+    i1 = np.searchsorted(genes1['t'], t, side='right')
+    i2 = np.searchsorted(genes2['t'], t, side='right')
+    child1 = np.concatenate([genes1[:i1], genes2[i2:]])
+    child2 = np.concatenate([genes2[:i2], genes1[i1:]])
+    return child1, child2
+
+def add_gene(genes, gene, period=None):
+    """Add a gene like ArraySchedule.add adds an action: migrations of the
+    same VM within period (in ns) after the gene's time are superseded by it,
+    unless it is already there.
+
+    @returns: the new genes, whether the gene was added
+
+    """
+    if period is not None:
+        same_vm = genes['vm'] == gene['vm']
+        window = (same_vm & (genes['t'] >= gene['t']) &
+                  (genes['t'] <= gene['t'] + period - 1000))
+        servers = genes['server'][window]
+        equal = np.flatnonzero(servers == gene['server'])
+        superseded = servers[:equal[0]] if len(equal) > 0 else servers
+        if len(superseded) > 0:
+            genes = genes[~(same_vm & np.in1d(genes['server'], superseded))]
+        if len(equal) > 0:
+            return genes, False
+    i = np.searchsorted(genes['t'], gene['t'], side='right')
+    return np.insert(genes, i, gene), True
+
+def mutation(genes, random_gene=None, period=None, max_tries=3):
+    """Replace a random gene with a new one from random_gene() (if given),
+    trying up to max_tries times to add a gene different from the removed
+    one."""
+    removed = None
+    if len(genes) > 0:
+        i = random.randint(0, len(genes) - 1)
+        removed = genes[i]
+        genes = np.delete(genes, i)
+    if random_gene is None:
+        return genes
+    for tries in range(max_tries):
+        gene = random_gene()
+        genes, added = add_gene(genes, gene, period)
+        if added and (removed is None or gene != removed):
+            break
+    return genes
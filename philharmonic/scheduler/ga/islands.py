@@ -0,0 +1,205 @@
+"""Island model genetic algorithm - several populations evolve in separate
+processes and every few generations the fittest units of each island
+migrate to the next one (in a ring).
+
+"""
+
+import multiprocessing
+import random
+import time
+import traceback
+
+import pandas as pd
+import numpy as np
+
+from philharmonic.logger import *
+from philharmonic.scheduler.ga import genome
+from philharmonic.scheduler.ga.gascheduler import (GAScheduler, ScheduleUnit,
+                                                   GenomeUnit)
+
+def _pack(unit, encoding):
+    """The unit's genes in encoding and its penalties (None if it isn't
+    evaluated) - to send it to another process."""
+    if isinstance(unit, GenomeUnit) and unit.encoding == encoding:
+        genes = unit.genes
+    else:
+        genes = encoding.encode(unit.actions)
+    penalties = None
+    if not unit.changed:
+        penalties = (unit.util, unit.cost, unit.constr, unit.sla)
+    return genes, penalties
+
+class _IslandFailure(object):
+    """Sent by an island instead of its next message when it raised an
+    exception."""
+
+    def __init__(self, exception, formatted_traceback):
+        self.exception = exception
+        self.traceback = formatted_traceback
+
+def _island(scheduler, index, seed, connection):
+    """Run _evolve_island, sending an _IslandFailure to the coordinator if it
+    raises."""
+    try:
+        _evolve_island(scheduler, index, seed, connection)
+    except Exception as e:
+        failure = _IslandFailure(e, traceback.format_exc())
+        try:
+            connection.send(failure)
+        except Exception: # e.g. the exception cannot be pickled
+            failure.exception = RuntimeError(repr(e))
+            connection.send(failure)
+    finally:
+        connection.close()
+
+def _evolve_island(scheduler, index, seed, connection):
+    """Evolve island index of the (forked) scheduler, sending its fittest
+    units to the coordinator and receiving the immigrants every
+    migration_interval generations. Finally send the generations run and
+    the whole population."""
+    random.seed(seed)
+    np.random.seed(seed)
+    scheduler.pool = None # the islands are the processes
+    population = scheduler._island_populations[index]
+    if population is not None:
+        scheduler.population = population
+    elif hasattr(scheduler, 'population'):
+        del scheduler.population
+    encoding = scheduler._encoding
+    scheduler._start_generations()
+    while True:
+        scheduler._evaluate_generation()
+        stop = scheduler._termination_condition()
+        if stop or scheduler._migration_due():
+            emigrants = scheduler.population[:scheduler.migration_size]
+            connection.send((stop, [_pack(unit, encoding)
+                                    for unit in emigrants]))
+            immigrants = connection.recv()
+            if immigrants is None: # stop
+                break
+            scheduler._receive(immigrants)
+        scheduler._breed()
+    connection.send((scheduler._iteration,
+                     [_pack(unit, encoding) for unit in scheduler.population]))
+
+class IslandGAScheduler(GAScheduler):
+    """Genetic algorithm scheduler with several populations (islands) that
+    evolve in separate processes, like the GAScheduler population does.
+    Every migration_interval generations, the migration_size fittest units
+    of each island replace the worst units of the next island. The selected
+    schedule is the global best (constraint satisfying units first).
+
+    """
+
+    def __init__(self, cloud=None, driver=None):
+        GAScheduler.__init__(self, cloud, driver)
+        self.islands = 4
+        self.migration_interval = 5 # generations
+        self.migration_size = 2 # units sent to the next island
+
+    def _migration_due(self):
+        return (bool(self.migration_interval) and
+                self._iteration % self.migration_interval == 0)
+
+    def _unpack(self, packed):
+        """A unit of this process from a _pack result."""
+        genes, penalties = packed
+        if self.genome:
+            unit = GenomeUnit(self._encoding, genes)
+        else:
+            unit = ScheduleUnit()
+            unit.actions = self._encoding.decode(genes)
+        unit.environment = self.environment
+        unit.cloud = self.cloud
+        unit.no_el_price = self.no_el_price
+        unit.no_temperature = self.no_temperature
+        evaluator = self._unit_evaluator()
+        if evaluator is not None:
+            unit.evaluator = evaluator
+        if penalties is not None:
+            unit._set_fitness(penalties, None)
+        return unit
+
+    def _receive(self, immigrants):
+        """Replace the worst units with the (evaluated) immigrants."""
+        if len(immigrants) == 0:
+            return
+        units = [self._unpack(packed) for packed in immigrants]
+        self.population = self.population[:-len(units)] + units
+        self.population.sort(key=lambda u : u.fitness, reverse=False)
+
+    def _recv(self, connections, i):
+        """The next message of island i - re-raise its exception if it
+        failed."""
+        try:
+            message = connections[i].recv()
+        except EOFError:
+            raise RuntimeError('island {} exited unexpectedly'.format(i))
+        if isinstance(message, _IslandFailure):
+            error('- island {} failed:\n{}'.format(i, message.traceback))
+            raise message.exception
+        return message
+
+    def island_algorithm(self):
+        """Evolve the islands in their processes, coordinating the
+        migrations, and find the fittest unit among them."""
+        start_time = time.time()
+        self._encoding = genome.Encoding(
+            self.cloud.vms, self.cloud.servers,
+            pd.Timestamp(self.environment.t).tz)
+        populations = getattr(self, '_island_populations', [])
+        populations = (populations + [None] * self.islands)[:self.islands]
+        self._island_populations = populations
+        seeds = [random.randint(0, 2**31 - 1) for i in range(self.islands)]
+        connections, processes = [], []
+        for i, seed in enumerate(seeds):
+            connection, island_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_island, args=(self, i, seed, island_connection))
+            process.daemon = True
+            process.start()
+            island_connection.close() # only the island's end stays open
+            connections.append(connection)
+            processes.append(process)
+        try:
+            emigrants = [[] for i in range(self.islands)]
+            active = list(range(self.islands))
+            while active:
+                stopped = []
+                for i in active:
+                    stop, emigrants[i] = self._recv(connections, i)
+                    if stop:
+                        stopped.append(i)
+                for i in active:
+                    previous = (i - 1) % self.islands
+                    if i in stopped:
+                        connections[i].send(None)
+                    elif previous in active: # sent emigrants in this round
+                        connections[i].send(emigrants[previous])
+                    else: # the previous island in the ring has stopped
+                        connections[i].send([])
+                active = [i for i in active if i not in stopped]
+            results = [self._recv(connections, i)
+                       for i in range(self.islands)]
+        finally:
+            for process in processes:
+                if process.is_alive(): # e.g. after another island failed
+                    process.terminate()
+                process.join()
+        generations = [iterations for iterations, packed in results]
+        self._island_populations = [
+            [self._unpack(unit) for unit in packed]
+            for iterations, packed in results
+        ]
+        info('- island GA ran {} generations in {:.2f}s'.format(
+            generations, time.time() - start_time))
+        # the global best - the fittest unit that satisfies the hard
+        # constraints (like _best_satisfies_constraints), else the fittest
+        self.population = [unit for population in self._island_populations
+                           for unit in population]
+        self.population.sort(key=lambda u : (u.constr > 0, u.fitness))
+        return self._select_best()
+
+    def reevaluate(self):
+        debug('\nREEVALUATE (t={})\n---------------'.format(self.environment.t))
+        return self.island_algorithm()
@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 from nose.tools import *
+import random
+import time
 
+import numpy as np
 import pandas as pd
 from mock import MagicMock, patch
 
@@ -10,6 +13,7 @@ from philharmonic import VM, Server, Cloud, Migration, VMRequest
 from philharmonic.simulator.environment import GASimpleSimulatedEnvironment
 from philharmonic.simulator import inputgen
 from philharmonic.scheduler import evaluator
+from philharmonic.scheduler.tests.test_evaluator import _reference_penalties
 
 def test_fitness():
     unit = ScheduleUnit()
@@ -205,6 +209,48 @@ def test_crossover():
                 '1st half one parent')
     assert_equals(len(child2.actions[1:]), 0, '2nd half other parent')
 
+def test_crossover_resumes_parent_evaluation():
+    vm1 = VM(4,2)
+    vm2 = VM(4,2)
+    server1 = Server(8,4, location="A")
+    server2 = Server(8,4, location="B")
+    cloud = Cloud([server1, server2], set([vm1, vm2]), auto_allocate=False)
+
+    times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
+    t1 = pd.Timestamp('2013-02-25 00:00')
+    t2 = pd.Timestamp('2013-02-25 13:00')
+    t3 = pd.Timestamp('2013-02-25 20:00')
+    env = GASimpleSimulatedEnvironment(times, forecast_periods=24)
+    env.t = t1
+    env.el_prices = inputgen.simple_el()
+    env.temperature = inputgen.simple_temperature()
+    evaluator.precreate_synth_power(env.start, env.end, cloud.servers)
+
+    units = []
+    for actions in [[Migration(vm1, server1), Migration(vm2, server1),
+                     Migration(vm2, server2)],
+                    [Migration(vm1, server2), Migration(vm2, server2),
+                     Migration(vm1, server1)]]:
+        unit = ScheduleUnit()
+        unit.cloud = cloud
+        unit.environment = env
+        unit.actions = pd.Series(actions, [t1, t2, t3])
+        unit.calculate_fitness()
+        units.append(unit)
+
+    child, child2 = units[0].crossover(units[1], t=t2)
+    assert_true(child.replay is units[0].replay)
+    assert_true(child2.replay is units[1].replay)
+    for unit in [child, child2]:
+        fresh = ScheduleUnit()
+        fresh.cloud = cloud
+        fresh.environment = env
+        fresh.actions = unit.actions
+        assert_equals(unit.calculate_fitness(), fresh.calculate_fitness())
+    # the states up to the crossover point were reused
+    assert_true(child.replay.states[1] is units[0].replay.states[1])
+    assert_true(child2.replay.states[1] is units[1].replay.states[1])
+
 def test_create_random():
     times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
     env = GASimpleSimulatedEnvironment(times, forecast_periods=24)
@@ -220,6 +266,96 @@ def test_create_random():
     unit = create_random(env, cloud)
     assert_is_instance(unit, ScheduleUnit)
 
+def test_calculate_fitnesses():
+    times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
+    env = GASimpleSimulatedEnvironment(times, forecast_periods=24)
+    env.t = pd.Timestamp('2013-02-25 00:00')
+    env.el_prices = inputgen.simple_el()
+    env.temperature = inputgen.simple_temperature()
+    vms = [VM(4,2) for i in range(3)]
+    servers = [Server(8,4, location="A"), Server(8,4, location="B")]
+    cloud = Cloud(servers, set(vms), auto_allocate=False)
+    ev = evaluator.Evaluator()
+    ev.precreate_synth_power(env.start, env.end, servers)
+
+    server_a, server_b = servers
+    t1 = pd.Timestamp('2013-02-25 03:00')
+    t2 = pd.Timestamp('2013-02-25 09:00')
+    # no server over capacity (see _reference_penalties)
+    schedules = [
+        [(t1, Migration(vms[0], server_a))],
+        [(t1, Migration(vms[0], server_a)), (t1, Migration(vms[1], server_b))],
+        [(t1, Migration(vms[0], server_a)), (t1, Migration(vms[1], server_a)),
+         (t2, Migration(vms[2], server_b))],
+        [(t1, Migration(vms[0], server_a)), (t1, Migration(vms[1], server_a)),
+         (t2, Migration(vms[2], server_b)), (t2, Migration(vms[0], server_b))],
+    ]
+    population = []
+    for schedule in schedules:
+        unit = create_random(env, cloud, evaluator=ev)
+        times, actions = zip(*schedule)
+        unit.actions = pd.Series(actions, times)
+        unit.changed = True
+        population.append(unit)
+    population[0].no_temperature = True # evaluated in a separate batch
+    gascheduler.calculate_fitnesses(population)
+    for unit in population:
+        assert_false(unit.changed)
+        start, end, el_prices, temperature = unit._evaluation_inputs()
+        expected = _reference_penalties(cloud, env, unit, el_prices,
+                                        temperature, start, end)
+        penalties = (unit.util, unit.cost, unit.constr, unit.sla)
+        for value, expected_value in zip(penalties, expected):
+            assert_almost_equals(value, expected_value)
+
+def test_calculate_fitnesses_memo():
+    times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
+    env = GASimpleSimulatedEnvironment(times, forecast_periods=24)
+    env.t = pd.Timestamp('2013-02-25 00:00')
+    env.el_prices = inputgen.simple_el()
+    env.temperature = inputgen.simple_temperature()
+    vm1, vm2 = VM(4,2), VM(4,2)
+    server1, server2 = Server(8,4, location="A"), Server(8,4, location="B")
+    cloud = Cloud([server1, server2], set([vm1, vm2]), auto_allocate=False)
+    ev = evaluator.Evaluator()
+    ev.precreate_synth_power(env.start, env.end, cloud.servers)
+
+    t1 = pd.Timestamp('2013-02-25 03:00')
+    t2 = pd.Timestamp('2013-02-25 09:00')
+    same = [[Migration(vm1, server1), Migration(vm2, server2)],
+            [Migration(vm2, server2), Migration(vm1, server1)]] # reordered
+    units = []
+    for actions in same + [[Migration(vm1, server2), Migration(vm2, server2)]]:
+        unit = create_random(env, cloud, evaluator=ev)
+        unit.actions = pd.Series(actions, [t1, t1])
+        units.append(unit)
+    genome_unit = gascheduler.create_random_genomes(1, env, cloud,
+                                                    evaluator=ev)[0]
+    genome_unit.actions = units[0].actions
+    units.append(genome_unit)
+
+    memo = gascheduler.FitnessMemo()
+    with patch.object(ev, 'evaluate_many', wraps=ev.evaluate_many) as ev_many:
+        gascheduler.calculate_fitnesses(units, memo)
+        assert_equals(sum(len(call[0][2]) for call in ev_many.call_args_list),
+                      2, 'only the distinct schedules evaluated')
+    assert_equals((memo.hits, memo.misses), (2, 2))
+    for unit in units:
+        assert_false(unit.changed)
+    assert_equals(units[0].fitness, units[1].fitness)
+    assert_equals(units[0].fitness, units[3].fitness)
+
+    # evaluated in an earlier generation
+    unit = create_random(env, cloud, evaluator=ev)
+    unit.actions = units[2].actions
+    gascheduler.calculate_fitnesses([unit], memo)
+    assert_equals((memo.hits, memo.misses), (3, 2))
+    assert_equals(unit.fitness, units[2].fitness)
+    unit.actions = pd.Series(same[0], [t1, t2]) # different times
+    unit.changed = True
+    gascheduler.calculate_fitnesses([unit], memo)
+    assert_equals((memo.hits, memo.misses), (3, 3))
+
 def test_best_satisfies_constraints():
     rfitnesses = [0.5, 1, 0.7]
     constraint_penalties = [0, 0.3, 0]
@@ -279,6 +415,52 @@ def test_best_satisfies_constraints_none():
     best = scheduler._best_satisfies_constraints()
     assert_is(best, None)
 
+def test_termination_condition():
+    scheduler = GAScheduler()
+    scheduler.max_generations = 10
+    scheduler._start_time = time.time()
+    scheduler._iteration, scheduler._stalled = 3, 5
+    assert_false(scheduler._termination_condition(), 'no early stop')
+    scheduler.stall_generations = 5
+    assert_true(scheduler._termination_condition(), 'stalled')
+    scheduler.min_generations = 4
+    assert_false(scheduler._termination_condition(), 'too few generations')
+    scheduler._iteration = 4
+    assert_true(scheduler._termination_condition())
+    scheduler.stall_generations = None
+    scheduler.time_budget = 60.
+    assert_false(scheduler._termination_condition(), 'within the budget')
+    scheduler._start_time -= 60.
+    assert_true(scheduler._termination_condition(), 'over the budget')
+    scheduler.time_budget = None
+    scheduler._iteration = 10
+    assert_true(scheduler._termination_condition(), 'max generations')
+
+def test_gascheduler_stall():
+    vms = [VM(4,2) for i in range(3)]
+    servers = [Server(8,4, location="A"), Server(8,4, location="B")]
+    cloud = Cloud(servers, set(vms), auto_allocate=False)
+    times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
+    env = GASimpleSimulatedEnvironment(times, forecast_periods=24)
+    env.t = times[0]
+    env.el_prices = inputgen.simple_el()
+    env.temperature = inputgen.simple_temperature()
+    env.get_requests = MagicMock(return_value=[])
+
+    scheduler = GAScheduler()
+    scheduler.population_size = 6
+    scheduler.max_generations = 1000
+    scheduler.stall_generations = 3
+    scheduler.min_generations = 5
+    scheduler.greedy_constraint_fix = False
+    scheduler.cloud = cloud
+    scheduler.environment = env
+    scheduler.initialize()
+    best = scheduler.reevaluate()
+    assert_true(5 <= scheduler._iteration < 1000)
+    assert_true(scheduler._stalled >= 3)
+    assert_equals(best.fitness, scheduler._best_fitness, 'best so far')
+
 def test_add_boot_actions_greedily():
     # some servers
     s1 = Server(4000, 8, location='A')
@@ -404,7 +586,6 @@ def test_add_boot_actions_greedily_some_vms_scheduled():
 
     # TODO: check this test - not sure if it's right after the refactoring
     marked_not_in = VMRequest(vm2, 'boot')
-    marked_not_in.TEST_marked_not_in = True
     reqs = [VMRequest(vm1, 'boot'), marked_not_in,
             VMRequest(vm3, 'boot')]
     times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
@@ -422,7 +603,6 @@ def test_add_boot_actions_greedily_some_vms_scheduled():
     unit = ScheduleUnit()
     unit.environment = environment
     marked_req = Migration(vm2, s1)
-    marked_req.TEST_marked = True
     unit.add(marked_req, environment.t) # also in request for this VM
     unit.add(Migration(vm3, s1), environment.t)
     for action in unit.actions:
@@ -430,10 +610,8 @@ def test_add_boot_actions_greedily_some_vms_scheduled():
     #import ipdb; ipdb.set_trace()
     scheduler._add_boot_actions_greedily(unit)
     expected_action_vms = set([action.vm for action in reqs])
-    assert_true(any(hasattr(act, 'TEST_marked') for act in unit.actions.values))
-    assert_false(
-        any(hasattr(act, 'TEST_marked_not_in') for act in unit.actions.values)
-    )
+    assert_true(any(act is marked_req for act in unit.actions.values))
+    assert_false(any(act is marked_not_in for act in unit.actions.values))
 
 def test_gascheduler():
     # cloud
@@ -512,6 +690,103 @@ def test_gascheduler_two_times(): # multiple reevaluation calls
     assert_not_in(vm2, set(act.vm for act in schedule2.actions),
                   'no actions for deleted VMs in the updated schedule')
 
+def test_gascheduler_genome(): # GenomeUnits, multiple reevaluation calls
+    vm1 = VM(4,2)
+    vm2 = VM(4,2)
+    server1 = Server(8,4, location="A")
+    server2 = Server(8,4, location="B")
+    cloud = Cloud([server1, server2], set([vm1, vm2]), auto_allocate=False)
+    times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
+    env = GASimpleSimulatedEnvironment(times, forecast_periods=20)
+    env.t = times[0]
+    env.el_prices = inputgen.simple_el()
+    env.temperature = inputgen.simple_temperature()
+    env.get_requests = MagicMock(return_value=[])
+
+    scheduler = GAScheduler()
+    scheduler.population_size = 6
+    scheduler.recombination_rate = 0.4
+    scheduler.mutation_rate = 0.18
+    scheduler.greedy_constraint_fix = True
+    scheduler.always_greedy_fix = False
+    scheduler.genome = True
+    scheduler.cloud = cloud
+    scheduler.environment = env
+    scheduler.initialize()
+    schedule1 = scheduler.reevaluate()
+    assert_is_instance(scheduler.population[0], gascheduler.GenomeUnit)
+    assert_not_is_instance(schedule1, gascheduler.GenomeUnit)
+
+    env.t = pd.Timestamp('2013-02-25 17:00')
+    vm3 = VM(4,2)
+    cloud.apply_real(VMRequest(vm2, 'delete'))
+    cloud.apply_real(VMRequest(vm3, 'boot'))
+    scheduler._create_or_update_population()
+    for unit in scheduler.population:
+        assert_true(len(unit.actions[:'2013-02-25 16:00']) == 0,
+                    'no outdated actions in the updated units')
+        assert_not_in(vm2, set(act.vm for act in unit.actions),
+                      'no actions for deleted VMs in the updated units')
+    schedule2 = scheduler.reevaluate()
+    assert_not_in(vm2, set(act.vm for act in schedule2.actions))
+
+def test_genome_unit_crossover(): # like the ScheduleUnit crossover
+    vms = [VM(4,2) for i in range(3)]
+    servers = [Server(8,4, location="A"), Server(8,4, location="B")]
+    cloud = Cloud(servers, set(vms), auto_allocate=False)
+    times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
+    env = GASimpleSimulatedEnvironment(times, forecast_periods=24)
+    env.t = times[0]
+    env.el_prices = inputgen.simple_el()
+    env.temperature = inputgen.simple_temperature()
+    evaluator.precreate_synth_power(env.start, env.end, cloud.servers)
+
+    parents = gascheduler.create_random_genomes(2, env, cloud)
+    t = pd.Timestamp('2013-02-25 10:00')
+    children = parents[0].crossover(parents[1], t=t)
+    for parent, other, child in [parents + [children[0]],
+                                 parents[::-1] + [children[1]]]:
+        unit = ScheduleUnit()
+        unit.cloud = cloud
+        unit.environment = env
+        unit.actions = parent.actions
+        expected = unit.crossover(other, t=t)[0]
+        assert_true(child.changed)
+        assert_true(child.actions.equals(expected.actions))
+        assert_almost_equals(child.calculate_fitness(),
+                             expected.calculate_fitness())
+        assert_true(child.decode().actions.equals(child.actions))
+
+def test_gascheduler_processes(): # same selection as the serial evaluation
+    vms = [VM(4,2) for i in range(4)]
+    servers = [Server(8,4, location="A"), Server(8,4, location="B")]
+    cloud = Cloud(servers, set(vms), auto_allocate=False)
+    times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
+    env = GASimpleSimulatedEnvironment(times, forecast_periods=24)
+    env.t = times[0]
+    env.el_prices = inputgen.simple_el()
+    env.temperature = inputgen.simple_temperature()
+    env.get_requests = MagicMock(return_value=[])
+
+    selected = []
+    for processes in [0, 2]:
+        random.seed(7)
+        np.random.seed(7)
+        scheduler = GAScheduler()
+        scheduler.population_size = 8
+        scheduler.recombination_rate = 0.4
+        scheduler.mutation_rate = 0.18
+        scheduler.greedy_constraint_fix = False
+        scheduler.processes = processes
+        scheduler.cloud = cloud
+        scheduler.environment = env
+        scheduler.initialize()
+        best = scheduler.reevaluate()
+        assert_is_none(scheduler.pool) # the workers were stopped
+        selected.append((best.fitness, list(best.actions.index),
+                         list(best.actions.values)))
+    assert_equals(selected[0], selected[1])
+
 # TODO
 def test_update():
     pass
@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+from nose.tools import *
+
+import numpy as np
+import pandas as pd
+from mock import MagicMock
+
+from philharmonic import VM, Server, Migration, ArraySchedule
+from .. import genome
+
+def _encoding():
+    vms = [VM(4,2) for i in range(3)]
+    servers = [Server(8,4, location="A"), Server(8,4, location="B")]
+    return genome.Encoding(vms, servers)
+
+def test_encode_decode():
+    encoding = _encoding()
+    vm1, vm2, vm3 = encoding.vms
+    server1, server2 = encoding.servers
+    t1 = pd.Timestamp('2013-02-25 00:00')
+    t2 = pd.Timestamp('2013-02-25 13:00')
+    actions = pd.Series([Migration(vm2, server2), Migration(vm1, server1),
+                         Migration(vm3, server2)], [t2, t1, t2])
+    genes = encoding.encode(actions)
+    assert_equals(list(genes['vm']), [0, 1, 2]) # sorted by time (stable)
+    assert_equals(list(genes['server']), [0, 1, 1])
+    decoded = encoding.decode(genes)
+    assert_equals(list(decoded.index), [t1, t2, t2])
+    assert_equals(list(decoded.values), [actions[1], actions[0], actions[2]])
+    assert_equals(len(encoding.decode(genome.empty())), 0)
+    assert_equals(encoding, genome.Encoding(encoding.vms, encoding.servers))
+    with assert_raises(ValueError):
+        encoding.encode(pd.Series([VM(4,2)], [t1]))
+
+def test_random_genes():
+    start = pd.Timestamp('2013-02-25 00:00')
+    end = pd.Timestamp('2013-02-26 00:00')
+    genomes = genome.random_genes([5, 0, 40], start, end, 3, 2)
+    assert_equals([len(genes) for genes in genomes], [5, 0, 40])
+    for genes in genomes:
+        assert_true((np.diff(genes['t']) >= 0).all(), 'sorted by time')
+        assert_true((genes['t'] >= start.value).all())
+        assert_true((genes['t'] <= end.value).all())
+        assert_true((genes['t'] % genome.HOUR == 0).all(), 'full hours')
+        assert_true(((genes['vm'] >= 0) & (genes['vm'] < 3)).all())
+        assert_true(((genes['server'] >= 0) & (genes['server'] < 2)).all())
+
+def test_crossover():
+    encoding = _encoding()
+    t1 = pd.Timestamp('2013-02-25 00:00')
+    t2 = pd.Timestamp('2013-02-25 13:00')
+    t3 = pd.Timestamp('2013-02-25 20:00')
+    vm1, vm2, vm3 = encoding.vms
+    server1, server2 = encoding.servers
+    actions1 = pd.Series([Migration(vm1, server1), Migration(vm2, server1)],
+                         [t1, t2])
+    actions2 = pd.Series([Migration(vm2, server2), Migration(vm1, server2)],
+                         [t2, t3])
+    child1, child2 = genome.crossover(encoding.encode(actions1),
+                                      encoding.encode(actions2), t2.value)
+    justabit = pd.offsets.Micro(1)
+    expected1 = pd.concat([actions1[:t2], actions2[t2 + justabit:]])
+    expected2 = pd.concat([actions2[:t2], actions1[t2 + justabit:]])
+    assert_true(encoding.decode(child1).equals(expected1))
+    assert_true(encoding.decode(child2).equals(expected2))
+
+def test_add_gene():
+    encoding = _encoding()
+    vm1, vm2, vm3 = encoding.vms
+    server1, server2 = encoding.servers
+    times = [pd.Timestamp('2013-02-25 00:00') + pd.offsets.Hour(i)
+             for i in range(3)]
+    period = pd.offsets.Hour(2)
+    actions = pd.Series([Migration(vm1, server1), Migration(vm1, server2),
+                         Migration(vm2, server1)], times)
+    for action, t in [(Migration(vm2, server2), times[1]), # supersedes
+                      (Migration(vm1, server2), times[1]), # already there
+                      (Migration(vm1, server2), times[0]),
+                      (Migration(vm3, server2), times[1])]: # new
+        schedule = ArraySchedule()
+        schedule.environment = MagicMock(period=period)
+        schedule.actions = actions
+        added = schedule.add(action, t)
+        genes, genes_added = genome.add_gene(
+            encoding.encode(actions), encoding.gene(action, t),
+            pd.Timedelta(period).value)
+        assert_equals(genes_added, added)
+        assert_true(encoding.decode(genes).equals(schedule.actions))
+
+def test_mutation():
+    encoding = _encoding()
+    start = pd.Timestamp('2013-02-25 00:00')
+    end = pd.Timestamp('2013-02-26 00:00')
+    genes = genome.random_genes([6], start, end, 3, 2)[0]
+    random_gene = lambda: genome.random_genes([1], start, end, 3, 2)[0][0]
+    mutated = genome.mutation(genes, random_gene, genome.HOUR)
+    assert_equals(len(genes), 6, 'original unchanged')
+    assert_true((np.diff(mutated['t']) >= 0).all(), 'still sorted')
+    assert_equals(len(genome.mutation(genes)), 5, 'only removed a gene')
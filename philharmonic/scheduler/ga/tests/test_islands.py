@@ -0,0 +1,141 @@
+from __future__ import absolute_import
+from nose.tools import *
+import random
+
+import numpy as np
+import pandas as pd
+from mock import MagicMock, patch
+
+from philharmonic import VM, Server, Cloud, VMRequest
+from philharmonic.simulator.environment import GASimpleSimulatedEnvironment
+from philharmonic.simulator import inputgen
+from ..gascheduler import ScheduleUnit, GenomeUnit, create_random
+from .. import islands
+from ..islands import IslandGAScheduler, _pack
+from .. import genome
+
+def _cloud():
+    vms = [VM(4,2) for i in range(3)]
+    servers = [Server(8,4, location="A"), Server(8,4, location="B")]
+    return Cloud(servers, set(vms), auto_allocate=False)
+
+def _scheduler(cloud, genome=False):
+    times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
+    env = GASimpleSimulatedEnvironment(times, forecast_periods=20)
+    env.t = times[0]
+    env.el_prices = inputgen.simple_el()
+    env.temperature = inputgen.simple_temperature()
+    env.get_requests = MagicMock(return_value=[])
+
+    scheduler = IslandGAScheduler()
+    scheduler.islands = 3
+    scheduler.migration_interval = 2
+    scheduler.migration_size = 2
+    scheduler.population_size = 6
+    scheduler.max_generations = 5
+    scheduler.recombination_rate = 0.4
+    scheduler.mutation_rate = 0.18
+    scheduler.greedy_constraint_fix = False
+    scheduler.genome = genome
+    scheduler.cloud = cloud
+    scheduler.environment = env
+    scheduler.initialize()
+    return scheduler
+
+def test_pack_unpack():
+    scheduler = _scheduler(_cloud())
+    env, cloud = scheduler.environment, scheduler.cloud
+    scheduler._encoding = genome.Encoding(cloud.vms, cloud.servers)
+    unit = create_random(env, cloud, evaluator=scheduler.evaluator)
+    assert_is_none(_pack(unit, scheduler._encoding)[1], 'not evaluated')
+    unit.calculate_fitness()
+    copy = scheduler._unpack(_pack(unit, scheduler._encoding))
+    assert_is_instance(copy, ScheduleUnit)
+    assert_true(copy.actions.equals(unit.actions))
+    assert_false(copy.changed)
+    assert_equals(copy.fitness, unit.fitness)
+    scheduler.genome = True
+    copy = scheduler._unpack(_pack(unit, scheduler._encoding))
+    assert_is_instance(copy, GenomeUnit)
+    assert_true(copy.actions.equals(unit.actions))
+
+def test_island_gascheduler():
+    cloud = _cloud()
+    selected = []
+    for i in range(2):
+        random.seed(3)
+        np.random.seed(3)
+        scheduler = _scheduler(cloud)
+        best = scheduler.reevaluate()
+        assert_is_instance(best, ScheduleUnit)
+        assert_equals(len(scheduler._island_populations), 3)
+        for population in scheduler._island_populations:
+            assert_equals(len(population), 6)
+        # the global best, constraint satisfying units first
+        satisfying = [unit for unit in scheduler.population
+                      if unit.constr == 0]
+        if satisfying:
+            assert_equals(best.fitness, min(u.fitness for u in satisfying))
+        else:
+            assert_equals(best.fitness, min(u.fitness
+                                            for u in scheduler.population))
+        selected.append((best.fitness, list(best.actions.index),
+                         list(best.actions.values)))
+    assert_equals(selected[0], selected[1], 'reproducible for a seed')
+
+def test_island_gascheduler_two_times():
+    scheduler = _scheduler(_cloud(), genome=True)
+    scheduler.reevaluate()
+    env, cloud = scheduler.environment, scheduler.cloud
+    env.t = pd.Timestamp('2013-02-25 17:00')
+    vm = list(cloud.vms)[0]
+    cloud.apply_real(VMRequest(vm, 'delete'))
+    best = scheduler.reevaluate()
+    assert_true(len(best.actions[:'2013-02-25 16:00']) == 0,
+                'no outdated actions in the updated schedule')
+    assert_not_in(vm, set(act.vm for act in best.actions),
+                  'no actions for deleted VMs in the updated schedule')
+
+def test_island_failure():
+    evolve_island = islands._evolve_island
+    for failing in [0, 2]:
+        def evolve(scheduler, index, seed, connection):
+            if index == failing:
+                raise ValueError('island {} failed'.format(index))
+            evolve_island(scheduler, index, seed, connection)
+        scheduler = _scheduler(_cloud())
+        with patch.object(islands, '_evolve_island', evolve):
+            with assert_raises(ValueError): # not a hang or an EOFError
+                scheduler.reevaluate()
+
+class _Connection(object):
+    """Counts the immigrants an island receives."""
+    def __init__(self, connection):
+        self._connection = connection
+        self.immigrants = []
+
+    def send(self, message):
+        self._connection.send(message)
+
+    def recv(self):
+        message = self._connection.recv()
+        if message is not None:
+            self.immigrants.append(len(message))
+        return message
+
+def test_island_migration_after_stop():
+    """a stopped island's last emigrants are not sent again"""
+    evolve_island = islands._evolve_island
+    def evolve(scheduler, index, seed, connection):
+        if index == 0:
+            scheduler.max_generations = 2
+            return evolve_island(scheduler, index, seed, connection)
+        connection = _Connection(connection)
+        evolve_island(scheduler, index, seed, connection)
+        # migrations at generation 2 (island 0 still active) and 4
+        assert_equals(connection.immigrants, [2, 0])
+    scheduler = _scheduler(_cloud())
+    scheduler.islands = 2
+    scheduler.max_generations = 6
+    with patch.object(islands, '_evolve_island', evolve):
+        scheduler.reevaluate()
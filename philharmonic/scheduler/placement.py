@@ -0,0 +1,137 @@
+"""Placement kernel shared by the greedy schedulers - checks whether a VM fits
+many hosts at once, given a matrix of their free capacities (a row per host,
+a column per resource type).
+
+"""
+
+import numpy as np
+
+from philharmonic.cloud.model import Machine, _aligned
+
+def _matrix(specs, resource_types):
+    """The resource values of the specs as a matrix (a row per spec)."""
+    n = len(resource_types)
+    if all(getattr(spec, 'resource_types', None) is resource_types and
+           len(spec.vector) == n for spec in specs): # aligned ResourceSpecs
+        vectors = [spec.vector for spec in specs]
+    else:
+        vectors = [_aligned(spec, resource_types) for spec in specs]
+    matrix = np.array(vectors, dtype=float)
+    matrix.shape = (len(specs), n)
+    return matrix
+
+def capacity_matrix(servers, resource_types=None):
+    """The capacities of the servers (a row per server)."""
+    if resource_types is None:
+        resource_types = Machine.resource_types
+    return _matrix([s.cap for s in servers], resource_types)
+
+def free_capacity_matrix(state, servers, resource_types=None):
+    """The free capacities of the servers in state (a row per server)."""
+    if resource_types is None:
+        resource_types = Machine.resource_types
+    if getattr(state, 'resource_types', None) == list(resource_types):
+        try: # ArrayState - take the rows of its free capacity array
+            return state._free[[state._server_idx[s] for s in servers]]
+        except AttributeError:
+            pass
+    free_cap = state.free_cap
+    return _matrix([free_cap[s] for s in servers], resource_types)
+
+def demand_vector(vm, resource_types=None):
+    """The resource demand of vm."""
+    if resource_types is None:
+        resource_types = Machine.resource_types
+    return _aligned(vm.res, resource_types)
+
+def fit(free, cap, demand, weights=None):
+    """Check the demand of a VM against all the hosts at once.
+
+    @param free: free capacity matrix of the hosts (a row per host)
+    @param cap: capacity matrix of the hosts
+    @param demand: resource demand vector of the VM
+    @param weights: resource weights for the utilisation (uniform if None)
+    @returns: feasibility mask (the VM fits the host without exceeding any
+      resource's capacity), utilisation vector of the hosts after placement
+
+    """
+    remaining = free - demand
+    mask = (remaining >= 0).all(axis=1)
+    if weights is None:
+        weights = np.ones(cap.shape[1]) / cap.shape[1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        utilisation = ((cap - remaining) / cap).dot(weights)
+    return mask, utilisation
+
+def fit_vm(vm, servers, state):
+    """fit of vm for the servers in state.
+
+    @returns: feasibility mask, utilisation vector after placement
+
+    """
+    resource_types = Machine.resource_types
+    return fit(free_capacity_matrix(state, servers, resource_types),
+               capacity_matrix(servers, resource_types),
+               demand_vector(vm, resource_types))
+
+_NO_SERVER = float('-inf') # free capacity of the padding leaves
+
+class FirstFitIndex(object):
+    """Segment tree over a list of servers that stores the maximum free
+    capacity of each resource in every subtree, to find the leftmost server
+    that a VM fits (like the first True of fit's mask) without checking the
+    servers one by one.
+
+    A subtree is only searched if the VM fits its maximums, so a query takes
+    O(log n) steps when the maximums come from the same server (e.g. with a
+    single resource) and backtracks only where they come from different
+    ones. Updating a server's free capacity takes O(log n).
+
+    """
+
+    def __init__(self, servers, state, resource_types=None):
+        if resource_types is None:
+            resource_types = Machine.resource_types
+        self.servers = list(servers)
+        self.resource_types = resource_types
+        self._position = {server: i for i, server in enumerate(self.servers)}
+        self._size = 1
+        while self._size < len(self.servers):
+            self._size *= 2
+        # node i has the children 2i and 2i+1, the leaves start at _size
+        padding = (_NO_SERVER,) * len(resource_types)
+        self._tree = [padding] * (2 * self._size)
+        free = free_capacity_matrix(state, self.servers, resource_types)
+        for i, row in enumerate(free.tolist()):
+            self._tree[self._size + i] = tuple(row)
+        for node in range(self._size - 1, 0, -1):
+            self._tree[node] = self._max(node)
+
+    def _max(self, node):
+        return tuple(map(max, self._tree[2 * node], self._tree[2 * node + 1]))
+
+    def update(self, server, state):
+        """Update the free capacity of server after its VMs changed in
+        state."""
+        row = free_capacity_matrix(state, [server], self.resource_types)[0]
+        node = self._size + self._position[server]
+        self._tree[node] = tuple(row.tolist())
+        node //= 2
+        while node > 0:
+            self._tree[node] = self._max(node)
+            node //= 2
+
+    def find(self, vm):
+        """The leftmost server that vm fits or None if there is none."""
+        demand = demand_vector(vm, self.resource_types).tolist()
+        tree = self._tree
+        stack = [1]
+        while stack:
+            node = stack.pop()
+            if any(free < d for free, d in zip(tree[node], demand)):
+                continue
+            if node >= self._size:
+                return self.servers[node - self._size]
+            stack.append(2 * node + 1)
+            stack.append(2 * node) # the left subtree first
+        return None
@@ -1,3 +1,5 @@
+import random
+
 from nose.tools import *
 from mock import MagicMock
 import pandas as pd
@@ -98,3 +100,69 @@ def test_sort_pms_cost_first_same_cost():
     state = State(servers, [])
     sorted_pms = sort_inactive_pms(servers, state, cost)
     assert_equals(sorted_pms, [pm4, pm3, pm2, pm1])
+
+def test_placement_context():
+    """the same hosts as sorting all the servers for every VM"""
+    random.seed(1)
+    servers = [Server(random.choice([4000, 8000]), random.choice([2, 4, 8]),
+                      location=random.choice(['A', 'B']))
+               for i in range(30)]
+    vms = [VM(random.choice([1000, 2000, 4000]), random.choice([1, 2]))
+           for i in range(60)]
+    cost = pd.Series({'A': 0.04, 'B': 0.08})
+    state = State(servers, vms)
+    for vm in vms[:10]: # some hosts are active
+        state.place(vm, random.choice(servers))
+    context = PlacementContext(servers, state, cost)
+    scheduler = BCFScheduler()
+    scheduler.cloud = MagicMock()
+    scheduler.cloud.get_current = MagicMock(return_value=state)
+    fits = lambda vm, s: scheduler._fits(vm, s) != -1
+    for vm in vms[5:]: # some of them migrate from their hosts
+        hosts = [s for s in servers if not state.server_free(s)]
+        inactive = [s for s in servers if state.server_free(s)]
+        candidates = (sort_active_pms(hosts, state, cost) +
+                      sort_inactive_pms(inactive, state, cost))
+        expected = next((s for s in candidates if fits(vm, s)), None)
+        host = context.find_host(vm)
+        assert_equals(host, expected)
+        if host is not None:
+            previous_host = state.allocation(vm)
+            context.place(vm, host, previous_host)
+            if previous_host is not None:
+                state.remove(vm, previous_host)
+            state.place(vm, host)
+
+def test_place_vms_batch():
+    """the same placements and schedule as placing the VMs one by one"""
+    random.seed(3)
+    servers = [Server(random.choice([4000, 8000]), random.choice([2, 4, 8]),
+                      location=random.choice(['A', 'B']))
+               for i in range(20)]
+    vms = [VM(random.choice([1000, 2000, 4000]), random.choice([1, 2]))
+           for i in range(30)]
+    el = pd.DataFrame({'A': [0.16], 'B': [0.08]}, [1])
+    temp = pd.DataFrame({'A': [15], 'B': [20]}, [1])
+    results = []
+    for batch in [True, False]:
+        cloud = Cloud(servers, vms)
+        for vm in vms[:5]:
+            cloud.apply_real(Migration(vm, servers[vms.index(vm)]))
+        scheduler = BCFScheduler()
+        scheduler.cloud = cloud
+        scheduler.environment = FBFSimpleSimulatedEnvironment()
+        scheduler.environment.t = 1
+        scheduler.environment.current_data = MagicMock(return_value=(el, temp))
+        scheduler.schedule = Schedule()
+        scheduler._original_vm_hosts = {vms[0]: servers[0]}
+        VMs = sort_vms_big_first(vms[:1] + vms[5:])
+        if batch:
+            scheduler._place_vms(VMs, 1)
+        else:
+            for vm in VMs:
+                scheduler._place(vm, scheduler.find_host(vm), 1)
+        results.append((scheduler.schedule.actions,
+                        cloud.get_current().alloc))
+    (actions, alloc), (expected_actions, expected_alloc) = results
+    assert_true(actions.equals(expected_actions))
+    assert_equals(alloc, expected_alloc)
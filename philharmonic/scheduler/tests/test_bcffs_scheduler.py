@@ -169,3 +169,39 @@ def test_sort_pms_by_beta():
     state = cloud.apply(Migration(vm3, s2))
     sorted_pms = sort_pms_by_beta(servers, state)
     assert_equals(sorted_pms, [s2, s1, s3])
+
+def test_traced_frequency_scaling():
+    """the same frequency changes as evaluating every level's schedule"""
+    times = pd.date_range('2013-02-25 00:00', periods=48, freq='H')
+    servers = [Server(4000, 2, location='A'), Server(8000, 4, location='B'),
+               Server(4000, 4, location='B')]
+    vms = [VM(2000, 1) for i in range(4)]
+    for vm, beta in zip(vms, [0., 0.1, 0.5, 0.]):
+        vm.beta = beta
+    cloud = Cloud(servers, vms)
+    for vm, server in zip(vms, servers + servers[1:]):
+        cloud.apply_real(Migration(vm, server))
+    el = pd.DataFrame({'A': [2.] * len(times), 'B': [0.4] * len(times)},
+                      times)
+    temp = pd.DataFrame({'A': [25] * len(times), 'B': [15] * len(times)},
+                        times)
+    schedules, freqs = [], []
+    for traced in [True, False]:
+        scheduler = BCFFSScheduler()
+        scheduler.traced_frequency_scaling = traced
+        scheduler.cloud = cloud
+        scheduler.environment = FBFSimpleSimulatedEnvironment(
+            times, forecast_periods=12)
+        scheduler.environment.get_requests = MagicMock(return_value = [])
+        scheduler.environment.current_data = MagicMock(
+            return_value = (el, temp))
+        schedule = scheduler.reevaluate()
+        schedules.append(list(schedule.actions.iteritems()))
+        state = cloud.get_real().copy()
+        for action in schedule.actions:
+            state.transition(action, inplace=True)
+        freqs.append(dict(state.freq_scale))
+    assert_equals(schedules[0], schedules[1])
+    assert_equals(freqs[0], freqs[1])
+    assert_true(any(freq < 1. for freq in freqs[0].values()),
+                'some frequencies decreased')
@@ -70,6 +70,30 @@ def test_bfd_reevaluate_underutilised():
     assert_true(current.all_allocated())
 
 
+def test_place_all():
+    s1, s2 = Server(8000, 4), Server(4000, 2)
+    vm1, vm2, vm3 = VM(2000, 1), VM(1000, 2), VM(2000, 2)
+    assignments = [(vm1, s1), (vm2, s2), (vm3, s1)]
+    results = []
+    for batch in [True, False]:
+        cloud = Cloud([s1, s2], [vm1, vm2, vm3])
+        cloud.apply_real(Migration(vm1, s1))
+        scheduler = BFDScheduler()
+        scheduler.cloud = cloud
+        scheduler.schedule = Schedule()
+        scheduler._original_vm_hosts = {vm1: s1}
+        if batch:
+            scheduler._place_all(assignments, 1)
+        else:
+            for vm, host in assignments:
+                scheduler._place(vm, host, 1)
+        results.append((scheduler.schedule.actions,
+                        cloud.get_current().alloc))
+    (actions, alloc), (expected_actions, expected_alloc) = results
+    assert_true(actions.equals(expected_actions))
+    assert_equals(len(actions), 2) # vm1 already on s1
+    assert_equals(alloc, expected_alloc)
+
 def test_remove_vms_from_underutilised_hosts():
     scheduler = BFDScheduler()
     scheduler.environment = FBFSimpleSimulatedEnvironment()
@@ -5,7 +5,7 @@ from mock import patch
 import pandas as pd
 
 from ..evaluator import *
-from ..evaluator import _server_freqs_to_vm_freqs
+from ..evaluator import _server_freqs_to_vm_freqs, _full_util
 from philharmonic import Cloud, Server, VM, Schedule, Migration, \
     IncreaseFreq, DecreaseFreq
 from philharmonic.simulator import inputgen
@@ -31,6 +31,38 @@ def _configure(mock_conf):
     mock_conf.pricing_freq = '1h'
     return mock_conf
 
+def _reference_penalties(cloud, environment, schedule, el_prices,
+                         temperature, start, end):
+    """The penalties of evaluate, calculated separately with the per-metric
+    functions (assumes that no server is over capacity)."""
+    util = calculate_cloud_utilisation(cloud, environment, schedule,
+                                       start, end)
+    constraint_penalty = calculate_constraint_penalties(
+        cloud, environment, schedule, start, end)
+    sla_penalty = calculate_sla_penalties(cloud, environment, schedule,
+                                          start, end)
+    el_prices_current = el_prices[start:end]
+    if temperature is not None:
+        el_prices_current = el_prices_current * ph.calculate_pue(
+            temperature[start:end])
+    el_prices_server = pd.DataFrame({server: el_prices_current[server.loc]
+                                     for server in util.columns})
+    full_util = _full_util(start, end, util.columns)
+    utilprice_worst_avg = (el_prices_server * full_util).mean().mean()
+    util = util.reindex(el_prices_current.index, method='pad')
+    utilprice_penalty = ((el_prices_server * util).mean().mean() /
+                         utilprice_worst_avg)
+    nonzero_utilisation_avg = util[util > 0].mean().mean()
+    if np.isnan(nonzero_utilisation_avg):
+        nonzero_utilisation_avg = 0
+    return (1 - nonzero_utilisation_avg, utilprice_penalty,
+            constraint_penalty, sla_penalty)
+
+def _assert_penalties(penalties, expected):
+    assert_equals(len(penalties), len(expected))
+    for value, expected_value in zip(penalties, expected):
+        assert_almost_equals(value, expected_value)
+
 def test_calculate_cloud_utilisation():
     # some servers
     s1 = Server(4000, 2)
@@ -59,6 +91,50 @@ def test_calculate_cloud_utilisation():
     assert_true((df_util[s2] == [0., 0., 0.375, 0.375]).all())
     assert_true((df_util[s3] == [0., 0., 0., 0.0]).all())
 
+def test_calculate_cloud_utilisation_outside_window():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1);
+    cloud = Cloud([s1, s2], [vm1])
+
+    times = pd.date_range('2010-02-26 8:00', '2010-02-26 16:00', freq='H')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    schedule = Schedule()
+    schedule.add(Migration(vm1, s1), times[1])
+    schedule.add(Migration(vm1, s2), times[5]) # after end
+    # all the actions are replayed, not just those within start-end
+    df_util = calculate_cloud_utilisation(cloud, env, schedule,
+                                          times[0], times[3])
+    assert_equals(list(df_util.index), [times[0], times[1], times[5]])
+    assert_true((df_util[s1] == [0., 0.5, 0.]).all())
+    df_freq = calculate_cloud_frequencies(cloud, env, schedule,
+                                          times[0], times[3])
+    assert_equals(list(df_freq.index), [times[0], times[1], times[5]])
+
+def test_calculate_cloud_utilisation_from_history():
+    s1 = Server(4000, 2)
+    s2 = Server(8000, 4)
+    vm1 = VM(2000, 1);
+    vm2 = VM(2000, 2);
+    cloud = Cloud([s1, s2], [vm1, vm2])
+
+    times = pd.date_range('2010-02-26 8:00', '2010-02-26 16:00', freq='H')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    schedule = Schedule()
+    for t, action in [(times[1], Migration(vm1, s1)),
+                      (times[3], Migration(vm2, s2)),
+                      (times[5], Migration(vm1, s2))]:
+        cloud.apply_real(action, t=t) # what the simulator records
+        schedule.add(action, t)
+
+    df_util = calculate_cloud_utilisation(cloud, env, schedule,
+                                          times[2], times[6],
+                                          from_history=True)
+    assert_equals(list(df_util.index), [times[2], times[3], times[5],
+                                        times[6]])
+    assert_true((df_util[s1] == [0.5, 0.5, 0., 0.]).all())
+    assert_true((df_util[s2] == [0., 0.375, 0.625, 0.625]).all())
+
 @patch('philharmonic.scheduler.evaluator.conf')
 def test_calculate_cloud_frequencies(mock_conf):
     # some servers
@@ -271,6 +347,41 @@ def test_calculate_combined_energy_different_freq(mock_conf):
     assert_greater(energy1, energy2)
     assert_greater(energy2, energy3)
 
+@patch('philharmonic.scheduler.evaluator.conf')
+def test_combined_cost_power_steps(mock_conf):
+    mock_conf = _configure(mock_conf)
+    mock_conf.P_std = 0 # no noise - power stays a step function
+    s1 = Server(4000, 2, location='A')
+    s2 = Server(8000, 4, location='B')
+    servers = [s1, s2]
+    vm1 = VM(2000, 1);
+    vm2 = VM(2000, 2);
+    cloud = Cloud(servers, set([vm1, vm2]))
+
+    times = pd.date_range('2010-02-25 8:00', '2010-02-26 16:00', freq='H')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    schedule = Schedule()
+    schedule.add(Migration(vm1, s1), pd.Timestamp('2010-02-25 11:07'))
+    schedule.add(Migration(vm2, s2), pd.Timestamp('2010-02-25 13:00'))
+    schedule.add(DecreaseFreq(s1), pd.Timestamp('2010-02-25 13:00'))
+    start, end = env.t, env.forecast_end
+
+    el_prices = inputgen.simple_el(start=env.t)
+    temperature = inputgen.simple_temperature(start=env.t)
+    cost = combined_cost(cloud, env, schedule, el_prices, temperature,
+                         start, end)
+    energy = combined_energy(cloud, env, schedule, temperature, start, end)
+
+    # the same as with power resampled to conf.power_freq
+    util = calculate_cloud_utilisation(cloud, env, schedule, start, end)
+    freq = calculate_cloud_frequencies(cloud, env, schedule, start, end)
+    power = generate_cloud_power(util, freq=freq)
+    power = calculate_cloud_cooling(power, temperature[start:end])
+    dense_cost = calculate_cloud_cost(power, el_prices[start:end]).sum()
+    dense_energy = ph.joul2kwh(ph.calculate_energy(power).sum())
+    assert_almost_equals(cost, dense_cost)
+    assert_almost_equals(energy, dense_energy)
+
 def test_server_freqs_to_vm_freqs():
     s1 = Server(4000, 2, location='A')
     s2 = Server(8000, 4, location='B')
@@ -523,3 +634,244 @@ def test_evaluate():
     assert_true(0 <= cost_penalty <= 1, 'normalised value expected')
     assert_true(0 <= constraint_penalty <= 1, 'normalised value expected')
     assert_true(0 <= sla_penalty <= 1, 'normalised value expected')
+
+@patch('philharmonic.scheduler.evaluator.conf')
+def test_trace_schedule(mock_conf):
+    mock_conf = _configure(mock_conf)
+    mock_conf.P_std = 0 # no noise, so that the results can be compared
+    s1 = Server(4000, 2, location='A')
+    s2 = Server(8000, 4, location='B')
+    s3 = Server(4000, 2, location='B')
+    servers = [s1, s2, s3]
+    vm1 = VM(2000, 1);
+    vm2 = VM(2000, 2);
+    cloud = Cloud(servers, set([vm1, vm2]), auto_allocate=True)
+
+    times = inputgen.two_days(start='2010-02-26 00:00')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    env.el_prices = inputgen.simple_el(start=env.t)
+    temperature = inputgen.simple_temperature(start=env.t)
+    start, end = env.t, env.forecast_end
+    unscaled = Schedule()
+    t1 = pd.Timestamp('2010-02-26 11:00')
+    unscaled.add(Migration(vm1, s2), t1)
+    t2 = pd.Timestamp('2010-02-26 13:00')
+    unscaled.add(Migration(vm2, s3), t2)
+    unscaled.add(Migration(vm1, s3), t2)
+    schedule = copy.copy(unscaled)
+    schedule.add(DecreaseFreq(s2), t1)
+    schedule.add(DecreaseFreq(s3), pd.Timestamp('2010-02-26 15:00'))
+
+    trace = trace_schedule(cloud, env, schedule, start, end)
+    assert_true(trace.util.equals(
+        calculate_cloud_utilisation(cloud, env, schedule, start, end)))
+    assert_true(trace.freq.equals(
+        calculate_cloud_frequencies(cloud, env, schedule, start, end)))
+    assert_true(trace.vm_freq.equals(calculate_cloud_frequencies(
+        cloud, env, schedule, start, end, for_vms=True)))
+    assert_equals(trace.constraint_penalty, calculate_constraint_penalties(
+        cloud, env, schedule, start, end))
+    assert_equals((trace.migration_energy, trace.migration_cost),
+                  calculate_migration_overhead(cloud, env, schedule,
+                                               start, end))
+    assert_greater(trace.migration_energy, 0)
+    assert_equals(trace_schedule(cloud, env, unscaled, start, end).sla_penalty,
+                  calculate_sla_penalties(cloud, env, unscaled, start, end))
+    # the derived metrics
+    for schedule, trace in [(schedule, trace), (unscaled, trace.unscaled())]:
+        assert_almost_equals(
+            combined_cost(cloud, env, schedule, env.el_prices, temperature,
+                          start, end, trace=trace),
+            combined_cost(cloud, env, schedule, env.el_prices, temperature,
+                          start, end))
+        assert_almost_equals(
+            combined_energy(cloud, env, schedule, temperature,
+                            start, end, trace=trace),
+            combined_energy(cloud, env, schedule, temperature, start, end))
+        assert_almost_equals(
+            calculate_service_profit(cloud, env, schedule, start, end,
+                                     trace=trace),
+            calculate_service_profit(cloud, env, schedule, start, end))
+
+@patch('philharmonic.scheduler.evaluator.conf')
+def test_trace_schedule_outside_window(mock_conf):
+    mock_conf = _configure(mock_conf)
+    s1 = Server(4000, 2, location='A')
+    s2 = Server(8000, 4, location='B')
+    vm1 = VM(2000, 1);
+    vm2 = VM(2000, 2);
+    cloud = Cloud([s1, s2], set([vm1, vm2]))
+
+    times = inputgen.two_days(start='2010-02-26 00:00')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    env.el_prices = inputgen.simple_el(start=env.t)
+    start = pd.Timestamp('2010-02-26 06:00')
+    end = pd.Timestamp('2010-02-26 18:00')
+    schedule = Schedule()
+    schedule.add(Migration(vm1, s1), pd.Timestamp('2010-02-26 02:00'))
+    schedule.add(Migration(vm2, s1), pd.Timestamp('2010-02-26 08:00'))
+    schedule.add(Migration(vm1, s2), pd.Timestamp('2010-02-26 12:00'))
+    schedule.add(Migration(vm2, s2), pd.Timestamp('2010-02-26 20:00'))
+
+    trace = trace_schedule(cloud, env, schedule, start, end)
+    assert_true(trace.util.equals(
+        calculate_cloud_utilisation(cloud, env, schedule, start, end)))
+    assert_true(trace.freq.equals(
+        calculate_cloud_frequencies(cloud, env, schedule, start, end)))
+    assert_equals(trace.constraint_penalty, calculate_constraint_penalties(
+        cloud, env, schedule, start, end))
+    assert_equals(trace.sla_penalty,
+                  calculate_sla_penalties(cloud, env, schedule, start, end))
+    assert_equals((trace.migration_energy, trace.migration_cost),
+                  calculate_migration_overhead(cloud, env, schedule,
+                                               start, end))
+
+@patch('philharmonic.scheduler.evaluator.conf')
+def test_trace_with_frequency(mock_conf):
+    mock_conf = _configure(mock_conf)
+    s1 = Server(4000, 2, location='A')
+    s2 = Server(8000, 4, location='B')
+    vm1 = VM(2000, 1);
+    vm2 = VM(2000, 2);
+    cloud = Cloud([s1, s2], set([vm1, vm2]))
+    cloud.apply_real(Migration(vm1, s1))
+    cloud.apply_real(Migration(vm2, s2))
+
+    times = inputgen.two_days(start='2010-02-26 00:00')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    start, end = env.t, env.forecast_end
+    trace = trace_schedule(cloud, env, Schedule(), start, end)
+    schedule = Schedule()
+    schedule.add(DecreaseFreq(s2), start)
+    schedule.add(DecreaseFreq(s2), start)
+    state = cloud.get_real().copy()
+    state.decrease_freq(s2)
+    state.decrease_freq(s2)
+    scaled = trace.with_frequency(s2, [vm2], state.freq_scale[s2])
+    expected = trace_schedule(cloud, env, schedule, start, end)
+    assert_true(scaled.freq.equals(expected.freq))
+    assert_true(scaled.vm_freq.equals(expected.vm_freq))
+    assert_true(scaled.util.equals(expected.util))
+    assert_true(trace.freq[s2].equals(trace.unscaled().freq[s2]),
+                'the original trace unchanged')
+
+def test_evaluator_cache():
+    s1 = Server(4000, 2, location='A')
+    s2 = Server(8000, 4, location='B')
+    vm1 = VM(2000, 1);
+    cloud = Cloud([s1, s2], initial_vms=set([vm1]))
+
+    times = inputgen.two_days(start='2010-02-26 00:00')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    el_prices = inputgen.simple_el(start=env.t)
+    schedule = Schedule()
+    schedule.add(Migration(vm1, s1), pd.Timestamp('2010-02-26 13:00'))
+    end = pd.Timestamp('2010-02-27 00:00')
+
+    ev = Evaluator(cache_size=2)
+    ev.precreate_synth_power(times[0], times[-1], [s1, s2])
+    result1 = ev.evaluate(cloud, env, schedule, el_prices, None, times[0], end)
+    assert_equals((ev.hits, ev.misses), (0, 1))
+    assert_equals(ev.evaluate(cloud, env, schedule, el_prices, None,
+                              times[0], end), result1)
+    assert_equals((ev.hits, ev.misses), (1, 1))
+    # same end, different start - not mixed up
+    later = pd.Timestamp('2010-02-26 12:00')
+    result2 = ev.evaluate(cloud, env, schedule, el_prices, None, later, end)
+    assert_equals(ev.misses, 2)
+    assert_equals(result2, Evaluator().evaluate(cloud, env, schedule,
+                                                el_prices, None, later, end))
+    # changed inputs are recognised
+    el_prices2 = el_prices * 2
+    ev.evaluate(cloud, env, schedule, el_prices2, None, times[0], end)
+    assert_equals(ev.misses, 3)
+    el_prices2.iloc[0, 0] = 100 # even if changed in place
+    ev.evaluate(cloud, env, schedule, el_prices2, None, times[0], end)
+    assert_equals(ev.misses, 4)
+    assert_equals(len(ev._cache), 2) # only the last two periods kept
+
+def test_evaluate_incremental():
+    s1 = Server(4000, 4, location='A') # fits both VMs
+    s2 = Server(8000, 4, location='B')
+    vm1 = VM(2000, 1);
+    vm2 = VM(2000, 2);
+    cloud = Cloud([s1, s2], initial_vms=set([vm1, vm2]))
+
+    times = inputgen.two_days(start='2010-02-26 00:00')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    el_prices = inputgen.simple_el(start=env.t)
+    temperature = inputgen.simple_temperature(start=env.t)
+    start, end = times[0], pd.Timestamp('2010-02-27 00:00')
+    schedule = Schedule()
+    schedule.add(Migration(vm1, s1), start)
+    schedule.add(Migration(vm2, s1), pd.Timestamp('2010-02-26 05:00'))
+    schedule.add(Migration(vm1, s2), pd.Timestamp('2010-02-26 13:00'))
+
+    ev = Evaluator()
+    result, replay = ev.evaluate_incremental(cloud, env, schedule, el_prices,
+                                             temperature, start, end)
+    _assert_penalties(result, _reference_penalties(
+        cloud, env, schedule, el_prices, temperature, start, end))
+    assert_equals(len(replay.states), 3)
+
+    # change the schedule after the first two times
+    changed = copy.copy(schedule)
+    changed.add(Migration(vm2, s2), pd.Timestamp('2010-02-26 09:00'))
+    result2, replay2 = ev.evaluate_incremental(
+        cloud, env, changed, el_prices, temperature, start, end, replay
+    )
+    _assert_penalties(result2, _reference_penalties(
+        cloud, env, changed, el_prices, temperature, start, end))
+    assert_not_equal(result2, result)
+    # the states before the change were reused, the rest replayed
+    assert_true(all(new is old for new, old
+                    in zip(replay2.states[:2], replay.states[:2])))
+    assert_true(replay2.states[2] is not replay.states[2])
+    assert_equals(len(replay2.states), 4)
+    assert_equals(len(replay.states), 3) # the old replay is left as it was
+
+    # a different real state - everything replayed
+    cloud.apply_real(Migration(vm2, s2))
+    result3, replay3 = ev.evaluate_incremental(
+        cloud, env, changed, el_prices, temperature, start, end, replay2
+    )
+    assert_true(replay3.states[0] is not replay2.states[0])
+    _assert_penalties(result3, _reference_penalties(
+        cloud, env, changed, el_prices, temperature, start, end))
+
+def test_evaluate_many():
+    s1 = Server(4000, 2, location='A')
+    s2 = Server(8000, 4, location='B')
+    vm1 = VM(2000, 1);
+    vm2 = VM(2000, 2);
+    cloud = Cloud([s1, s2], initial_vms=set([vm1, vm2]))
+
+    times = inputgen.two_days(start='2010-02-26 00:00')
+    env = FBFSimpleSimulatedEnvironment(times, forecast_periods=24)
+    el_prices = inputgen.simple_el(start=env.t)
+    temperature = inputgen.simple_temperature(start=env.t)
+    start, end = times[0], pd.Timestamp('2010-02-27 00:00')
+    schedule1 = Schedule() # no actions
+    schedule2 = Schedule()
+    schedule2.add(Migration(vm1, s1), start)
+    schedule2.add(Migration(vm2, s2), pd.Timestamp('2010-02-26 05:00'))
+    schedule3 = copy.copy(schedule2)
+    schedule3.add(Migration(vm1, s2), pd.Timestamp('2010-02-26 13:00'))
+    schedule3.add(Migration(vm2, s1), pd.Timestamp('2010-02-26 13:00'))
+    schedules = [schedule1, schedule2, schedule3]
+
+    ev = Evaluator()
+    results = ev.evaluate_many(cloud, env, schedules, el_prices, temperature,
+                               start, end)
+    assert_equals(len(results), 3)
+    for schedule, (penalties, replay) in zip(schedules, results):
+        _assert_penalties(penalties, _reference_penalties(
+            cloud, env, schedule, el_prices, temperature, start, end))
+    # the third schedule resumes from the second one's replay
+    replays = [None, None, results[1][1]]
+    resumed = ev.evaluate_many(cloud, env, schedules, el_prices, temperature,
+                               start, end, replays)
+    assert_true(resumed[2][1].states[1] is results[1][1].states[1])
+    for (penalties, _), (expected, _) in zip(resumed, results):
+        _assert_penalties(penalties, expected)
+    assert_equals(ev.evaluate_many(cloud, env, [], el_prices), [])
@@ -0,0 +1,62 @@
+from nose.tools import *
+import random
+
+import numpy as np
+
+from philharmonic import Server, VM, State, ArrayState
+from philharmonic.scheduler import placement
+
+def test_fit():
+    free = np.array([[4., 2.], [8., 1.], [2., 4.]])
+    cap = np.array([[8., 4.], [8., 4.], [4., 4.]])
+    mask, utilisation = placement.fit(free, cap, np.array([2., 1.]))
+    assert_equals(list(mask), [True, True, True])
+    assert_true(np.allclose(utilisation, [(0.75 + 0.75) / 2,
+                                          (0.25 + 1.) / 2,
+                                          (1. + 0.25) / 2]))
+    mask, utilisation = placement.fit(free, cap, np.array([4., 2.]))
+    assert_equals(list(mask), [True, False, False])
+    mask, utilisation = placement.fit(free, cap, np.array([1., 1.]),
+                                      weights=np.array([1., 0.]))
+    assert_true(np.allclose(utilisation, [5./8, 1./8, 3./4]))
+    mask, utilisation = placement.fit(free[:0], cap[:0], np.array([1., 1.]))
+    assert_equals(len(mask), 0)
+
+def test_fit_vm():
+    servers = [Server(4000, 2), Server(8000, 4), Server(2000, 8)]
+    vms = [VM(2000, 1), VM(4000, 2)]
+    for state_class in [State, ArrayState]:
+        state = state_class(servers, vms)
+        state.place(vms[0], servers[0])
+        free = placement.free_capacity_matrix(state, servers[::-1])
+        assert_equals(free.tolist(), [[2000, 8], [8000, 4], [2000, 1]])
+        mask, utilisation = placement.fit_vm(vms[1], servers, state)
+        assert_equals(list(mask), [False, True, False])
+        assert_equals(utilisation[1], 0.5)
+        mask, utilisation = placement.fit_vm(vms[1], [], state)
+        assert_equals(len(mask), 0)
+
+def test_first_fit_index():
+    """the first server of fit's mask"""
+    random.seed(2)
+    for num_servers in [1, 5, 30]:
+        servers = [Server(random.choice([2000, 4000, 8000]),
+                          random.choice([2, 4, 8]))
+                   for i in range(num_servers)]
+        vms = [VM(random.choice([1000, 2000, 4000]), random.choice([1, 2, 4]))
+               for i in range(3 * num_servers)]
+        state = State(servers, vms)
+        index = placement.FirstFitIndex(servers, state)
+        for vm in vms:
+            mask, utilisation = placement.fit_vm(vm, servers, state)
+            expected = servers[np.argmax(mask)] if mask.any() else None
+            server = index.find(vm)
+            assert_equals(server, expected)
+            if server is not None:
+                state.place(vm, server)
+                index.update(server, state)
+            if random.random() < 0.2: # free a server
+                server = random.choice(servers)
+                state.remove_all(server)
+                index.update(server, state)
+    assert_is_none(placement.FirstFitIndex([], state).find(vms[0]))
@@ -104,7 +104,8 @@ manager = "Simulator"
 
 factory = {
     # Scheduling algorithm to use. Can be:
-    #  FBFScheduler, BFDScheduler, GAScheduler, NoScheduler
+    #  FBFScheduler, BFDScheduler, GAScheduler, IslandGAScheduler,
+    #  NoScheduler
     "scheduler": "FBFScheduler",
     # Optional object to pass to the scheduler for parameters
     "scheduler_conf": None,
@@ -162,6 +163,15 @@ factory = {
 def get_factory():
     return factory
 
+# The State implementation used by the cloud model. Can be:
+#  State (dicts keyed by servers), ArrayState (NumPy arrays indexed by dense
+#  server/VM ids - vectorised utilisation and constraint checks, faster for
+#  large infrastructures)
+state_backend = "State"
+# Number of actions between the state snapshots that the cloud history keeps
+# (more frequent snapshots - faster Cloud.state_at, but more memory used)
+state_history_interval = 100
+
 # Various scheduling settings
 #============================
 # Percentage of utilisation under which a PM is considered underutilised
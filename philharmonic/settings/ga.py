@@ -9,9 +9,19 @@ gaconf = {
     "mutation_rate": 0.05,
     "max_generations": 60,
     #"max_generations": 2,
+    # stop earlier (but after min_generations) if reevaluate takes
+    # time_budget seconds or the best fitness doesn't improve in
+    # stall_generations generations (None - no such limit)
+    "time_budget": None,
+    "stall_generations": None,
+    "min_generations": 1,
     "random_recreate_ratio": 0.8,
     "no_temperature": False,
     "no_el_price": False,
+    # evaluate the fitness in this many worker processes (0 - serially)
+    "processes": 0,
+    # evolve NumPy-encoded genomes (faster for large populations)
+    "genome": False,
     # apply a hybrid GA/greedy algorithm, where
     # greedy hard constraint resolution is attempted
     # on the best schedule generated by the GA
@@ -0,0 +1,12 @@
+from .ga import *
+
+output_folder = os.path.join(base_output_folder, "ga_islands/")
+
+# populations evolving in separate processes
+gaconf["islands"] = 4
+# every migration_interval generations the migration_size fittest units
+# of each island replace the worst units of the next one
+gaconf["migration_interval"] = 5
+gaconf["migration_size"] = 2
+
+factory['scheduler'] = "IslandGAScheduler"
@@ -15,17 +15,18 @@ import philharmonic as ph
 from philharmonic.logger import *
 from philharmonic.scheduler import evaluator
 from philharmonic.utils import loc
-from philharmonic import Schedule
 
 def pickle_results(schedule):
     schedule.actions.to_pickle(loc('schedule.pkl'))
 
-def generate_series_results(cloud, env, schedule, nplots):
+def generate_series_results(cloud, env, schedule, nplots, trace=None):
     info('\nDynamic results\n---------------')
+    if trace is None:
+        trace = evaluator.trace_schedule(cloud, env, schedule)
     # cloud utilisation
     #------------------
     # evaluator.precreate_synth_power(env.start, env.end, cloud.servers)
-    util = evaluator.calculate_cloud_utilisation(cloud, env, schedule)
+    util = trace.util
     info('Utilisation (%)')
     info(str(util * 100))
     #print('- weighted mean per no')
@@ -71,7 +72,7 @@ def generate_series_results(cloud, env, schedule, nplots):
 
     # pm frequencies
     info('\nPM frequencies (MHz)')
-    pm_freqs = evaluator.calculate_cloud_frequencies(cloud, env, schedule)
+    pm_freqs = trace.freq
     info(pm_freqs)
 
     # PM avgutilization
@@ -113,11 +114,15 @@ def serialise_results(cloud, env, schedule):
 
     # dynamic results
     #----------------
-    generate_series_results(cloud, env, schedule, nplots)
+    # everything below is calculated from a single pass through the schedule
+    trace = evaluator.trace_schedule(cloud, env, schedule)
+    # the schedule if we did not apply any frequency scaling
+    trace_unscaled = trace.unscaled()
+    generate_series_results(cloud, env, schedule, nplots, trace)
 
-    energy = evaluator.combined_energy(cloud, env, schedule)
+    energy = evaluator.combined_energy(cloud, env, schedule, trace=trace)
     energy_total = evaluator.combined_energy(cloud, env, schedule,
-                                             env.temperature)
+                                             env.temperature, trace=trace)
 
     # Aggregated results
     #===================
@@ -125,9 +130,8 @@ def serialise_results(cloud, env, schedule):
 
     # migration overhead
     #-------------------
-    migration_energy, migration_cost = evaluator.calculate_migration_overhead(
-        cloud, env, schedule
-    )
+    migration_energy, migration_cost = (trace.migration_energy,
+                                        trace.migration_cost)
     info('Migration energy (kWh)')
     info(migration_energy)
     info(' - total with migrations:')
@@ -145,7 +149,7 @@ def serialise_results(cloud, env, schedule):
     # info(en_cost_IT)
     info(' - total electricity cost without cooling:')
     en_cost_IT_total = evaluator.combined_cost(cloud, env, schedule,
-                                               env.el_prices)
+                                               env.el_prices, trace=trace)
     info(en_cost_IT_total)
 
     # TODO: reenable
@@ -156,25 +160,21 @@ def serialise_results(cloud, env, schedule):
     info(' - total electricity cost with cooling:')
     en_cost_with_cooling_total = evaluator.combined_cost(cloud, env, schedule,
                                                          env.el_prices,
-                                                         env.temperature)
+                                                         env.temperature,
+                                                         trace=trace)
     info(en_cost_with_cooling_total)
     info(' - total electricity cost with migrations:')
     en_cost_combined = en_cost_with_cooling_total + migration_cost
     info(en_cost_combined)
 
-    # the schedule if we did not apply any frequency scaling
-    schedule_unscaled = Schedule()
-    schedule_unscaled.actions = schedule.actions[
-        schedule.actions.apply(lambda a : not a.name.endswith('freq'))
-    ]
-
     # QoS aspects
     info(' - total profit from users:')
-    serv_profit = evaluator.calculate_service_profit(cloud, env, schedule)
+    serv_profit = evaluator.calculate_service_profit(cloud, env, schedule,
+                                                     trace=trace)
     info('${}'.format(serv_profit))
     info(' - profit loss due to scaling:')
     serv_profit_unscaled = evaluator.calculate_service_profit(
-        cloud, env, schedule_unscaled
+        cloud, env, schedule, trace=trace_unscaled
     )
     scaling_profit_loss = serv_profit_unscaled - serv_profit
     scaling_profit_loss_rel = scaling_profit_loss / serv_profit_unscaled
@@ -184,7 +184,8 @@ def serialise_results(cloud, env, schedule):
     # frequency savings
     info(' - frequency scaling savings (compared to no scaling):')
     en_cost_combined_unscaled = evaluator.combined_cost(
-        cloud, env, schedule_unscaled, env.el_prices, env.temperature
+        cloud, env, schedule, env.el_prices, env.temperature,
+        trace=trace_unscaled
     ) + migration_cost
     scaling_savings_abs = en_cost_combined_unscaled - en_cost_combined
     info('${}'.format(scaling_savings_abs))
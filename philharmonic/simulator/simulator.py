@@ -34,7 +34,7 @@ import philharmonic as ph
 from philharmonic.logger import *
 import inputgen
 from .results import serialise_results
-from philharmonic import Schedule
+from philharmonic import Schedule, ArraySchedule
 from philharmonic.scheduler.generic.fbf_optimiser import FBFOptimiser
 from philharmonic.manager.imanager import IManager
 #from philharmonic.cloud.driver import simdriver
@@ -137,14 +137,14 @@ class Simulator(IManager):
         SD_el = self.factory['SD_el'] if 'SD_el' in self.factory  else 0
         SD_temp = self.factory['SD_temp'] if 'SD_temp' in self.factory  else 0
         self.environment.model_forecast_errors(SD_el, SD_temp)
-        self.real_schedule = Schedule()
+        self.real_schedule = ArraySchedule()
 
     def apply_actions(self, actions):
         """apply actions (or requests) on the cloud (for "real") and log them"""
         self.cloud.reset_to_real()
         for t, action in actions.iteritems():
             #debug('apply %s at time %d'.format(action, t))
-            self.cloud.apply_real(action)
+            self.cloud.apply_real(action, t=t)
             self.real_schedule.add(action, t)
             self.driver.apply_action(action, t)
 
@@ -207,6 +207,127 @@ def calculate_cooling_overhead(power, temperature):
     pPUE = pPUE.reindex(power.index, method='ffill')
     return power * pPUE
 
+#-- step functions
+# Power that is derived from a schedule only changes when an action happens,
+# so it can be kept as a step function - every value holds until the next
+# index. The functions below give the same results as resampling such a step
+# function to freq (fill_method='pad') and passing it to calculate_energy,
+# calculate_price and calculate_cooling_overhead, but they only work with
+# the change points, not the whole resampled grid.
+
+def resampled_span(index, freq):
+    """@returns: the first and last timestamp of the grid that resampling
+    a time series with this index to freq would create
+
+    """
+    return index[0].floor(freq), index[-1].floor(freq)
+
+def _grid(index, freq):
+    """First point and step (in ns) and the number of points
+    of the resampled grid."""
+    first, last = resampled_span(index, freq)
+    step = pd.tseries.frequencies.to_offset(freq).nanos
+    return first.value, step, (last.value - first.value) // step + 1
+
+def _grid_counts(index, grid):
+    """How many grid points take each of the index's values when padding,
+    preceded by the number of points before index[0] (that are NaN)."""
+    first, step, num = grid
+    # the first grid point at or after each time
+    points = np.clip(-((first - index.asi8) // step), 0, num)
+    return np.diff(np.concatenate([[0], points, [num]]))
+
+def _grid_sum(values, counts, skipna):
+    """Sum of the resampled values (per column), given the step values
+    and their _grid_counts."""
+    values = np.asarray(values, dtype=float)
+    weights = counts[1:].astype(float)
+    if values.ndim > 1:
+        weights = weights[:, np.newaxis]
+    used = counts[1:] > 0
+    products = (weights * values)[used]
+    if not skipna:
+        total = products.sum(axis=0)
+        if counts[0] > 0: # padding leaves NaN before the first value
+            total = total * np.nan
+        return total
+    total = np.nansum(products, axis=0)
+    # pandas sums all-NaN data to NaN
+    return np.where(np.isnan(values[used]).all(axis=0), np.nan, total)
+
+def _grid_value(steps, grid, point):
+    """Value of the resampled step function at the given grid point."""
+    first, step, num = grid
+    time = first + point * step
+    position = steps.index.asi8.searchsorted(time, side='right') - 1
+    if position < 0:
+        return np.nan * np.asarray(steps.values[0], dtype=float)
+    return np.asarray(steps.values[position], dtype=float)
+
+def _wrap(steps, values):
+    """Package per-column results like the DataFrame/Series functions do."""
+    if isinstance(steps, pd.DataFrame):
+        return pd.Series(values, index=steps.columns)
+    return float(values)
+
+def calculate_step_energy(power, freq):
+    """Energy of a step function of power values, the same as
+    calculate_energy(power.resample(freq, fill_method='pad')).
+
+    @param power: Series or DataFrame of power values (in Watts), each holding
+    until the next index
+    @param freq: frequency the power would be sampled at
+
+    @return: calculated energy in Joules
+
+    """
+    grid = _grid(power.index, freq)
+    first, step, num = grid
+    counts = _grid_counts(power.index, grid)
+    total = _grid_sum(power.values, counts, skipna=False)
+    # trapezoids over the grid + one extra step at the last value
+    edges = _grid_value(power, grid, num - 1) - _grid_value(power, grid, 0)
+    energy = step / 1e9 * (total + edges / 2.)
+    return _wrap(power, energy)
+
+def _align_steps(steps, other):
+    """Join the change points of two step functions, keeping only the points
+    of other within the steps' span."""
+    start, end = steps.index[0], steps.index[-1]
+    times = other.index[(other.index >= start) & (other.index <= end)]
+    index = steps.index.union(times)
+    return (steps.reindex(index, method='ffill'),
+            other.reindex(index, method='ffill'))
+
+def calculate_step_price(power, prices, freq):
+    """Electricity cost of a step function of power values, the same as
+    calculate_price(power.resample(freq, fill_method='pad'), prices).
+
+    @param power: Series or DataFrame of power values (W), each holding until
+    the next index
+    @param prices: Series or DataFrame of electricity prices ($/kWh)
+    @param freq: frequency the power would be sampled at
+
+    @return: calculated price in $
+
+    """
+    grid = _grid(power.index, freq)
+    first, step, num = grid
+    power, prices = _align_steps(power, per_kwh2per_joul(prices))
+    counts = _grid_counts(power.index, grid)
+    total = _grid_sum((power * prices).values, counts, skipna=True)
+    # the same interval guess as calculate_price
+    h = num * step / 1e9 / (num + 1)
+    return _wrap(power, h * total)
+
+def calculate_step_cooling_overhead(power, temperature):
+    """Like calculate_cooling_overhead, but for a step function of power
+    values - the result is the step function of power with cooling overhead.
+
+    """
+    power, pPUE = _align_steps(power, calculate_pue(temperature))
+    return power * pPUE
+
 def vm_price(freq, C_base=0.0520278, C_dif=0.018, f_base=1000):
     """Calculate a VM's price based on the frequency. ElasticHosts model."""
     C = C_base + C_dif * (freq - f_base) / f_base
@@ -5,6 +5,7 @@ Created on Oct 15, 2012
 '''
 import unittest
 from nose.tools import *
+import numpy as np
 import pandas as pd
 
 from philharmonic.scheduler import EnergyPredictor
@@ -135,6 +136,32 @@ def test_calculate_power_freq_different_freqs():
     assert_almost_equals(list(power['s1'][num:]), [125.48] * num)
     assert_almost_equals(list(power['s2']), [139.93] * 2 * num)
 
+def test_calculate_step_functions():
+    # power changing at irregular times, prices and temperatures hourly
+    index = pd.DatetimeIndex(['2013-01-01 00:00', '2013-01-01 00:17',
+                              '2013-01-01 02:05', '2013-01-01 03:59'])
+    power = pd.DataFrame({'s1': [100., 150., 0., 120.],
+                          's2': [0., 130., 140., 200.]}, index)
+    hours = pd.date_range('2013-01-01', periods=5, freq='H')
+    prices = pd.DataFrame({'s1': [0.1, 0.2, 0.3, 0.2, 0.1],
+                           's2': [0.3, 0.3, 0.1, 0.2, 0.2]}, hours)
+    temperature = pd.DataFrame({'s1': [5, 10, 15, 20, 25],
+                                's2': [-5, 0, 5, 0, -5]}, hours)
+    # the same as resampling the step functions and integrating that
+    dense = power.resample('5min', fill_method='pad')
+    start, end = ph.resampled_span(power.index, '5min')
+    assert_equals((start, end), (dense.index[0], dense.index[-1]))
+    energy = ph.calculate_step_energy(power, '5min')
+    assert_true(np.allclose(energy, ph.calculate_energy(dense)))
+    assert_almost_equals(ph.calculate_step_energy(power['s1'], '5min'),
+                         ph.calculate_energy(dense['s1']))
+    price = ph.calculate_step_price(power, prices, '5min')
+    assert_true(np.allclose(price, ph.calculate_price(dense, prices[start:end])))
+    cooled = ph.calculate_step_cooling_overhead(power, temperature[start:end])
+    dense_cooled = ph.calculate_cooling_overhead(dense, temperature[start:end])
+    assert_true(np.allclose(ph.calculate_step_energy(cooled, '5min'),
+                            ph.calculate_energy(dense_cooled)))
+
 def test_vm_price():
     cost = ph.vm_price(2000)
     assert_is_instance(cost, float)